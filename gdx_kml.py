@@ -0,0 +1,702 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ gdx_kml
+                                 A QGIS plugin
+ GEarth View
+                             -------------------
+        KML encoding of feature geometries and attributes, and the
+        KMZ packaging of the published documents.
+
+        Nothing here depends on PyQt or QGIS: features come in as WKB
+        plus attribute values, so the same code runs in the QGIS main
+        thread and in the worker processes of the parallel export.
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import time, re, struct, zlib
+
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    # GDAL comes with QGIS; without it (the tests) only the OGR fallbacks
+    # and the worker transforms are missing
+    ogr = osr = None
+
+from xml.sax.saxutils import escape
+
+import numpy
+
+
+# GDX_Kml geometry encoding --------------------------------------
+
+GDX_REPROJECT_BATCH = 256
+
+
+# Returns (parts, hasZ): parts is a list of (kind, rings) where kind is
+# Point, LineString or Polygon and every ring is a (N, 3) numpy array.
+# The WKB is read straight into numpy arrays; OGR is only used to
+# simplify (tolerance, in layer units) and for curved geometries.
+# Points, and lines and rings already down to the vertices a
+# simplification keeps, stay on the numpy path whatever the tolerance.
+# clip, (xmin, ymin, xmax, ymax) in the geometry CRS, cuts what lies
+# outside; geometries inside it are read as they are.
+def GDX_WkbParts(wkb, tolerance=0., clip=None):
+
+				if not wkb:
+				  return [], False
+
+				parts = []
+				try:
+				  hasZ = GDX_WkbRead(wkb, 0, parts)[1]
+				except ValueError:
+				  return GDX_OgrWkbParts(wkb, tolerance, clip)
+
+				if tolerance > 0 and not GDX_PartsMinimal(parts):
+				  return GDX_OgrWkbParts(wkb, tolerance, clip)
+				if clip is not None and not GDX_PartsInside(parts, clip):
+				  return GDX_OgrWkbParts(wkb, tolerance, clip)
+				return parts, hasZ
+
+
+# True when simplifying cannot drop a vertex of parts: points, lines of
+# two vertices and rings of four (a triangle, closed).
+def GDX_PartsMinimal(parts):
+
+				for kind, rings in parts:
+				  if kind == 'LineString' and len(rings[0]) > 2:
+				    return False
+				  if kind == 'Polygon':
+				    for ring in rings:
+				      if len(ring) > 4:
+				        return False
+				return True
+
+
+def GDX_PartsInside(parts, clip):
+
+				xmin, ymin, xmax, ymax = clip
+				for kind, rings in parts:
+				  for ring in rings:
+				    if len(ring) and (ring[:, 0].min() < xmin or ring[:, 0].max() > xmax or
+				                      ring[:, 1].min() < ymin or ring[:, 1].max() > ymax):
+				      return False
+				return True
+
+
+# Reads the geometry at offset into parts, returns (next offset, hasZ).
+# Handles both byte orders, Multi* and collections, and the Z/M flavours
+# of WKB: ISO (1000/2000/3000 + type) and the 0x80000000/0x40000000 flags
+# of QGIS 2 and EWKB.  M values are dropped.
+def GDX_WkbRead(wkb, offset, parts):
+
+				order, code, hasZ, hasM = GDX_WkbHeader(wkb, offset)
+				uint32 = numpy.dtype(order + 'u4')
+				float64 = numpy.dtype(order + 'f8')
+				offset = offset + 5
+				dims = 2 + hasZ + hasM
+
+				def vertices(count, offset):
+				  coords = numpy.frombuffer(wkb, float64, count * dims, offset).reshape(count, dims)
+				  xyz = numpy.zeros((count, 3))
+				  xyz[:, :2] = coords[:, :2]
+				  if hasZ:
+				    xyz[:, 2] = coords[:, 2]
+				  return xyz, offset + count * dims * 8
+
+				if code == 1:
+				  xyz, offset = vertices(1, offset)
+				  if not numpy.isnan(xyz[0][0]):    # POINT EMPTY
+				    parts.append(('Point', [xyz]))
+
+				elif code == 2:
+				  count = int(numpy.frombuffer(wkb, uint32, 1, offset)[0])
+				  xyz, offset = vertices(count, offset + 4)
+				  if count:
+				    parts.append(('LineString', [xyz]))
+
+				elif code == 3:
+				  count = int(numpy.frombuffer(wkb, uint32, 1, offset)[0])
+				  offset = offset + 4
+				  rings = []
+				  for iii in range(count):
+				    xyz, offset = vertices(int(numpy.frombuffer(wkb, uint32, 1, offset)[0]), offset + 4)
+				    rings.append(xyz)
+				  if rings and len(rings[0]):
+				    parts.append(('Polygon', rings))
+
+				elif code in (4, 5, 6, 7):   # Multi* and GeometryCollection
+				  count = int(numpy.frombuffer(wkb, uint32, 1, offset)[0])
+				  offset = offset + 4
+				  for iii in range(count):
+				    offset = GDX_WkbRead(wkb, offset, parts)[0]
+
+				else:   # curves, surfaces...
+				  raise ValueError('WKB type %d' % (code))
+
+				return offset, hasZ
+
+
+# Returns (byte order, base type, hasZ, hasM) of the geometry at offset.
+def GDX_WkbHeader(wkb, offset=0):
+
+				if numpy.frombuffer(wkb, numpy.uint8, 1, offset)[0] == 1:
+				  order = '<'
+				else:
+				  order = '>'
+
+				code = int(numpy.frombuffer(wkb, numpy.dtype(order + 'u4'), 1, offset + 1)[0])
+
+				hasZ = bool(code & 0x80000000)
+				hasM = bool(code & 0x40000000)
+				code = code & 0x0fffffff
+				if code >= 1000:
+				  hasZ = hasZ or (code // 1000) in (1, 3)
+				  hasM = hasM or (code // 1000) in (2, 3)
+				  code = code % 1000
+				return order, code, hasZ, hasM
+
+
+GDX_WKB_NAMES = {1: 'Point', 2: 'LineString', 3: 'Polygon', 4: 'MultiPoint', 5: 'MultiLineString', 6: 'MultiPolygon', 7: 'GeometryCollection'}
+
+
+# The WKT type name, as QgsGeometry.exportToWkt writes it: PolygonZ...
+def GDX_WkbTypeName(wkb):
+
+				order, code, hasZ, hasM = GDX_WkbHeader(wkb)
+				return GDX_WKB_NAMES.get(code, 'Unknown') + 'Z' * hasZ + 'M' * hasM
+
+
+def GDX_OgrWkbParts(wkb, tolerance=0., clip=None):
+
+				parts = []
+				geometra = ogr.CreateGeometryFromWkb(wkb)
+				if geometra is None:
+				  return parts, False
+
+				if hasattr(geometra, 'HasCurveGeometry') and geometra.HasCurveGeometry():
+				  geometra = geometra.GetLinearGeometry()
+
+				if clip is not None:
+				  xmin, ymin, xmax, ymax = clip
+				  minX, maxX, minY, maxY = geometra.GetEnvelope()
+				  if minX < xmin or maxX > xmax or minY < ymin or maxY > ymax:
+				    clipped = geometra.Intersection(GDX_ClipBox(clip))
+				    # None: GEOS failed (invalid geometry), keep it whole
+				    if clipped is not None:
+				      if clipped.IsEmpty():
+				        return parts, False
+				      geometra = clipped
+
+				if tolerance > 0:
+				  geometra = geometra.SimplifyPreserveTopology(tolerance)
+
+				GDX_OgrParts(geometra, parts)
+				return parts, geometra.GetCoordinateDimension() == 3
+
+
+GDX_ClipBoxes = {}
+
+def GDX_ClipBox(clip):
+
+				box = GDX_ClipBoxes.get(clip)
+				if box is None:
+				  if len(GDX_ClipBoxes) > 64:
+				    GDX_ClipBoxes.clear()
+				  xmin, ymin, xmax, ymax = clip
+				  box = ogr.CreateGeometryFromWkt(('POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))') % (xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax, xmin, ymin))
+				  GDX_ClipBoxes[clip] = box
+				return box
+
+
+def GDX_OgrParts(geometra, parts):
+
+				tipo = ogr.GT_Flatten(geometra.GetGeometryType())
+
+				if tipo == ogr.wkbPoint:
+				  parts.append(('Point', [GDX_OgrVertices(geometra)]))
+
+				elif tipo == ogr.wkbLineString:
+				  parts.append(('LineString', [GDX_OgrVertices(geometra)]))
+
+				elif tipo == ogr.wkbPolygon:
+				  rings = []
+				  for iii in range(geometra.GetGeometryCount()):
+				    rings.append(GDX_OgrVertices(geometra.GetGeometryRef(iii)))
+				  parts.append(('Polygon', rings))
+
+				else:   # Multi* and GeometryCollection
+				  for iii in range(geometra.GetGeometryCount()):
+				    GDX_OgrParts(geometra.GetGeometryRef(iii), parts)
+
+
+def GDX_OgrVertices(geometra):
+
+				xyz = numpy.zeros((geometra.GetPointCount(), 3))
+				if len(xyz):
+				  punti = numpy.array(geometra.GetPoints(), dtype=float)
+				  xyz[:, :punti.shape[1]] = punti
+				return xyz
+
+
+# Reprojects, in place, all the rings of a batch of GDX_GeomParts results.
+def GDX_ReprojectBatch(transform, batch):
+
+				rings = [ring for parts in batch for kind, partRings in parts for ring in partRings if len(ring)]
+				if not rings:
+				  return
+
+				xyz = numpy.array(transform.TransformPoints(numpy.concatenate(rings).tolist()))
+
+				start = 0
+				for ring in rings:
+				  ring[:] = xyz[start:start + len(ring)]
+				  start = start + len(ring)
+
+
+# GDX_FormatCoords --------------------------------------
+#
+#  Coordinate blocks in one pass: a single format string repeated for the
+#  N rows of an (N, 2|3) array and applied to its flattened values, so the
+#  per-point work stays in C.  precision / zPrecision are the decimals
+#  (None: shortest repr of the float); a constant Z (or altitude) is
+#  formatted once and written as text.  suffix and terminator close every
+#  row: ' \n' for KML, ',ID,Name,Istr\n' for the 3dPoints CSV.
+#  trim strips the trailing zeros of the fixed decimals ("12.5000000"
+#  becomes "12.5", "3.0000000" becomes "3") with two regex passes over
+#  the whole block.
+
+GDX_TRIM_DECIMALS = re.compile(r'(\.[0-9]*?[1-9])0+(?![0-9])')
+GDX_TRIM_POINT = re.compile(r'\.0+(?![0-9])')
+
+def GDX_FormatCoords(xyz, withZ=False, altitude=None, precision=7, zPrecision=2, suffix='', terminator=' \n', trim=False):
+
+				count = len(xyz)
+				if not count:
+				  return ''
+
+				if withZ and altitude is None and (xyz[:, 2] == xyz[0, 2]).all():
+				  altitude = float(xyz[0, 2])
+
+				xyFormat = GDX_CoordFormat(precision)
+				rowFormat = xyFormat + ',' + xyFormat
+				if altitude is not None:
+				  rowFormat = rowFormat + ',' + (GDX_CoordFormat(zPrecision) % (altitude)).replace('%', '%%')
+				  values = xyz[:, :2]
+				elif withZ:
+				  rowFormat = rowFormat + ',' + GDX_CoordFormat(zPrecision)
+				  values = xyz[:, :3]
+				else:
+				  values = xyz[:, :2]
+
+				rowFormat = rowFormat + (suffix + terminator).replace('%', '%%')
+				text = (rowFormat * count) % tuple(values.ravel().tolist())
+				if trim:
+				  text = GDX_TRIM_POINT.sub('', GDX_TRIM_DECIMALS.sub(r'\1', text))
+				return text
+
+
+def GDX_CoordFormat(precision):
+
+				if precision is None:
+				  return '%r'
+				return ('%%.%df') % (precision)
+
+
+def GDX_KmlCoords(ring, altitude=None, withZ=False, precision=7, trim=False):
+
+				return GDX_FormatCoords(ring, withZ, altitude, precision, trim=trim)
+
+
+# altitude is the "height" field value: when set, polygons are extruded and
+# every vertex without its own Z takes that altitude.  altitudeMode
+# (absolute, relativeToGround...) places geometries with their own Z
+# above the ground, extruded down to it when extrude is set; without it
+# every geometry is draped on the terrain.  trim writes the shortest
+# coordinates: no trailing zeros, and no Z at all where Google Earth
+# ignores it (geometries draped on the terrain).
+def GDX_KmlGeometry(parts, hasZ, altitude=None, altitudeMode=None, extrude=False, precision=7, trim=False):
+
+				elevated = ''
+				if hasZ and altitudeMode:
+				  elevated = ('			<altitudeMode>%s</altitudeMode>\n') % (altitudeMode)
+				  if extrude:
+				    elevated = '			<extrude>1</extrude>\n' + elevated
+
+				kml = []
+				if len(parts) > 1:
+				  kml.append('		<MultiGeometry>\n')
+
+				for kind, rings in parts:
+
+				  if kind == 'Point':
+				    kml.append('		<Point>\n')
+				    kml.append('			<gx:drawOrder>1</gx:drawOrder>\n')
+				    kml.append(elevated)
+				    kml.append(('			<coordinates>%s</coordinates>\n') % (GDX_FormatCoords(rings[0][:1], bool(elevated), None, precision, terminator='', trim=trim)))
+				    kml.append('		</Point>\n')
+
+				  elif kind == 'LineString':
+				    kml.append('		<LineString>\n')
+				    if elevated:
+				      kml.append(elevated)
+				    else:
+				      kml.append('			<tessellate>1</tessellate>\n')
+				    kml.append('			<coordinates>\n')
+				    kml.append(GDX_KmlCoords(rings[0], withZ=hasZ and not (trim and not elevated), precision=precision, trim=trim))
+				    kml.append('			</coordinates>\n')
+				    kml.append('		</LineString>\n')
+
+				  elif kind == 'Polygon':
+
+				    # Se non e' un "PolygonZ", aggiungi la coordinata di estrusione
+				    #  altrimenti, utilizza la sua Z
+				    ownZ = hasZ and len(rings[0]) and rings[0][0][2] != 0
+				    if ownZ:
+				      height = None
+				    elif altitude is not None:
+				      height = altitude
+				    elif trim:
+				      height = None
+				    else:
+				      height = 0.
+				    withZ = ownZ and not (trim and altitude is None and not elevated)
+
+				    if altitude is not None:
+				      kml.append('		<Polygon><extrude>1</extrude><altitudeMode>relativeToGround</altitudeMode>\n')
+				    elif ownZ and elevated:
+				      kml.append('		<Polygon>\n')
+				      kml.append(elevated)
+				    else:
+				      kml.append('		<Polygon>\n')
+				      kml.append('			<tessellate>1</tessellate>\n')
+
+				    for iii in range(len(rings)):
+				      if iii == 0:
+				        kml.append('     <outerBoundaryIs><LinearRing><coordinates>\n')
+				      else:
+				        kml.append('     <innerBoundaryIs><LinearRing><coordinates>\n')
+				      kml.append(GDX_KmlCoords(rings[iii], height, withZ, precision, trim))
+				      if iii == 0:
+				        kml.append('     </coordinates></LinearRing></outerBoundaryIs>\n')
+				      else:
+				        kml.append('     </coordinates></LinearRing></innerBoundaryIs>\n')
+
+				    kml.append('		</Polygon>\n')
+
+				if len(parts) > 1:
+				  kml.append('		</MultiGeometry>\n')
+
+				return ''.join(kml)
+
+
+# job['lazy'], when set, is the /feature URL of the layer up to the fid:
+# the balloon loads the attributes from there (see GDX_FeaturePage).
+GDX_LAZY_WIDTH = 400
+GDX_LAZY_HEIGHT = 300
+
+def GDX_KmlPlacemark(job, fid, attrs, parts, hasZ):
+
+				names = job['names']
+				heightIdx = job['heightIdx']
+				schema = job['schema']
+				kind = parts[0][0]
+
+				kml = []
+				kml.append('	<Placemark>\n')
+				kml.append(('		<name>%s</name>\n') % (fid))
+
+				if schema is not None:
+				  kml.append(('		<styleUrl>#%s</styleUrl>\n') % (schema['id']))
+				elif kind == 'Point':
+				  kml.append('	<styleUrl>#default0</styleUrl>\n')
+				elif kind == 'Polygon':
+				  kml.append('		<styleUrl>#msn_style</styleUrl>\n')
+
+# DESCRIPTION DATA-----------
+				kml.append('	<Snippet maxLines="0"></Snippet>\n')
+				if schema is not None:
+				  kml.append(GDX_KmlSchemaData(schema, attrs))
+				elif job.get('lazy'):
+				  kml.append(('	<description><![CDATA[<iframe src="%s%s" width="%d" height="%d" frameborder="0"></iframe>]]></description>\n') % (job['lazy'], fid, GDX_LAZY_WIDTH, GDX_LAZY_HEIGHT))
+				elif names:
+				  kml.append('	<description><![CDATA[\n')
+				  kml.append('<html><body><table border="1">\n')
+				  kml.append('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
+				  for iii in range(len(names)):
+				    value = attrs[iii]
+				    if value is None:
+				      value = 'NULL'
+				    kml.append(('<tr><td>%s</td><td>%s</td></tr>\n') % (names[iii], value))
+				  kml.append('</table></body></html>\n')
+				  kml.append(']]></description>\n')
+
+				# Se esiste un campo "height" prendi il valore e impostalo
+				altitude = None
+				if heightIdx >= 0 and kind == 'Polygon':
+				  try:
+				    altitude = float(attrs[heightIdx])
+				  except (TypeError, ValueError):
+				    altitude = 0.
+
+				kml.append(GDX_KmlGeometry(parts, hasZ, altitude, job.get('altitudeMode'), job.get('extrude'), job.get('precision', 7), job.get('trim')))
+				kml.append('	</Placemark>\n')
+
+				return ''.join(kml)
+
+
+# GDX_KmlSchema --------------------------------------
+#
+#  "schema" attribute encoding: the layer fields are declared once in a
+#  <Schema>, every Placemark carries its values as <SchemaData> and one
+#  shared <BalloonStyle> template ($[schema/field]) renders the balloons,
+#  instead of an HTML table per feature.  fields is a list of
+#  (name, kmlType); the result is computed once per layer.
+
+def GDX_KmlSchema(schemaId, fields):
+
+				schema = {'id': schemaId, 'simpleData': []}
+
+				header = []
+				rows = []
+				header.append(('	<Schema name="%s" id="%s">\n') % (schemaId, schemaId))
+				for iii in range(len(fields)):
+				  name, kmlType = fields[iii]
+				  quoted = escape(name, {'"': '&quot;'})
+				  header.append(('		<SimpleField name="%s" type="%s"><displayName>%s</displayName></SimpleField>\n') % (quoted, kmlType, escape(name)))
+				  rows.append(('<tr><td>%s</td><td>$[%s/%s]</td></tr>\n') % (escape(name), schemaId, name))
+				  schema['simpleData'].append((iii, ('<SimpleData name="%s">') % (quoted)))
+				header.append('	</Schema>\n')
+
+				balloon = ('		<BalloonStyle><text><![CDATA[\n'
+				           '<html><body><table border="1">\n'
+				           '<tr><th>Field Name</th><th>Field Value</th></tr>\n'
+				           '%s'
+				           '</table></body></html>\n'
+				           ']]></text></BalloonStyle>\n') % (''.join(rows))
+
+				# normal and highlight styles, for points, lines and polygons alike
+				for suffix, icon, poly in (('_n', 'placemark_circle', '<color>00ff8080</color><fill>0</fill>'),
+				                           ('_h', 'placemark_circle_highlight', '<color>7fff8080</color>')):
+				  header.append(('	<Style id="%s%s">\n') % (schemaId, suffix))
+				  header.append(('		<IconStyle><scale>0.7</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/%s.png</href></Icon></IconStyle>\n') % (icon))
+				  header.append('		<LabelStyle><scale>0.7</scale></LabelStyle>\n')
+				  header.append(('		<PolyStyle>%s</PolyStyle>\n') % (poly))
+				  header.append(balloon)
+				  header.append('	</Style>\n')
+
+				header.append(('	<StyleMap id="%s">\n') % (schemaId))
+				header.append(('		<Pair><key>normal</key><styleUrl>#%s_n</styleUrl></Pair>\n') % (schemaId))
+				header.append(('		<Pair><key>highlight</key><styleUrl>#%s_h</styleUrl></Pair>\n') % (schemaId))
+				header.append('	</StyleMap>\n')
+
+				schema['header'] = ''.join(header)
+				return schema
+
+
+def GDX_KmlSchemaData(schema, attrs):
+
+				kml = []
+				kml.append(('		<ExtendedData><SchemaData schemaUrl="#%s">') % (schema['id']))
+				for iii, element in schema['simpleData']:
+				  value = attrs[iii]
+				  if value is not None:
+				    kml.append(element)
+				    kml.append(escape(('%s') % (value,)))
+				    kml.append('</SimpleData>')
+				kml.append('</SchemaData></ExtendedData>\n')
+				return ''.join(kml)
+
+
+# GDX_EncodeChunk --------------------------------------
+#
+#  Entry point of the parallel export workers (see GDX_KmlEncodeParallel
+#  in gearthview.py).  spec is (srcWkt, tolerance, job), job holding what
+#  GDX_KmlPlacemark reads, and items a list of (fid, wkb, attrs); returns,
+#  in the same order, a list of (fid, placemark, parts, hasZ) with the
+#  parts already in Wgs84.
+
+GDX_WorkerTransforms = {}
+
+
+def GDX_WorkerTransform(srcWkt):
+
+				if srcWkt not in GDX_WorkerTransforms:
+				  srcSrs = osr.SpatialReference()
+				  srcSrs.ImportFromWkt(srcWkt)
+				  destSrs = osr.SpatialReference()
+				  destSrs.ImportFromEPSG(4326)
+				  if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+				    srcSrs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+				    destSrs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+				  GDX_WorkerTransforms[srcWkt] = osr.CoordinateTransformation(srcSrs, destSrs)
+				return GDX_WorkerTransforms[srcWkt]
+
+
+def GDX_EncodeChunk(args):
+
+				spec, items = args
+				srcWkt, tolerance, job = spec
+
+				geometries = [GDX_WkbParts(wkb, tolerance, job.get('clip')) for fid, wkb, attrs in items]
+				GDX_ReprojectBatch(GDX_WorkerTransform(srcWkt), [parts for parts, hasZ in geometries])
+
+				results = []
+				for iii in range(len(items)):
+				  fid, wkb, attrs = items[iii]
+				  parts, hasZ = geometries[iii]
+				  if parts:
+				    results.append((fid, GDX_KmlPlacemark(job, fid, attrs, parts, hasZ), parts, hasZ))
+				  else:
+				    results.append((fid, '', parts, hasZ))
+				return results
+
+
+# GDX_KmzStream --------------------------------------
+#
+#  KMZ archives written front to back, so a document never exists whole
+#  in memory or on disk: every entry is deflated while it is written and
+#  its CRC and sizes follow the data in a data descriptor (zip flag 3),
+#  which is also what lets the same archive go out over HTTP.  No ZIP64:
+#  entries and archive must stay under 4 GB.
+
+GDX_KMZ_FLAGS = 0x0808     # data descriptor, utf-8 names
+
+# Zip writer on out (anything with a write method).  Entries are
+# written with begin, write... and end, or at once with writestr and
+# writefile; close writes the central directory.  level is the zlib
+# compression level of the entries that do not give their own.
+class GDX_KmzStream(object):
+
+				def __init__(self, out, level=6):
+				  self.out = out
+				  self.level = level
+				  self.offset = 0
+				  self.entries = []
+				  self.current = None
+
+				def _emit(self, data):
+				  if data:
+				    self.out.write(data)
+				    self.offset = self.offset + len(data)
+
+				def begin(self, name, level=None):
+				  if isinstance(name, unicode):
+				    name = name.encode('utf-8')
+				  if level is None:
+				    level = self.level
+
+				  now = time.localtime()
+				  entry = {}
+				  entry['name'] = name
+				  entry['offset'] = self.offset
+				  entry['time'] = (now[3] << 11) | (now[4] << 5) | (now[5] // 2)
+				  entry['date'] = ((now[0] - 1980) << 9) | (now[1] << 5) | now[2]
+				  entry['crc'] = 0
+				  entry['size'] = 0
+				  entry['csize'] = 0
+				  entry['deflate'] = zlib.compressobj(level, zlib.DEFLATED, -15)
+				  self.current = entry
+
+				  self._emit(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, GDX_KMZ_FLAGS, 8, entry['time'], entry['date'],
+				             0, 0, 0, len(name), 0) + name)
+
+				def write(self, data):
+				  if isinstance(data, unicode):
+				    data = data.encode('utf-8')
+				  entry = self.current
+				  entry['crc'] = zlib.crc32(data, entry['crc'])
+				  entry['size'] = entry['size'] + len(data)
+				  packed = entry['deflate'].compress(data)
+				  entry['csize'] = entry['csize'] + len(packed)
+				  self._emit(packed)
+
+				def end(self):
+				  entry = self.current
+				  packed = entry['deflate'].flush()
+				  entry['csize'] = entry['csize'] + len(packed)
+				  self._emit(packed)
+				  if entry['size'] > 0xFFFFFFFF or self.offset > 0xFFFFFFFF:
+				    raise ValueError("KMZ entry %s is larger than 4 GB" % (entry['name']))
+
+				  entry['crc'] = entry['crc'] & 0xFFFFFFFF
+				  del entry['deflate']
+				  self._emit(struct.pack('<IIII', 0x08074b50, entry['crc'], entry['csize'], entry['size']))
+				  self.entries.append(entry)
+				  self.current = None
+
+				def writestr(self, name, data, level=None):
+				  self.begin(name, level)
+				  self.write(data)
+				  self.end()
+
+				def writefile(self, name, path, level=None):
+				  self.begin(name, level)
+				  source = open(path, 'rb')
+				  try:
+				    while True:
+				      data = source.read(1048576)
+				      if not data:
+				        break
+				      self.write(data)
+				  finally:
+				    source.close()
+				  self.end()
+
+				def close(self):
+				  start = self.offset
+				  for entry in self.entries:
+				    self._emit(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, GDX_KMZ_FLAGS, 8, entry['time'], entry['date'],
+				               entry['crc'], entry['csize'], entry['size'], len(entry['name']), 0, 0, 0, 0, 0,
+				               entry['offset']) + entry['name'])
+				  count = len(self.entries)
+				  self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, self.offset - start, start, 0))
+
+
+# What a GDX_KmzStream has written, until a generator takes it.
+class GDX_KmzBuffer(list):
+
+				def write(self, data):
+				  self.append(data)
+
+				def take(self):
+				  data = ''.join(self)
+				  del self[:]
+				  return data
+
+
+# The pieces of a KML generator as the bytes of a KMZ holding it as name.
+# The Placemarks of the KML, that cannot be told from the deflated
+# bytes, are added to counts['placemarks'] when counts is given.
+def GDX_KmzPieces(pieces, level=6, name='doc.kml', counts=None):
+
+				buffer = GDX_KmzBuffer()
+				kmz = GDX_KmzStream(buffer, level)
+				kmz.begin(name)
+				try:
+				  for piece in pieces:
+				    if not isinstance(piece, basestring):
+				      # not data (a Deferred the producer waits for): passed on
+				      yield piece
+				      continue
+				    if counts is not None:
+				      counts['placemarks'] = counts.get('placemarks', 0) + piece.count('<Placemark>')
+				    kmz.write(piece)
+				    if buffer:
+				      yield buffer.take()
+				finally:
+				  if hasattr(pieces, 'close'):
+				    pieces.close()
+
+				kmz.end()
+				kmz.close()
+				yield buffer.take()
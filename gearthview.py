@@ -42,7 +42,8 @@ from qgis.gui import *
 import qgis
 
 import sys, itertools, os, glob, subprocess, zipfile, zlib, tempfile
-import platform
+import threading, sqlite3, hashlib, marshal, collections, Queue
+import platform, urllib, multiprocessing, re
 
 from math import *
 import datetime
@@ -81,11 +82,27 @@ except:
 
 ## INSTALL qt4reactor before importing the twisted stuff
 from twisted.internet import reactor
+from twisted.internet import interfaces
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python import failure
+from twisted.python import log as twistedLog
+from twisted.python import threadable
 from twisted.web import server 
+from twisted.web import http
 from twisted.web.static import File   
+from twisted.web.resource import Resource
+from zope.interface import implements
 
 from osgeo import gdal, ogr, osr
 
+import numpy
+from xml.sax.saxutils import escape
+
+from gdx_kml import GDX_REPROJECT_BATCH, GDX_WkbParts, GDX_WkbTypeName, GDX_ReprojectBatch, GDX_FormatCoords, GDX_KmlCoords
+from gdx_kml import GDX_KmlGeometry, GDX_KmlPlacemark, GDX_KmlSchema, GDX_EncodeChunk
+from gdx_kml import GDX_KmzStream, GDX_KmzPieces
+
 ###
 
 #----------------------------------------------------------------------------
@@ -157,22 +174,21 @@ def P3dPoints_Write(self, adesso):
 
 				      Name = feat.attributes()[idx]              
 
-#				      print Name
-				      
-				      testoWKT = geom.exportToWkt() + "\n"
+				      wkb = geom.asWkb() if geom is not None else None
+				      parts, hasZ = GDX_WkbParts(wkb)
+				      if not parts:
+				        continue
 
-#				      print testoWKT
-
-				      istr = testoWKT.split(' ')
-				      Z = str(istr[3])
-				      Z = Z.replace(',','')
-				      istruz = str(num) + "," + Name + "," + str(istr[0])
+				      tipo = GDX_WkbTypeName(wkb)
+				      first = parts[0][1][0]
+				      Z = first[0][2]
+				      istruz = str(num) + "," + Name + "," + tipo
 
 #				      print istruz
 
 
 
-				      if (str(istr[0]) == "PolygonZ" and adesso == "GEKml_Polygons"):
+				      if (tipo == "PolygonZ" and adesso == "GEKml_Polygons"):
 
 #				         print "---scrivo un elemento poligono"
                  
@@ -202,29 +218,16 @@ def P3dPoints_Write(self, adesso):
 
 
                                           
-				      testoWKT = testoWKT.replace("PointZ (", "")
-				      testoWKT = testoWKT.replace("LineStringZ (", "")
-				      testoWKT = testoWKT.replace("PolygonZ ((", "")              
-
-				      testoWKT = testoWKT.replace("Polygon ((", "")
-
-				      testoWKT = testoWKT.replace(", ", ",istruzione\n")              
-              
-				      testoWKT = testoWKT.replace("))", ",istruzione")
-				      testoWKT = testoWKT.replace(")", ",istruzione")
-				      testoWKT = testoWKT.replace(" ", ",")
-              
-				      testoWKT = testoWKT.replace("istruzione", istruz)
-
-				      kml.write (testoWKT)
+				      # one "X,Y[,Z],ID,Name,Istr" row per vertex
+				      for kind, rings in parts:
+				        for ring in rings:
+				          kml.write (GDX_FormatCoords(ring, hasZ, None, None, None, ',' + istruz, '\n'))
 
-				      if (str(istr[0]) == "PointZ" and adesso == "GEKml_Polygons"):
-				         splitta = testoWKT.split(',')              
-				         baseZ = splitta[2]
+				      if (tipo == "PointZ" and adesso == "GEKml_Polygons"):
+				         baseZ = first[0][2]
 
-				      if (str(istr[0]) == "LineStringZ" and adesso == "GEKml_Polygons"):
-				         splitta = testoWKT.split(',')              
-				         height = splitta[7]
+				      if (tipo == "LineStringZ" and adesso == "GEKml_Polygons" and len(first) > 1):
+				         height = first[1][2]
 				        				        
 				kml.close()
 
@@ -265,6 +268,156 @@ if error == QgsVectorFileWriter.NoError:
 
 
 
+# ----------------------------------------------------
+# Push producer that writes the pieces yielded by a KML generator
+# (see GDX_Publisher2) to a twisted.web request.
+#
+# Pieces are gathered up to bufferSize bytes before each write, and the
+# generator is advanced a few buffers per reactor turn, so QGIS keeps
+# repainting while big layers are streamed out.
+#
+# The generator may yield a Deferred, e.g. for a render in progress:
+# nothing more is asked of it until the Deferred fires.
+#
+# Bytes, Placemarks and time of every response, with the camera range
+# and the precision the generator picked for view (GDX_ViewParams), are
+# kept in GDX_PayloadLog. Pieces that are not KML (see GDX_KmzPieces)
+# are not counted: the generator adds its Placemarks to counts instead.
+class GDX_KmlProducer(object):
+
+				implements(interfaces.IPushProducer)
+
+				bufferSize = 65536
+				buffersPerTurn = 4
+
+				def __init__(self, request, chunks, view=None, counts=None):
+				  self.request = request
+				  self.chunks = chunks
+				  self.view = view
+				  self.counts = counts
+				  self.paused = False
+				  self.waiting = False
+				  self.call = None
+				  self.stats = {'uri': request.uri, 'bytes': 0, 'placemarks': 0}
+				  self.started = time.time()
+
+				def start(self):
+				  self.request.registerProducer(self, True)
+				  self.request.notifyFinish().addErrback(self._lostClient)
+				  self._schedule()
+
+				def _schedule(self):
+				  if self.call is None and not self.paused and not self.waiting and self.request is not None:
+				    self.call = reactor.callLater(0, self._produce)
+
+				def _produce(self):
+				  self.call = None
+				  for turn in range(self.buffersPerTurn):
+				    if self.paused or self.request is None:
+				      return
+				    pieces = []
+				    size = 0
+				    done = False
+				    failed = None
+				    waitFor = None
+				    try:
+				      while size < self.bufferSize:
+				        piece = self.chunks.next()
+				        if isinstance(piece, defer.Deferred):
+				          waitFor = piece
+				          break
+				        if isinstance(piece, unicode):
+				          piece = piece.encode('utf-8')
+				        pieces.append(piece)
+				        size = size + len(piece)
+				    except StopIteration:
+				      done = True
+				    except Exception:
+				      failed = failure.Failure()
+				    if failed is not None:
+				      self._fail(failed)
+				      return
+				    if pieces:
+				      data = ''.join(pieces)
+				      self.stats['bytes'] = self.stats['bytes'] + len(data)
+				      if self.counts is None:
+				        self.stats['placemarks'] = self.stats['placemarks'] + data.count('<Placemark>')
+				      self.request.write(data)
+				    if done:
+				      self._finish()
+				      return
+				    if waitFor is not None:
+				      self.waiting = True
+				      waitFor.addBoth(self._wake)
+				      return
+				  self._schedule()
+
+				def _wake(self, result):
+				  self.waiting = False
+				  self._schedule()
+
+				def _finish(self):
+				  request = self.request
+				  self.stopProducing()
+				  request.unregisterProducer()
+				  request.finish()
+				  if self.counts is not None:
+				    self.stats['placemarks'] = self.counts.get('placemarks', 0)
+				  if self.view:
+				    # read now: the generator sets the precision as it starts
+				    self.stats['range'] = self.view['range']
+				    if 'precision' in self.view:
+				      self.stats['precision'] = self.view['precision']
+				  GDX_PayloadReport(self.stats, time.time() - self.started)
+
+				# A broken generator is never passed off as a complete document: a 500
+				# when nothing was sent yet, else the connection is dropped unfinished.
+				def _fail(self, reason):
+				  twistedLog.err(reason, "GDX_KmlProducer: %s" % (self.stats['uri']))
+				  request = self.request
+				  self.stopProducing()
+				  request.unregisterProducer()
+				  if self.stats['bytes'] == 0:
+				    request.setResponseCode(500)
+				    request.finish()
+				  else:
+				    request.transport.loseConnection()
+
+				def _lostClient(self, reason):
+				  self.stopProducing()
+
+				def pauseProducing(self):
+				  self.paused = True
+
+				def resumeProducing(self):
+				  self.paused = False
+				  self._schedule()
+
+				def stopProducing(self):
+				  if self.call is not None:
+				    self.call.cancel()
+				    self.call = None
+				  if self.request is not None:
+				    self.request = None
+				    self.chunks.close()
+
+
+# GDX_PayloadLog --------------------------------------
+#
+#  The last responses streamed by GDX_KmlProducer, newest last: how many
+#  bytes and Placemarks were sent and with which coordinate precision.
+
+GDX_PayloadLog = collections.deque(maxlen=100)
+
+def GDX_PayloadReport(stats, seconds):
+
+				stats['seconds'] = seconds
+				GDX_PayloadLog.append(stats)
+
+				perPlacemark = stats['bytes'] / max(stats['placemarks'], 1)
+				GDX_Debug(("GDX_KmlProducer: %d bytes, %d Placemarks (%d bytes each), precision %s, %.2f s") %(stats['bytes'], stats['placemarks'], perPlacemark, stats.get('precision', '-'), seconds))
+
+
 # ----------------------------------------------------
 def startGeoDrink_Server(self):
  
@@ -346,9 +499,11 @@ def startGeoDrink_Server(self):
 
 					      if(pony == '3'):
                 					         
-					         kml = GDX_Publisher2(self, kml)
-#					         print kml
-					         return str(kml)
+					         request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+					         view = GDX_ViewParams(request)
+					         producer = GDX_KmlProducer(request, GDX_Publisher2(self, kml, view), view)
+					         producer.start()
+					         return server.NOT_DONE_YET
 
 					      param2 = params[2].replace('LookatTerrain=','')
 					      LookatTerrain = param2.split(',')
@@ -448,9 +603,7 @@ def startGeoDrink_Server(self):
 					      mapRenderer = canvas.mapRenderer()
 					      srs = mapRenderer.destinationCrs()
 				
-					      crsSrc = QgsCoordinateReferenceSystem(4326)
-					      crsDest = QgsCoordinateReferenceSystem(srs) 
-					      xform = QgsCoordinateTransform(crsSrc, crsDest)
+					      xform = GDX_QgsTransform(4326, srs)
 					      
    
 					      GEraggio = (lookatRange - Zeta) / 2.
@@ -554,9 +707,7 @@ def startGeoDrink_Server(self):
 					      mapRenderer = canvas.mapRenderer()
 					      srs = mapRenderer.destinationCrs()
 				
-					      crsSrc = QgsCoordinateReferenceSystem(4326)
-					      crsDest = QgsCoordinateReferenceSystem(srs) 
-					      xform = QgsCoordinateTransform(crsSrc, crsDest)
+					      xform = GDX_QgsTransform(4326, srs)
 					         
 					      GEraggio = (lookatRange - Zeta) / 2.
                 
@@ -599,6 +750,12 @@ def startGeoDrink_Server(self):
 					root = Resource()
 					root.putChild("form", FormPage(self.iface, self.plugin_dir))
 					root.putChild("gaeta", File(webServerDir))
+					root.putChild("tile", GDX_TilePage())
+					root.putChild("kmz", GDX_KmzPage(self.iface))
+					root.putChild("feature", GDX_FeaturePage())
+					root.putChild("layers", GDX_LayersPage(self.iface))
+					root.putChild("layer", GDX_LayerPage(self.iface))
+					root.putChild("overlay", GDX_OverlayPage(self.iface))
 
 					cesiumDir = webServerDir + "cesium/"          
 					root.putChild("cesium", File(cesiumDir))
@@ -640,9 +797,7 @@ def QGEarth_addPoint(self):
 				       return
                
 				    srs = layer.crs();
-				    crsSrc = QgsCoordinateReferenceSystem(4326)
-				    crsDest = QgsCoordinateReferenceSystem(srs) 
-				    xform = QgsCoordinateTransform(crsSrc, crsDest)
+				    xform = GDX_QgsTransform(4326, srs)
 				    pt = xform.transform(QgsPoint(lon, lat))
 				
 				    gPnt = QgsGeometry.fromPoint(QgsPoint(pt.x(),pt.y()))
@@ -698,767 +853,3281 @@ def QGEarth_addPoint(self):
 				    memLay.commitChanges()
 				    QgsMapLayerRegistry.instance().addMapLayer(memLay) 
 
-# GDX_Publisher --------------------------------------
+# GDX_Setting --------------------------------------
+#
+#  Plugin options, stored in QSettings under "gearthview/".
 
-def GDX_Publisher(self):
+def GDX_Setting(key, default):
 
-#				print "GDX_Publisher -------------------------------\n"
-        
-				mapCanvas = self.iface.mapCanvas()
-				
-				tumpdir = unicode(QFileInfo(QgsApplication.qgisUserDbFilePath()).path()) + "/python/plugins/gearthview/_WebServer"
+				value = QSettings().value("gearthview/" + key, default)
 
-				adesso = str(datetime.datetime.now())
-				adesso = adesso.replace(" ","_")
-				adesso = adesso.replace(":","_")
-				adesso = adesso.replace(".","_")        				
+				if isinstance(default, bool):
+				  return value in (True, 'true', 'True', '1', 1)
+				try:
+				  return type(default)(value)
+				except (TypeError, ValueError):
+				  return default
 
-#				print "adesso: <%s>\n" %(adesso)
 
-# Prendo le coordinate della finestra attuale---------------------------------------
-# 13.5702225179249876,41.2134192420407501 : 13.5768356834183166,41.2182110366311107
-				text = mapCanvas.extent().toString()
-				text1 = text.replace("," , " ")
-				text2 = text1.replace(" : ", ",")
-#				the_filter = "bbox($geometry, geomFromWKT ( 'LINESTRING(" + text2 + ")'))"
-#				self.doPaste(the_filter) 				
+# Timings and cache counters for the "GEarthView" tab of the QGIS log
+# panel, only with the "debug" setting on.  Any thread.
+def GDX_Debug(text):
 
-# HERE IT DELETES THE OLD IMAGE ------------------------------------
-# (if you comment these, images still remain ...  :)
-				for filename in glob.glob(str(tumpdir + '/*.png')) :
-				   os.remove( str(filename) )
-				for filename in glob.glob(str(tumpdir + '/*.pngw')) :
-				   os.remove( str(filename) )            
-# ------------------------------------------------------------------				
+				if GDX_Setting('debug', False):
+				  QgsMessageLog.logMessage(text, 'GEarthView', QgsMessageLog.INFO)
 
-    
-				tname = 'ZIPPA'
 
-				out_folder = tumpdir
-				
-				kml = codecs.open(out_folder + '/doc.kml', 'w', encoding='utf-8')
-#				kml=open(out_folder + '/doc.kml', 'w')
-				#
+# GDX_CrsPool --------------------------------------
+#
+#  Process-wide pool of CRS and coordinate transform objects, shared by the
+#  publishers, FormPage and QGEarth_addPoint.  Building a CRS hits the SRS
+#  database, so each (source, destination) pair is built only once, until
+#  the project CRS or a layer CRS changes (see gearthview.initGui).
 
-				iface = qgis.utils.iface
+GDX_CrsPool = {}
+GDX_CrsPoolCounters = {'hits': 0, 'misses': 0}
+GDX_CrsPoolLock = threading.Lock()
 
-				if QGis.QGIS_VERSION_INT <= 120200: 
 
-				   mapRenderer = mapCanvas.mapRenderer()
-				   mapRect = mapRenderer.extent()
-				   width = mapRenderer.width()
-				   height = mapRenderer.height()
-				   srs = mapRenderer.destinationCrs()
+# crs can be an EPSG code, an authid / WKT string or a QgsCoordinateReferenceSystem
+def GDX_CrsKey(crs):
 
-#  OLD version ----------------------------------------------------------
-				   # create output image and initialize it
-				   image = QImage(QSize(width, height), QImage.Format_ARGB32)
-				   image.fill(0)
-				   #adjust map canvas (renderer) to the image size and render
-				   imagePainter = QPainter(image)
-				   zoom = 1
-				   target_dpi = int(round(zoom * mapRenderer.outputDpi()))				
-				   mapRenderer.setOutputSize(QSize(width, height), target_dpi)			
-				   mapRenderer.render(imagePainter)
-				   imagePainter.end()
-#  OLD version ----------------------------------------------------------
+				if isinstance(crs, (int, long)):
+				  return ('EPSG:%d') % (crs)
 
-#  NEW version (not working) --------------------------------------------
-#				   image = QImage(QPixmap.grabWidget(self.iface.mapCanvas()))
-#  NEW version (not working) --------------------------------------------
+				if isinstance(crs, basestring):
+				  return crs
 
-				   xN = mapRect.xMinimum()
-				   yN = mapRect.yMinimum()
+				authid = crs.authid()
+				if authid:
+				  return authid
+				return crs.toWkt()
 
-				   nomePNG = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
-				
-				   input_file = out_folder + "/" + nomePNG + ".png"
-				
-				   #Save the image
-				   image.save(input_file, "png")
 
-				else:   # ovvero  QGis.QGIS_VERSION_INT > 120200
+def GDX_CrsPoolGet(key, build):
 
+				with GDX_CrsPoolLock:
+				  if key in GDX_CrsPool:
+				    GDX_CrsPoolCounters['hits'] = GDX_CrsPoolCounters['hits'] + 1
+				    return GDX_CrsPool[key]
+				  GDX_CrsPoolCounters['misses'] = GDX_CrsPoolCounters['misses'] + 1
 
-           
-				   mapRenderer = mapCanvas.mapRenderer()
-				   mapRect = mapRenderer.extent()
-				   width = mapRenderer.width()
-				   height = mapRenderer.height()
-				   srs = mapRenderer.destinationCrs()
-
-				   xN = mapRect.xMinimum()
-				   yN = mapRect.yMinimum()
-
-				   mapSettings = QgsMapSettings()
-				   mapSettings.setMapUnits(0)
-				   mapSettings.setExtent(mapRect)
-				   DPI = 300
-				   mapSettings.setOutputDpi(DPI)
-
-				   mapSettings.setOutputSize(QSize(width, height))
-
-				   lst = []
-				   layerTreeRoot = QgsProject.instance().layerTreeRoot()
-				   for id in layerTreeRoot.findLayerIds():
-				       node = layerTreeRoot.findLayer(id)
-				       lst.append(id)
-           
-				   mapSettings.setLayers(lst)
-           
-				   mapSettings.setFlags(QgsMapSettings.Antialiasing | QgsMapSettings.UseAdvancedEffects | QgsMapSettings.ForceVectorOutput | QgsMapSettings.DrawLabeling)
-				   image = QImage(QSize(width, height), QImage.Format_RGB32)
+				value = build()
 
-				   image.fill(0)
+				with GDX_CrsPoolLock:
+				  GDX_CrsPool[key] = value
+				return value
 
-				   image.setDotsPerMeterX(DPI / 25.4 * 1000)
-				   image.setDotsPerMeterY(DPI / 25.4 * 1000)
-				   p = QPainter()
-				   p.begin(image)
-				   mapRenderer = QgsMapRendererCustomPainterJob(mapSettings, p)
-				   mapRenderer.start()
-				   mapRenderer.waitForFinished()
-				   p.end()
-
-				   nomePNG = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
-				   input_file = out_folder + "/" + nomePNG + ".png"
-				
-				   #Save the image
-				   image.save(input_file, "png")
 
+def GDX_Crs(crs):
 
-				# EndIf     # QGis.QGIS_VERSION_INT > 120200
+				if isinstance(crs, QgsCoordinateReferenceSystem):
+				  return crs
 
-				layer = mapCanvas.currentLayer()
-				crsSrc = srs  # QgsCoordinateReferenceSystem(layer.crs())   # prendere quello attuale
-				crsDest = QgsCoordinateReferenceSystem(4326)  # Wgs84LLH
-				xform = QgsCoordinateTransform(crsSrc, crsDest)
+				return GDX_CrsPoolGet(('crs', GDX_CrsKey(crs)), lambda: QgsCoordinateReferenceSystem(crs))
 
-				x1 = mapRect.xMinimum()
-				y1 = mapRect.yMinimum()
-				
-				x2 = mapRect.xMaximum()
-				y2 = mapRect.yMinimum()
 
-				x3 = mapRect.xMaximum()
-				y3 = mapRect.yMaximum()
+def GDX_QgsTransform(crsSrc, crsDest):
 
-				x4 = mapRect.xMinimum()
-				y4 = mapRect.yMaximum()
+				key = ('qgs', GDX_CrsKey(crsSrc), GDX_CrsKey(crsDest))
+				return GDX_CrsPoolGet(key, lambda: QgsCoordinateTransform(GDX_Crs(crsSrc), GDX_Crs(crsDest)))
 
-				xc = (x1 + x3) / 2.
-				yc = (y1 + y3) / 2.	
 
-				pt1 = xform.transform(QgsPoint(x1, y1))				
-				pt2 = xform.transform(QgsPoint(x2, y2))
-				pt3 = xform.transform(QgsPoint(x3, y3))
-				pt4 = xform.transform(QgsPoint(x4, y4))                				
+def GDX_OsrSrs(crs):
 
-				pt5 = xform.transform(QgsPoint(xc, yc))
+				def build():
+				  srs = osr.SpatialReference()
+				  if isinstance(crs, (int, long)):
+				    srs.ImportFromEPSG(crs)
+				  else:
+				    srs.ImportFromWkt(GDX_Crs(crs).toWkt())
+				  if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+				    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+				  return srs
 
-				xc = pt5.x()
-				yc = pt5.y()
+				return GDX_CrsPoolGet(('osr', GDX_CrsKey(crs)), build)
 
-				x1 = pt1.x()
-				y1 = pt1.y()
-				
-				x2 = pt2.x()
-				y2 = pt2.y()
-				
-				x3 = pt3.x()
-				y3 = pt3.y()
-				
-				x4 = pt4.x()
-				y4 = pt4.y()
-				
 
-				
-				#Write kml header
-				kml.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-				kml.write('<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">\n')				
-				kml.write('    <Document>\n')
-				kml.write('    	 <name>QGisView</name>\n')
-				kml.write('    	 <Snippet maxLines="0"></Snippet>\n') 
-#				loc = ("    	 <description><![CDATA[http://map.project-osrm.org/?loc=%.7lf,%.7lf&ly=1784084387]]></description>\n") %(yc, xc)
-#				loc = ("    	 <description><![CDATA[http://map.project-osrm.org/?z=16&center=%.7lf,%.7lf&loc=&loc=&hl=en&ly=&alt=&df=&srv=]]></description>\n") %(yc, xc)
-				loc = ("    	 <description><![CDATA[https://map.what3words.com/%.7lf,%.7lf]]></description>\n") %(yc, xc)
+def GDX_OsrTransform(crsSrc, crsDest):
 
-				kml.write(loc)
-#
-				
-				
-#				kml.write('    	 <description>http://map.project-osrm.org/?hl=it&loc=45.989486,12.778154&loc=45.985624,12.781076&z=16&center=45.984058,12.774417&alt=0&df=0&re=0&ly=-940622518</description>\n')
-				
-				kml.write('	     <open>1</open>\n')
+				key = ('osrTransform', GDX_CrsKey(crsSrc), GDX_CrsKey(crsDest))
+				return GDX_CrsPoolGet(key, lambda: osr.CoordinateTransformation(GDX_OsrSrs(crsSrc), GDX_OsrSrs(crsDest)))
 
-				kml.write('	<Style id="sh_style">\n')
-				kml.write('		<PolyStyle>\n')
-				kml.write('			<color>7fff8080</color>\n')
-				kml.write('		</PolyStyle>\n')
-				kml.write('	</Style>\n')
-				kml.write('	<StyleMap id="msn_style">\n')
-				kml.write('		<Pair>\n')
-				kml.write('			<key>normal</key>\n')
-				kml.write('			<styleUrl>#sn_style</styleUrl>\n')
-				kml.write('		</Pair>\n')
-				kml.write('		<Pair>\n')
-				kml.write('			<key>highlight</key>\n')
-				kml.write('			<styleUrl>#sh_style</styleUrl>\n')
-				kml.write('		</Pair>\n')
-				kml.write('	</StyleMap>\n')
-				kml.write('	<Style id="sn_style">\n')
-				kml.write('		<PolyStyle>\n')
-				kml.write('			<color>00ff8080</color>\n')
-				kml.write('			<fill>0</fill>\n')
-				kml.write('		</PolyStyle>\n')
-				kml.write('	</Style>\n')
-				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 1\n')   
 
-				kml.write('	     <Style id="sh_ylw-pushpin">\n')
-				kml.write('	     	<IconStyle>\n')
-				kml.write('	     		<scale>1.2</scale>\n')
-				kml.write('	     	</IconStyle>\n')
-				kml.write('	     	<PolyStyle>\n')
-				kml.write('	     		<fill>0</fill>\n')
-				kml.write('	     	</PolyStyle>\n')
-				kml.write('	     </Style>\n')
-				kml.write('	     <Style id="sn_ylw-pushpin">\n')
-				kml.write('	     	<PolyStyle>\n')
-				kml.write('	     		<fill>0</fill>\n')
-				kml.write('	     	</PolyStyle>\n')
-				kml.write('	     </Style>\n')
-				kml.write('	     <StyleMap id="msn_ylw-pushpin">\n')
-				kml.write('	     	<Pair>\n')
-				kml.write('	     		<key>normal</key>\n')
-				kml.write('	     		<styleUrl>#sn_ylw-pushpin</styleUrl>\n')
-				kml.write('	     	</Pair>\n')
-				kml.write('	     	<Pair>\n')
-				kml.write('	     		<key>highlight</key>\n')
-				kml.write('	     		<styleUrl>#sh_ylw-pushpin</styleUrl>\n')
-				kml.write('	     	</Pair>\n')
-				kml.write('	     </StyleMap>\n')				
-				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 2\n')
+def GDX_CrsPoolClear(*args):
 
-				kml.write('    <StyleMap id="msn_style">\n')
-				kml.write('        <Pair>\n')
-				kml.write('            <key>normal</key>\n')
-				kml.write('            <styleUrl>#sn_style</styleUrl>\n')
-				kml.write('        </Pair>\n')
-				kml.write('        <Pair>\n')
-				kml.write('            <key>highlight</key>\n')
-				kml.write('            <styleUrl>#sh_style</styleUrl>\n')
-				kml.write('        </Pair>\n')
-				kml.write('    </StyleMap>\n')
-				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 3\n')
-				
-				kml.write('	     	<Style id="hl">\n')
-				kml.write('	     		<IconStyle>\n')
-				kml.write('	     			<scale>0.7</scale>\n')
-				kml.write('	     			<Icon>\n')
-				kml.write('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle_highlight.png</href>\n')
-				kml.write('	     			</Icon>\n')
-				kml.write('	     		</IconStyle>\n')
-				kml.write('	     		<LabelStyle>\n')
-				kml.write('	     			<scale>0.7</scale>\n')
-				kml.write('	     		</LabelStyle>\n')							
-				kml.write('	     		<ListStyle>\n')
-				kml.write('	     		</ListStyle>\n')
-				kml.write('	     	</Style>\n')
-				kml.write('	     	<Style id="default">\n')
-				kml.write('	     		<IconStyle>\n')
-				kml.write('	     			<scale>0.7</scale>\n')
-				kml.write('	     			<Icon>\n')
-				kml.write('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href>\n')
-				kml.write('	     			</Icon>\n')
-				kml.write('	     		</IconStyle>\n')
-				kml.write('	     		<LabelStyle>\n')
-				kml.write('	     			<scale>0.7</scale>\n')
-				kml.write('	     		</LabelStyle>\n')			
-				kml.write('	     		<ListStyle>\n')
-				kml.write('	     		</ListStyle>\n')
-				kml.write('	     	</Style>\n')
-				kml.write('	     	<StyleMap id="default0">\n')
-				kml.write('	     		<Pair>\n')
-				kml.write('	     			<key>normal</key>\n')
-				kml.write('	     			<styleUrl>#default</styleUrl>\n')
-				kml.write('	     		</Pair>\n')
-				kml.write('	     		<Pair>\n')
-				kml.write('	     			<key>highlight</key>\n')
-				kml.write('	     			<styleUrl>#hl</styleUrl>\n')
-				kml.write('	     		</Pair>\n')
-				kml.write('	     	</StyleMap>\n')
-				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 4\n')				
-				
-				rotazio = 0.0
-				if QGis.QGIS_VERSION_INT >= 20801:                
-				   rotazio = -(mapCanvas.rotation())
-				
-				
-				kml.write('      <Folder>\n')
-				
-				xc = (x1 + x3) / 2.
-				yc = (y1 + y3) / 2.
-				dx = (x3 - x1) * 75000. #100000.
+				with GDX_CrsPoolLock:
+				  GDX_CrsPool.clear()
 
 
-				kml.write('    		<open>1</open>\n')    
-				kml.write('    		<NetworkLink>\n')
-				kml.write('    		   <name>QGIS_link</name>\n')
-				kml.write('    		   <visibility>1</visibility>\n')
-				kml.write('    		   <open>1</open>\n')
-				kml.write('    		   <Link>\n')
-#				kml.write('    		      <href>../_WebServer/QGIS_link.kmz</href>\n')
-				kml.write('    		      <href>QGIS_link.kmz</href>\n')        
-				kml.write('    		   </Link>\n')
-				kml.write('    		</NetworkLink>\n')        
+def GDX_CrsPoolStats():
 
-        				
-				kml.write('    		<LookAt>\n')
-				stringazza = ("    		   <longitude>%lf</longitude>\n") %(xc)
-				kml.write(stringazza)				
-				stringazza = ("    		   <latitude>%lf</latitude>\n") %(yc)
-				kml.write(stringazza)				
-				kml.write('    		   <altitude>0</altitude>\n')
+				with GDX_CrsPoolLock:
+				  stats = dict(GDX_CrsPoolCounters)
+				  stats['size'] = len(GDX_CrsPool)
 
-				stringazza = ("    		   <heading>%lf</heading>\n") %(rotazio)
-				kml.write(stringazza)
-        
-				kml.write('    		   <tilt>0</tilt>\n')
-				stringazza = ("    		   <range>%lf</range>\n") %(dx)
-				kml.write(stringazza)				
-				kml.write('    		   <gx:altitudeMode>relativeToGround</gx:altitudeMode>\n')
-				kml.write('    		</LookAt>\n')
+				total = stats['hits'] + stats['misses']
+				stats['hitRate'] = float(stats['hits']) / total if total else 0.
+				return stats
 
-				kml.write('      <GroundOverlay>\n')
-				kml.write('    	 <name>QGisView</name>\n')
-        				
-				kml.write('    	<Icon>\n')
 
-#				nomePNG = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
-				stringazza = ("    	<href>%s.png</href>\n") % (nomePNG)
-				kml.write(stringazza)
-				kml.write('    		<viewBoundScale>1.0</viewBoundScale>\n')
-				kml.write('    	</Icon>\n')
-				kml.write('    	<gx:LatLonQuad>\n')
-				kml.write('    		<coordinates>\n')
+# GDX_Kml geometry helpers --------------------------------------
+#
+#  Vertices of a whole batch of features are pulled into numpy arrays and
+#  reprojected to Wgs84 with one osr TransformPoints call, instead of one
+#  xform.transform(QgsPoint()) per vertex.  The encoding itself is in
+#  gdx_kml.py, shared with the parallel export workers.
 
-				stringazza =    ("%.7lf,%.7lf,0 %.7lf,%.7lf,0 %.7lf,%.7lf,0 %.7lf,%.7lf,0\n") % (x1, y1, x2, y2, x3, y3, x4, y4)        		
-				kml.write(stringazza)				
 
-				kml.write('    		</coordinates>\n')
-				kml.write('    	</gx:LatLonQuad>\n')
-				kml.write('    </GroundOverlay>\n')
+def GDX_Wgs84Transform(layer):
 
-#				#Write kml footer
-#				kml.write('</kml>\n')
-#				#Close kml file
-#				kml.close()
+				if isinstance(layer, GDX_LayerSnapshot):
+				  return layer.transform
+				return GDX_OsrTransform(layer.crs(), 4326)
+
+
+def GDX_GeomParts(geom, tolerance=0., clip=None):
+
+				if geom is None:
+				  return [], False
+				return GDX_WkbParts(geom.asWkb(), tolerance, clip)
+
+
+# GDX_DiskCache --------------------------------------
+#
+#  Persistent SQLite cache of the encoded Placemarks and of the reprojected
+#  geometries, so that a layer published yesterday is not encoded again.
+#  Entries are keyed by layer source, file modification stamps, CRS,
+#  fields and style; the least recently used entries are evicted when the
+#  database grows past "cache/maxMegaBytes".
+
+GDX_KML_FORMAT = 1
+
+GDX_DiskCacheDb = None
+GDX_DiskCacheLock = threading.Lock()
+GDX_DiskCacheCounters = {'hits': 0, 'misses': 0}
+
+
+def GDX_DiskCacheConnect():
+
+				global GDX_DiskCacheDb
+
+				if GDX_DiskCacheDb is None:
+				  tumpdir = unicode(QFileInfo(QgsApplication.qgisUserDbFilePath()).path()) + "/python/plugins/gearthview/_WebServer"
+				  path = GDX_Setting('cache/path', tumpdir + '/_cache/gdx_export_cache.sqlite')
+				  if not os.path.exists(os.path.dirname(path)):
+				    os.makedirs(os.path.dirname(path))
+
+				  db = sqlite3.connect(path, check_same_thread=False)
+				  db.execute('PRAGMA auto_vacuum = FULL')
+				  db.executescript(
+				    'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, bytes INTEGER, lastUsed REAL);\n'
+				    'CREATE TABLE IF NOT EXISTS placemarks (key TEXT, fid INTEGER, kml TEXT, PRIMARY KEY (key, fid));\n'
+				    'CREATE TABLE IF NOT EXISTS geometries (key TEXT, fid INTEGER, data BLOB, PRIMARY KEY (key, fid));\n'
+				    'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);\n')
+				  GDX_DiskCacheDb = db
+
+				return GDX_DiskCacheDb
+
+
+# Modification stamps of the files behind the layer, or None when the
+# layer is not file based (or has unsaved edits) and cannot be persisted.
+def GDX_LayerStamp(layer):
+
+				if layer.isModified():
+				  return None
+				return GDX_SourceStamp(layer)
+
+
+# What the fragments of a layer are keyed on, with its edits count: the
+# stamps of its source, also in an edit session (the edit signals follow
+# the edit buffer).  None when a change made outside QGIS would go unseen
+# (database layers without cache/hashContent): nothing is cached then.
+# Memory layers change only through QGIS.
+def GDX_FragmentStamp(layer):
+
+				if isinstance(layer, GDX_LayerSnapshot):
+				  return layer.fragmentStamp
+				if layer.dataProvider().name() == 'memory':
+				  return 'memory'
+				return GDX_SourceStamp(layer)
+
+
+def GDX_SourceStamp(layer):
+
+				source = layer.source()
+				provider = layer.dataProvider().name()
+
+				if provider == 'memory':
+				  return None
+
+				if provider == 'spatialite':
+				  path = QgsDataSourceURI(source).database()
+				elif source.startswith('file:'):
+				  path = QUrl(source).toLocalFile()
+				else:
+				  path = source.split('|')[0]
+
+				if os.path.isfile(path):
+				  stamps = []
+				  for filename in sorted(glob.glob(os.path.splitext(path)[0] + '.*')):
+				    st = os.stat(filename)
+				    stamps.append((filename, st.st_mtime, st.st_size))
+				  return (provider, source, tuple(stamps))
+
+				if GDX_Setting('cache/hashContent', False):
+				  # read through once per session: the edit signals drop it
+				  entry = GDX_LayerCacheEntry(layer)
+				  if entry['hash'] is None:
+				    entry['hash'] = GDX_LayerContentHash(layer)
+				  return (provider, source, entry['hash'])
+
+				return None
+
+
+def GDX_LayerContentHash(layer):
+
+				digest = hashlib.sha1()
+				for feat in layer.getFeatures():
+				  geom = feat.geometry()
+				  if geom is not None:
+				    digest.update(geom.asWkb())
+				  digest.update(repr(feat.attributes()))
+				return digest.hexdigest()
+
+
+def GDX_LayerStyle(layer):
+
+				if hasattr(layer, 'rendererV2') and layer.rendererV2() is not None:
+				  return layer.rendererV2().dump()
+				return ''
+
+
+# Returns (geomKey, kmlKey), both None when the layer cannot be persisted.
+def GDX_DiskCacheKeys(layer, signature, variant=None):
+
+				if not GDX_Setting('cache/enabled', True):
+				  return None, None
+
+				if isinstance(layer, GDX_LayerSnapshot):
+				  stamp, style = layer.stamp, layer.style
+				else:
+				  stamp, style = GDX_LayerStamp(layer), GDX_LayerStyle(layer)
+
+				if stamp is None:
+				  return None, None
+
+				geomKey = hashlib.sha1(repr(('geometries', stamp, GDX_CrsKey(layer.crs()), variant))).hexdigest()
+				kmlKey = hashlib.sha1(repr(('placemarks', stamp, signature, style))).hexdigest()
+				return geomKey, kmlKey
+
+
+def GDX_DiskCacheHas(key):
+
+				with GDX_DiskCacheLock:
+				  db = GDX_DiskCacheConnect()
+				  return db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+
+
+# Loads {fid: value} from table ('placemarks' or 'geometries'), optionally
+# only for the given feature ids.
+def GDX_DiskCacheLoad(key, table, fids=None):
+
+				column = 'kml' if table == 'placemarks' else 'data'
+				query = ('SELECT fid, %s FROM %s WHERE key = ?') % (column, table)
+
+				items = {}
+				with GDX_DiskCacheLock:
+				  db = GDX_DiskCacheConnect()
+
+				  if fids is None:
+				    rows = db.execute(query, (key,)).fetchall()
+				  else:
+				    rows = []
+				    for start in range(0, len(fids), 500):
+				      chunk = fids[start:start + 500]
+				      rows.extend(db.execute(query + (' AND fid IN (%s)') % (','.join('?' * len(chunk))), [key] + chunk).fetchall())
+
+				  if rows:
+				    db.execute('UPDATE entries SET lastUsed = ? WHERE key = ?', (time.time(), key))
+				    db.commit()
+
+				for fid, value in rows:
+				  if table == 'geometries':
+				    value = GDX_GeomUnpack(value)
+				  items[fid] = value
+				return items
+
+
+def GDX_DiskCacheStore(key, table, items):
+
+				if not items:
+				  return
+
+				if table == 'placemarks':
+				  rows = [(key, fid, kml) for fid, kml in items.items()]
+				  size = sum([len(kml) for kml in items.values()])
+				else:
+				  rows = [(key, fid, sqlite3.Binary(GDX_GeomPack(parts, hasZ))) for fid, (parts, hasZ) in items.items()]
+				  size = sum([len(row[2]) for row in rows])
+
+				column = 'kml' if table == 'placemarks' else 'data'
+
+				with GDX_DiskCacheLock:
+				  db = GDX_DiskCacheConnect()
+				  db.executemany(('INSERT OR REPLACE INTO %s (key, fid, %s) VALUES (?, ?, ?)') % (table, column), rows)
+				  db.execute('INSERT OR IGNORE INTO entries (key, bytes, lastUsed) VALUES (?, 0, ?)', (key, time.time()))
+				  db.execute('UPDATE entries SET bytes = bytes + ?, lastUsed = ? WHERE key = ?', (size, time.time(), key))
+				  GDX_DiskCacheEvict(db)
+				  db.commit()
+
+
+# What GDX_KmlPlacemarks has just encoded (job['store']), with its hits.
+# Any thread.
+def GDX_DiskCacheSave(geomKey, kmlKey, store, hits):
+
+				GDX_DiskCacheStore(kmlKey, 'placemarks', store['placemarks'])
+				GDX_DiskCacheStore(geomKey, 'geometries', store['geometries'])
+				GDX_DiskCacheCount(hits, len(store['geometries']))
+
+
+def GDX_DiskCacheEvict(db):
+
+				maxBytes = GDX_Setting('cache/maxMegaBytes', 512) * 1024 * 1024
+				total = db.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+
+				evicted = 0
+				for key, size in db.execute('SELECT key, bytes FROM entries ORDER BY lastUsed').fetchall():
+				  if total <= maxBytes:
+				    break
+				  db.execute('DELETE FROM placemarks WHERE key = ?', (key,))
+				  db.execute('DELETE FROM geometries WHERE key = ?', (key,))
+				  db.execute('DELETE FROM entries WHERE key = ?', (key,))
+				  total = total - size
+				  evicted = evicted + 1
+
+				if evicted:
+				  GDX_DiskCacheAdd(db, 'evictions', evicted)
+
+
+def GDX_DiskCacheAdd(db, name, value):
+
+				db.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (name,))
+				db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+
+
+def GDX_DiskCacheCount(hits, misses):
+
+				if not (hits or misses):
+				  return
+
+				with GDX_DiskCacheLock:
+				  GDX_DiskCacheCounters['hits'] = GDX_DiskCacheCounters['hits'] + hits
+				  GDX_DiskCacheCounters['misses'] = GDX_DiskCacheCounters['misses'] + misses
+				  db = GDX_DiskCacheConnect()
+				  GDX_DiskCacheAdd(db, 'hits', hits)
+				  GDX_DiskCacheAdd(db, 'misses', misses)
+				  db.commit()
+
+
+# Session and lifetime (all QGIS sessions) reuse of the persistent cache.
+def GDX_DiskCacheStats():
+
+				with GDX_DiskCacheLock:
+				  db = GDX_DiskCacheConnect()
+				  stats = dict(db.execute('SELECT name, value FROM counters').fetchall())
+				  entries, size = db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+				  stats['sessionHits'] = GDX_DiskCacheCounters['hits']
+				  stats['sessionMisses'] = GDX_DiskCacheCounters['misses']
+
+				for name in ('hits', 'misses', 'evictions'):
+				  stats.setdefault(name, 0)
+				stats['entries'] = entries
+				stats['bytes'] = size
+
+				total = stats['hits'] + stats['misses']
+				stats['hitRate'] = float(stats['hits']) / total if total else 0.
+				total = stats['sessionHits'] + stats['sessionMisses']
+				stats['sessionHitRate'] = float(stats['sessionHits']) / total if total else 0.
+				return stats
+
+
+def GDX_GeomPack(parts, hasZ):
+
+				return marshal.dumps((hasZ, [(kind, [ring.tobytes() for ring in rings]) for kind, rings in parts]))
+
+
+def GDX_GeomUnpack(data):
+
+				hasZ, packed = marshal.loads(str(data))
+				parts = [(kind, [numpy.frombuffer(ring).reshape(-1, 3) for ring in rings]) for kind, rings in packed]
+				return parts, hasZ
+
+
+# GDX_FragmentCache --------------------------------------
+#
+#  Per-layer cache of the encoded Placemarks, keyed by feature id.  The
+#  layer edit signals drop the fragments of the touched features, so a
+#  re-publish encodes only those and reuses the others.
+
+GDX_FragmentCache = {}
+GDX_FragmentCacheLock = threading.RLock()
+
+
+def GDX_LayerCacheEntry(layer):
+
+				layerId = layer.id()
+				entry = GDX_FragmentCache.get(layerId)
+
+				if entry is None and isinstance(layer, GDX_LayerSnapshot):
+				  # the layer went away during a background publish: cache nothing
+				  return {'variants': collections.OrderedDict(), 'regions': None, 'clusters': None, 'schema': None, 'edits': 0, 'hash': None, 'slots': []}
+
+				if entry is None:
+				  entry = {'variants': collections.OrderedDict(), 'regions': None, 'clusters': None, 'schema': None, 'edits': 0, 'hash': None, 'slots': []}
+				  GDX_FragmentCache[layerId] = entry
+
+				  # kept for GDX_FragmentDisconnect
+				  entry['slots'] = [
+				    ('featureAdded', lambda fid: GDX_FragmentDirty(layerId, fid)),
+				    ('featureDeleted', lambda fid: GDX_FragmentDirty(layerId, fid)),
+				    ('geometryChanged', lambda fid, geom: GDX_FragmentDirty(layerId, fid)),
+				    ('attributeValueChanged', lambda fid, idx, value: GDX_FragmentDirty(layerId, fid)),
+				    ('updatedFields', lambda: GDX_FragmentReset(layerId))]
+				  for name, slot in entry['slots']:
+				    getattr(layer, name).connect(slot)
+
+				return entry
+
+
+# One fragments dict per signature (fields, CRS, simplification bucket...,
+# then the layer stamp and the edits count), the least recently used dropped
+# past GDX_FRAGMENT_VARIANTS.  Every variant can hold the whole layer, and
+# each view tolerance, precision and clip window is one, so only a few are
+# kept: the disk cache has the others.  An edit moves every variant to the
+# new edits count, so only the touched features are encoded again.
+GDX_FRAGMENT_VARIANTS = 4
+
+
+def GDX_LayerFragments(layer, signature):
+
+				variants = GDX_LayerCacheEntry(layer)['variants']
+
+				with GDX_FragmentCacheLock:
+				  fragments = variants.pop(signature, None)
+				  if fragments is None:
+				    fragments = {}
+				  variants[signature] = fragments
+
+				  while len(variants) > GDX_FRAGMENT_VARIANTS:
+				    variants.popitem(last=False)
+
+				return fragments
+
+
+def GDX_FragmentDirty(layerId, fid):
+
+				entry = GDX_FragmentCache.get(layerId)
+				if entry is not None:
+				  with GDX_FragmentCacheLock:
+				    edits = entry['edits'] + 1
+				    variants = entry['variants'].items()
+				    entry['variants'].clear()
+				    for signature, fragments in variants:
+				      fragments.pop(fid, None)
+				      entry['variants'][signature[:-1] + (edits,)] = fragments
+				    entry['edits'] = edits
+				  entry['regions'] = None
+				  entry['clusters'] = None
+				  entry['hash'] = None
+
+
+def GDX_FragmentReset(layerId):
+
+				entry = GDX_FragmentCache.get(layerId)
+				if entry is not None:
+				  with GDX_FragmentCacheLock:
+				    entry['variants'].clear()
+				    entry['edits'] = entry['edits'] + 1
+				    entry['schema'] = None
+				  entry['regions'] = None
+				  entry['clusters'] = None
+				  entry['hash'] = None
+
+
+def GDX_FragmentRemoveLayer(layerId):
+
+				GDX_FragmentCache.pop(layerId, None)
+
+
+# On unload: the edit signals of layer stop reaching this module.
+def GDX_FragmentDisconnect(layer):
+
+				entry = GDX_FragmentCache.pop(layer.id(), None)
+				if entry is not None:
+				  for name, slot in entry['slots']:
+				    getattr(layer, name).disconnect(slot)
+
+
+# GDX_RenderCache --------------------------------------
+#
+#  Encoded bytes of the rendered map views, keyed by a hash of what they
+#  depend on: extent, output size, DPI, CRS, encoder and, for every layer, its
+#  data stamps, style and the number of repaints QGIS asked for since it
+#  was loaded (edits, style and label changes).  An unchanged canvas on
+#  the periodic p=3 refresh, or a superoverlay tile rendered before, is
+#  served from here.  The least recently used views leave the memory past
+#  "renderCache/memoryMegaBytes" and _cache/render past
+#  "renderCache/diskMegaBytes".
+
+GDX_RENDER_FORMAT = 2
+
+GDX_RenderCache = collections.OrderedDict()
+GDX_RenderCacheLock = threading.Lock()
+GDX_RenderCacheCounters = {'hits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+GDX_RenderGenerations = {}
+
+
+def GDX_RenderDirty(layerId):
+
+				GDX_RenderGenerations[layerId] = GDX_RenderGenerations.get(layerId, 0) + 1
+
+
+# What the image of one layer depends on, or None when its data can
+# change behind our back (database and web layers).
+def GDX_RenderLayerKey(layer):
+
+				if layer.type() == layer.VectorLayer:
+				  if layer.dataProvider().name() == 'memory' or layer.isModified():
+				    # changed only inside this session, where the repaints are counted
+				    stamp = GDX_ServerSession
+				  else:
+				    stamp = GDX_LayerStamp(layer)
+				  labels = [(key, layer.customProperty(key)) for key in layer.customPropertyKeys() if key.startswith('labeling')]
+				  style = (GDX_LayerStyle(layer), layer.subsetString(), labels)
+				else:
+				  stamp = None
+				  if os.path.isfile(layer.source()):
+				    st = os.stat(layer.source())
+				    stamp = (layer.source(), st.st_mtime, st.st_size)
+				  # raster styles are only followed through the repaints
+				  style = GDX_ServerSession
+
+				if stamp is None:
+				  return None
+				return (layer.id(), stamp, style, GDX_RenderGenerations.get(layer.id(), 0))
+
+
+def GDX_RenderKey(rect, width, height, dpi, srs, layerIds, extra=()):
+
+				if not GDX_Setting('renderCache/enabled', True):
+				  return None
+
+				key = [GDX_RENDER_FORMAT, (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()),
+				       width, height, dpi, GDX_CrsKey(srs), extra]
+
+				registry = QgsMapLayerRegistry.instance()
+				for layerId in layerIds:
+				  layer = registry.mapLayer(layerId)
+				  if layer is None:
+				    continue
+				  layerKey = GDX_RenderLayerKey(layer)
+				  if layerKey is None:
+				    return None
+				  key.append(layerKey)
+
+				return hashlib.sha1(repr(key)).hexdigest()
+
+
+def GDX_RenderSettingsKey(settings, profile):
+
+				size = settings.outputSize()
+				background = settings.backgroundColor()
+				extra = (int(settings.flags()), background.name(), background.alpha(), GDX_EncoderKey(profile))
+				if hasattr(settings, 'rotation'):
+				  extra = extra + (settings.rotation(),)
+				return GDX_RenderKey(settings.extent(), size.width(), size.height(), settings.outputDpi(), settings.destinationCrs(), settings.layers(), extra)
+
+
+def GDX_RenderCacheDir():
+
+				tumpdir = unicode(QFileInfo(QgsApplication.qgisUserDbFilePath()).path()) + "/python/plugins/gearthview/_WebServer"
+				path = GDX_Setting('renderCache/path', tumpdir + '/_cache/render')
+				if not os.path.exists(path):
+				  os.makedirs(path)
+				return path
+
+
+def GDX_RenderCacheGet(key):
+
+				if key is None:
+				  return None
+
+				with GDX_RenderCacheLock:
+				  png = GDX_RenderCache.pop(key, None)
+				  if png is not None:
+				    GDX_RenderCache[key] = png
+				    GDX_RenderCacheCounters['hits'] = GDX_RenderCacheCounters['hits'] + 1
+				    return png
+
+				path = GDX_RenderCacheDir() + '/' + key + '.img'
+				try:
+				  f = open(path, 'rb')
+				  png = f.read()
+				  f.close()
+				  # the file times order the disk entries by last use
+				  os.utime(path, None)
+				except (IOError, OSError):
+				  png = None
+
+				with GDX_RenderCacheLock:
+				  if png is None:
+				    GDX_RenderCacheCounters['misses'] = GDX_RenderCacheCounters['misses'] + 1
+				    return None
+				  GDX_RenderCacheCounters['hits'] = GDX_RenderCacheCounters['hits'] + 1
+				  GDX_RenderCacheCounters['diskHits'] = GDX_RenderCacheCounters['diskHits'] + 1
+				  GDX_RenderCacheKeep(key, png)
+				return png
+
+
+def GDX_RenderCachePut(key, png):
+
+				if key is None:
+				  return
+
+				folder = GDX_RenderCacheDir()
+				path = folder + '/' + key + '.img'
+
+				with GDX_RenderCacheLock:
+				  GDX_RenderCacheKeep(key, png)
+
+				  if not os.path.exists(path):
+				    f = open(path + '.part', 'wb')
+				    f.write(png)
+				    f.close()
+				    os.rename(path + '.part', path)
+				    GDX_RenderCacheTrim(folder)
+
+
+# GDX_RenderCacheLock held.
+def GDX_RenderCacheKeep(key, png):
+
+				old = GDX_RenderCache.pop(key, None)
+				if old is not None:
+				  GDX_RenderCacheCounters['bytes'] = GDX_RenderCacheCounters['bytes'] - len(old)
+				GDX_RenderCache[key] = png
+				GDX_RenderCacheCounters['bytes'] = GDX_RenderCacheCounters['bytes'] + len(png)
+
+				maxBytes = GDX_Setting('renderCache/memoryMegaBytes', 64) * 1024 * 1024
+				while GDX_RenderCacheCounters['bytes'] > maxBytes and len(GDX_RenderCache) > 1:
+				  old = GDX_RenderCache.popitem(last=False)[1]
+				  GDX_RenderCacheCounters['bytes'] = GDX_RenderCacheCounters['bytes'] - len(old)
+				  GDX_RenderCacheCounters['evictions'] = GDX_RenderCacheCounters['evictions'] + 1
+
+
+# GDX_RenderCacheLock held.
+def GDX_RenderCacheTrim(folder):
+
+				maxBytes = GDX_Setting('renderCache/diskMegaBytes', 256) * 1024 * 1024
+
+				files = []
+				for filename in glob.glob(folder + '/*.img'):
+				  try:
+				    st = os.stat(filename)
+				  except OSError:
+				    continue
+				  files.append((st.st_mtime, st.st_size, filename))
+
+				total = sum([size for stamp, size, filename in files])
+				for stamp, size, filename in sorted(files):
+				  if total <= maxBytes:
+				    break
+				  try:
+				    os.remove(filename)
+				  except OSError:
+				    continue
+				  total = total - size
+
+
+def GDX_RenderCacheStats():
+
+				with GDX_RenderCacheLock:
+				  stats = dict(GDX_RenderCacheCounters)
+				  stats['entries'] = len(GDX_RenderCache)
+
+				total = stats['hits'] + stats['misses']
+				stats['hitRate'] = float(stats['hits']) / total if total else 0.
+				return stats
+
+
+def GDX_RenderCacheReport(hit):
+
+				stats = GDX_RenderCacheStats()
+				GDX_Debug(("GDX_RenderCache: %s, %d hits (%d from disk) / %d misses, hit rate %.0f%%") %('hit' if hit else 'miss', stats['hits'], stats['diskHits'], stats['misses'], stats['hitRate'] * 100))
+
+
+# GDX_RenderStage --------------------------------------
+#
+#  Every map image (publish overlay, p=3 refresh overlay, superoverlay
+#  tiles) goes through a GDX_RenderJob: a QgsMapRendererParallelJob, which
+#  draws the layers concurrently on QGIS worker threads and reports back
+#  through its finished() signal, so the GUI thread never waits on it.
+#  A job started on a channel cancels the one it supersedes there, and
+#  any job is canceled after "render/timeout" seconds.
+
+GDX_RenderChannels = {}
+
+
+# The canvas view as map settings for a width x height overlay at dpi.
+def GDX_OverlaySettings(mapCanvas, width, height, dpi):
+
+				mapRenderer = mapCanvas.mapRenderer()
+				srs = mapRenderer.destinationCrs()
+
+				mapSettings = QgsMapSettings()
+				mapSettings.setDestinationCrs(srs)
+				mapSettings.setCrsTransformEnabled(mapRenderer.hasCrsTransformEnabled())
+				mapSettings.setMapUnits(srs.mapUnits())
+				mapSettings.setExtent(mapRenderer.extent())
+				mapSettings.setOutputDpi(dpi)
+				mapSettings.setOutputSize(QSize(width, height))
+				mapSettings.setLayers(mapCanvas.mapSettings().layers())
+				mapSettings.setFlags(QgsMapSettings.Antialiasing | QgsMapSettings.UseAdvancedEffects | QgsMapSettings.ForceVectorOutput | QgsMapSettings.DrawLabeling)
+				return mapSettings
+
+
+# One render of settings, encoded with the overlay profile (see
+# GDX_OverlayEncoder) on a twisted worker thread.  done(data) is called
+# once, on the main thread: with the image bytes, from the render cache
+# or rendered, or with None when canceled or timed out.
+class GDX_RenderJob(object):
+
+				def __init__(self, settings, done, channel=None, profile=None):
+				  if profile is None:
+				    profile = GDX_OverlayProfile(settings)
+				  self.settings = settings
+				  self.done = done
+				  self.channel = channel
+				  self.profile = profile
+				  self.key = GDX_RenderSettingsKey(settings, profile)
+				  self.job = None
+				  self.timer = None
+				  self.hit = False
+				  self.canceled = False
+				  self.called = False
+
+				def start(self):
+				  data = GDX_RenderCacheGet(self.key)
+				  if data is not None:
+				    self.hit = True
+				    # never before start() returns
+				    QTimer.singleShot(0, lambda: self.deliver(data))
+				    return
+
+				  self.job = QgsMapRendererParallelJob(self.settings)
+				  QObject.connect(self.job, SIGNAL("finished()"), self.finished)
+				  self.timer = QTimer()
+				  self.timer.setSingleShot(True)
+				  QObject.connect(self.timer, SIGNAL("timeout()"), self.cancel)
+				  self.timer.start(GDX_Setting('render/timeout', 120) * 1000)
+				  self.job.start()
+
+				def finished(self):
+				  if self.canceled:
+				    self.deliver(None)
+				    return
+
+				  image = self.job.renderedImage()
+				  dotsPerMeter = self.settings.outputDpi() / 25.4 * 1000
+				  image.setDotsPerMeterX(dotsPerMeter)
+				  image.setDotsPerMeterY(dotsPerMeter)
+
+				  encoding = threads.deferToThread(GDX_OverlayEncode, image, self.profile)
+				  encoding.addCallbacks(self.encoded, self.failed)
+
+				def encoded(self, data):
+				  GDX_RenderCachePut(self.key, data)
+				  self.deliver(data)
+
+				def failed(self, reason):
+				  twistedLog.err(reason, "GDX_RenderJob: encoding failed")
+				  self.deliver(None)
+
+				def cancel(self):
+				  self.canceled = True
+				  if self.job is not None and self.job.isActive():
+				    self.job.cancel()
+				  self.deliver(None)
+
+				def deliver(self, data):
+				  if self.called:
+				    return
+				  self.called = True
+				  if self.timer is not None:
+				    self.timer.stop()
+				  if GDX_RenderChannels.get(self.channel) is self:
+				    del GDX_RenderChannels[self.channel]
+				  if data is not None and self.channel is not None and self.key is not None:
+				    GDX_RenderCacheReport(self.hit)
+				  self.done(data)
+
+
+def GDX_RenderOverlay(settings, done, channel=None, profile=None):
+
+				job = GDX_RenderJob(settings, done, channel, profile)
+
+				if channel is not None:
+				  superseded = GDX_RenderChannels.get(channel)
+				  GDX_RenderChannels[channel] = job
+				  if superseded is not None:
+				    superseded.cancel()
+
+				job.start()
+				return job
+
+
+# GDX_OverlayEncoder --------------------------------------
+#
+#  Overlay images are written by one of GDX_OVERLAY_ENCODERS:
+#    jpeg     opaque basemaps, "overlay/jpeg/quality" (85)
+#    png      any content, zlib level "overlay/png/level" (0-9, 6)
+#    palette  8 bit PNG, transparency kept as an on/off mask: the smallest
+#             for flat vector maps, coarse for imagery and color ramps
+#  "overlay/encoder" names one; "auto" picks "overlay/encoder/raster"
+#  (jpeg) when raster layers are drawn and "overlay/encoder/vector" (png)
+#  otherwise, and png instead of jpeg on a transparent background.  Encode
+#  time and bytes of the last overlays are kept in GDX_EncodeLog.
+
+GDX_EncodeLog = collections.deque(maxlen=100)
+
+
+def GDX_EncodeJpeg(image):
+
+				# JPEG has no alpha: transparent pixels would come out black
+				opaque = image.convertToFormat(QImage.Format_RGB32)
+				return GDX_ImageBytes(opaque, "jpg", GDX_Setting('overlay/jpeg/quality', 85))
+
+
+# Qt takes a PNG "quality" q and deflates at level (100 - q) * 9 / 91.
+def GDX_PngQuality():
+
+				level = min(max(GDX_Setting('overlay/png/level', 6), 0), 9)
+				return int(100 - level * 91 / 9.)
+
+
+def GDX_EncodePng(image):
+
+				return GDX_ImageBytes(image, "png", GDX_PngQuality())
+
+
+def GDX_EncodePalette(image):
+
+				# from straight (not premultiplied) ARGB Qt keeps a transparent entry
+				straight = image.convertToFormat(QImage.Format_ARGB32)
+				indexed = straight.convertToFormat(QImage.Format_Indexed8, Qt.DiffuseDither | Qt.ThresholdAlphaDither)
+				return GDX_ImageBytes(indexed, "png", GDX_PngQuality())
+
+
+# name: (file extension, encoder)
+GDX_OVERLAY_ENCODERS = {
+    'jpeg': ('jpg', GDX_EncodeJpeg),
+    'png': ('png', GDX_EncodePng),
+    'palette': ('png', GDX_EncodePalette),
+}
+
+
+# Main thread: the encoder for the content of settings.
+def GDX_OverlayProfile(settings):
+
+				profile = GDX_Setting('overlay/encoder', 'auto')
+
+				if profile not in GDX_OVERLAY_ENCODERS:
+				  registry = QgsMapLayerRegistry.instance()
+				  layers = [registry.mapLayer(layerId) for layerId in settings.layers()]
+				  if [layer for layer in layers if layer is not None and layer.type() == layer.RasterLayer]:
+				    profile = GDX_Setting('overlay/encoder/raster', 'jpeg')
+				  else:
+				    profile = GDX_Setting('overlay/encoder/vector', 'png')
+
+				if profile == 'jpeg' and settings.backgroundColor().alpha() < 255:
+				  profile = 'png'
+
+				if profile not in GDX_OVERLAY_ENCODERS:
+				  profile = 'png'
+				return profile
+
+
+# What the bytes of a profile depend on, for the render cache key.
+def GDX_EncoderKey(profile):
+
+				if profile == 'jpeg':
+				  return (profile, GDX_Setting('overlay/jpeg/quality', 85))
+				return (profile, GDX_PngQuality())
+
+
+def GDX_OverlayExt(profile):
+
+				return GDX_OVERLAY_ENCODERS[profile][0]
+
+
+# Any thread.
+def GDX_OverlayEncode(image, profile):
+
+				started = time.time()
+				data = GDX_OVERLAY_ENCODERS[profile][1](image)
+				GDX_EncodeReport(profile, image, len(data), time.time() - started)
+				return data
+
+
+def GDX_EncodeReport(profile, image, size, seconds):
+
+				GDX_EncodeLog.append({'profile': profile, 'width': image.width(), 'height': image.height(), 'bytes': size, 'seconds': seconds})
+				GDX_Debug(("GDX_OverlayEncoder: %s %dx%d, %d bytes, %.3f s") %(profile, image.width(), image.height(), size, seconds))
+
+
+# Yields the Placemarks of the layer features inside rect (layer CRS),
+# or of the features fids when given.  tolerance (layer units) simplifies
+# lines and polygons; results are cached per power-of-two bucket.
+# precision (decimals) overrides the "precision" setting.
+def GDX_KmlPlacemarks(layer, rect, fids=None, tolerance=0., precision=None):
+
+				job = {}
+				job['transform'] = GDX_Wgs84Transform(layer)
+				profile = GDX_LayerProfile(layer)
+				job['names'] = profile['names']
+				job['fetch'] = profile['fetch']
+				job['heightIdx'] = profile['heightIdx']
+				job['lazy'] = None
+				if GDX_Setting('attributes', 'table') == 'lazy':
+				  # only "height" here: the balloons load from /feature when opened
+				  job['lazy'] = GDX_FeatureUrl(layer)
+				  job['names'] = []
+				  job['fetch'] = []
+				  job['heightIdx'] = -1
+				  if profile['heightIdx'] >= 0:
+				    job['fetch'] = [profile['fetch'][profile['heightIdx']]]
+				    job['heightIdx'] = 0
+				job['schema'] = GDX_LayerSchema(layer)
+				job['altitudeMode'] = GDX_Setting('altitudeMode', '') or None
+				job['extrude'] = GDX_Setting('extrude', False)
+				job['precision'] = GDX_Setting('precision', 7) if precision is None else precision
+				job['trim'] = GDX_Setting('precision/trim', True)
+				job['srcWkt'] = layer.crs().toWkt()
+				job['parallel'] = False
+
+				bucket = None
+				job['tolerance'] = 0.
+				if tolerance > 0:
+				  bucket = int(floor(log(tolerance, 2)))
+				  job['tolerance'] = 2. ** bucket
+
+				job['clip'] = None
+				variant = bucket
+				if rect is not None and GDX_Setting('clip', False):
+				  job['clip'] = GDX_ClipWindow(rect)
+				  variant = (bucket, job['clip'])
+
+				schemaId = job['schema'] and job['schema']['id']
+				signature = (GDX_KML_FORMAT, tuple(job['names']), GDX_CrsKey(layer.crs()), variant, schemaId, job['altitudeMode'], job['extrude'], job['precision'], job['trim'], job['lazy'])
+				entry = GDX_LayerCacheEntry(layer)
+				stamp = GDX_FragmentStamp(layer)
+				shared = None
+				if stamp is None:
+				  fragments = {}
+				elif isinstance(layer, GDX_LayerSnapshot):
+				  # encoded aside, kept only if no edit came in meanwhile
+				  shared = {}
+				  if entry['edits'] == layer.edits:
+				    shared = GDX_LayerFragments(layer, signature + (stamp, layer.edits))
+				  fragments = dict(shared)
+				else:
+				  fragments = GDX_LayerFragments(layer, signature + (stamp, entry['edits']))
+				job['fragments'] = fragments
+
+				# what has just been encoded, for the persistent cache
+				job['store'] = {'placemarks': {}, 'geometries': {}}
+				hits = 0
+
+				geomKey, kmlKey = GDX_DiskCacheKeys(layer, signature, variant)
+				loaded = {}
+				if kmlKey is not None and not fragments:
+				  loaded = GDX_DiskCacheLoad(kmlKey, 'placemarks')
+				  fragments.update(loaded)
+
+				warm = fragments or (geomKey is not None and GDX_DiskCacheHas(geomKey))
+
+				if fids is None and warm and hasattr(QgsFeatureRequest, 'setFilterFids'):
+
+				  # only the ids of the visible features, then fetch the dirty ones
+				  rq = GDX_ProfileRequest(layer, rect, [], QgsFeatureRequest.NoGeometry)
+				  fids = [feat.id() for feat in layer.getFeatures(rq)]
+
+				if fids is not None:
+
+				  dirty = [fid for fid in fids if fid not in fragments]
+
+				  geometries = {}
+				  if dirty and geomKey is not None:
+				    geometries = GDX_DiskCacheLoad(geomKey, 'geometries', dirty)
+
+				  known = [fid for fid in dirty if fid in geometries]
+				  unknown = [fid for fid in dirty if fid not in geometries]
+
+				  if known:
+				    features = GDX_LayerFeatures(layer, known, QgsFeatureRequest.NoGeometry, job['fetch'])
+				    for piece in GDX_KmlEncode(job, features, geometries):
+				      pass
+
+				  if unknown:
+				    job['parallel'] = GDX_ParallelWanted(len(unknown))
+				    for piece in GDX_KmlEncode(job, GDX_LayerFeatures(layer, unknown, None, job['fetch']), {}):
+				      pass
+
+				  for fid in fids:
+				    if fid in loaded:
+				      hits = hits + 1
+				    yield fragments.get(fid, '')
+
+				  hits = hits + len(known)
+
+				else:
+
+				  job['parallel'] = GDX_ParallelWanted(layer.featureCount())
+				  for piece in GDX_KmlEncode(job, layer.getFeatures(GDX_ProfileRequest(layer, rect)), {}):
+				    yield piece
+
+				if shared is not None:
+				  with GDX_FragmentCacheLock:
+				    stale = entry['edits'] != layer.edits
+				    if not stale:
+				      shared.update(fragments)
+				  if stale:
+				    return
+
+				if geomKey is not None:
+				  if threadable.isInIOThread():
+				    # the reactor goes on serving while the rows are written
+				    saving = threads.deferToThread(GDX_DiskCacheSave, geomKey, kmlKey, job['store'], hits)
+				    saving.addErrback(twistedLog.err, "GDX_KmlPlacemarks: disk cache store failed")
+				  else:
+				    GDX_DiskCacheSave(geomKey, kmlKey, job['store'], hits)
+
+
+# GDX_ClipWindow --------------------------------------
+#
+#  With the "clip" setting the geometries are cut, in the layer CRS and
+#  before simplification and reprojection, to the view rect grown by
+#  "clip/buffer" of its size on every side.  The window is snapped
+#  outward to a power-of-two grid, so it stays the same while the view
+#  moves a little: the clipped Placemarks are cached per window like any
+#  other fragments variant.  Geometries inside the window are not
+#  touched.
+
+def GDX_ClipWindow(rect):
+
+				size = max(rect.width(), rect.height())
+				if size <= 0:
+				  return None
+
+				margin = size * max(GDX_Setting('clip/buffer', 0.25), 0.)
+				step = 2. ** floor(log(max(margin, size / 8.), 2))
+				return (floor((rect.xMinimum() - margin) / step) * step, floor((rect.yMinimum() - margin) / step) * step,
+				        ceil((rect.xMaximum() + margin) / step) * step, ceil((rect.yMaximum() + margin) / step) * step)
+
+
+# attributes: the indexes to fetch, None for all
+def GDX_LayerFeatures(layer, fids, flags=None, attributes=None):
+
+				if hasattr(QgsFeatureRequest, 'setFilterFids'):
+				  rq = QgsFeatureRequest()
+				  rq.setFilterFids(fids)
+				  if flags is not None:
+				    rq.setFlags(flags)
+				  if attributes is not None:
+				    rq.setSubsetOfAttributes(attributes)
+				  return layer.getFeatures(rq)
+
+				return itertools.chain.from_iterable(layer.getFeatures(QgsFeatureRequest(fid)) for fid in fids)
+
+
+# geometries holds the already reprojected (parts, hasZ) of some features
+def GDX_KmlEncode(job, features, geometries):
+
+				if job.get('parallel') and not geometries:
+				  pool = GDX_ParallelPool()
+				  if pool is not None:
+				    for piece in GDX_KmlEncodeParallel(job, features, pool):
+				      yield piece
+				    return
+
+				fragments = job['fragments']
+
+				batch = []
+				for feat in features:
+
+				  fid = feat.id()
+				  if fid in fragments:
+				    yield fragments[fid]
+				    continue
+
+				  if fid in geometries:
+				    parts, hasZ = geometries[fid]
+				    fresh = False
+				  else:
+				    parts, hasZ = GDX_GeomParts(feat.geometry(), job['tolerance'], job['clip'])
+				    fresh = True
+
+				  if parts:
+				    batch.append((feat, parts, hasZ, fresh))
+				  else:
+				    fragments[fid] = ''
+
+				  if len(batch) >= GDX_REPROJECT_BATCH:
+				    for piece in GDX_KmlBatch(job, batch):
+				      yield piece
+				    batch = []
+
+				for piece in GDX_KmlBatch(job, batch):
+				  yield piece
+
+
+def GDX_KmlBatch(job, batch):
+
+				GDX_ReprojectBatch(job['transform'], [parts for feat, parts, hasZ, fresh in batch if fresh])
+
+				pieces = []
+				for feat, parts, hasZ, fresh in batch:
+				  attrs = feat.attributes()
+				  attrs = [attrs[iii] for iii in job['fetch']]
+				  if job['schema'] is not None:
+				    attrs = GDX_AttrValues(attrs)
+				  piece = GDX_KmlPlacemark(job, feat.id(), attrs, parts, hasZ)
+				  job['fragments'][feat.id()] = piece
+				  job['store']['placemarks'][feat.id()] = piece
+				  if fresh:
+				    job['store']['geometries'][feat.id()] = (parts, hasZ)
+				  pieces.append(piece)
+				return pieces
+
+
+# GDX_LayerProfile --------------------------------------
+#
+#  Export profile of a layer, saved in the project as custom properties:
+#    gearthview/attributes  comma separated fields shown in the balloons;
+#                           unset: all of them, empty: no description
+#    gearthview/filter      QGIS expression, only the matching features
+#                           are exported (by the provider, when it can)
+#  Features are fetched with the balloon fields (and "height") only, see
+#  GDX_ProfileRequest.
+
+def GDX_LayerProfile(layer):
+
+				if isinstance(layer, GDX_LayerSnapshot):
+				  return layer.profile
+
+				names = [f.name() for f in layer.pendingFields()]
+
+				wanted = layer.customProperty('gearthview/attributes', None)
+				if wanted is None:
+				  shown = names
+				else:
+				  shown = [name.strip() for name in unicode(wanted).split(',')]
+				  shown = [name for name in shown if name in names]
+
+				fetch = [names.index(name) for name in shown]
+				heightIdx = layer.fieldNameIndex('height')
+				if heightIdx < 0:
+				  position = -1
+				elif heightIdx in fetch:
+				  position = fetch.index(heightIdx)
+				else:
+				  fetch.append(heightIdx)
+				  position = len(fetch) - 1
+
+				profile = {}
+				profile['names'] = shown
+				profile['fetch'] = fetch
+				profile['heightIdx'] = position
+				profile['filter'] = unicode(layer.customProperty('gearthview/filter', '') or '')
+				return profile
+
+
+# Request for the profile fields (or the attributes indexes) of the
+# features inside rect, with the profile filter.
+def GDX_ProfileRequest(layer, rect=None, attributes=None, flags=None):
+
+				profile = GDX_LayerProfile(layer)
+
+				rq = QgsFeatureRequest()
+				if rect is not None:
+				  rq.setFilterRect(rect)
+				if flags is not None:
+				  rq.setFlags(flags)
+				if attributes is None:
+				  attributes = profile['fetch']
+				rq.setSubsetOfAttributes(attributes)
+				if profile['filter']:
+				  rq.setFilterExpression(profile['filter'])
+				return rq
+
+
+# GDX_LayerSchema --------------------------------------
+#
+#  With the "attributes" option set to "schema" the Placemarks carry their
+#  values as SchemaData (see gdx_kml.GDX_KmlSchema); the Schema, styles and
+#  balloon template of the layer go once in every document that holds its
+#  Placemarks, through GDX_KmlLayerHeader.
+
+GDX_KML_TYPES = {QVariant.Int: 'int', QVariant.UInt: 'uint', QVariant.Double: 'double', QVariant.Bool: 'bool'}
+
+
+# Also called by the GDX_LayerEncoder threads: the shared entry is only
+# read and written under GDX_FragmentCacheLock.
+def GDX_LayerSchema(layer):
+
+				if GDX_Setting('attributes', 'table') != 'schema':
+				  return None
+
+				names = GDX_LayerProfile(layer)['names']
+
+				entry = GDX_LayerCacheEntry(layer)
+				with GDX_FragmentCacheLock:
+				  schema = entry['schema']
+				  if schema is None or schema['names'] != names:
+				    schemaId = 'S_' + re.sub('[^A-Za-z0-9_]', '_', layer.id())
+				    types = dict([(f.name(), GDX_KML_TYPES.get(f.type(), 'string')) for f in layer.pendingFields()])
+				    schema = GDX_KmlSchema(schemaId, [(name, types[name]) for name in names])
+				    schema['names'] = names
+				    entry['schema'] = schema
+				  return schema
+
+
+def GDX_KmlLayerHeader(layer):
+
+				schema = GDX_LayerSchema(layer)
+				if schema is None:
+				  return ''
+				return schema['header']
+
+
+# NULL attributes are None for GDX_KmlPlacemark: no SimpleData is written
+def GDX_AttrValues(attrs):
+
+				return [None if isinstance(value, QPyNullVariant) else value for value in attrs]
+
+
+# GDX_Parallel --------------------------------------
+#
+#  Large exports are encoded by a pool of worker processes: the main thread
+#  reads the features and ships WKB plus attribute values, in chunks of
+#  consecutive features, to gdx_kml.GDX_EncodeChunk; the Placemarks come
+#  back and are yielded in the original order.  Only a few chunks per
+#  worker are in flight, so memory stays flat on million-feature layers.
+#  The pool is opt-in, "parallel" off by default: starting processes from
+#  inside QGIS is not safe everywhere, and whenever the pool cannot be
+#  started (or its workers do not answer) the export is encoded in process.
+
+GDX_ParallelPoolInstance = None
+GDX_ParallelPoolLock = threading.Lock()
+
+# what GDX_KmlPlacemark reads from the job, shipped to the workers
+GDX_ENCODE_KEYS = ('names', 'heightIdx', 'schema', 'altitudeMode', 'extrude', 'precision', 'trim', 'lazy', 'clip')
+
+
+def GDX_ParallelProcesses():
+
+				try:
+				  cores = multiprocessing.cpu_count()
+				except NotImplementedError:
+				  cores = 1
+				return GDX_Setting('parallel/processes', cores)
+
+
+def GDX_ParallelWanted(count):
+
+				if not GDX_Setting('parallel', False) or GDX_ParallelProcesses() < 2:
+				  return False
+				return count >= GDX_Setting('parallel/minFeatures', 20000)
+
+
+# Raises when the workers cannot be started or do not answer: a pool
+# with dead workers would hang the export on its first chunk.
+def GDX_ParallelStart():
+
+				if platform.system() == 'Windows':
+				  # inside QGIS sys.executable is qgis.exe
+				  executable = os.path.join(sys.exec_prefix, 'pythonw.exe')
+				  if not os.path.isfile(executable):
+				    raise EnvironmentError("%s not found" % (executable))
+				  multiprocessing.set_executable(executable)
+
+				pool = multiprocessing.Pool(GDX_ParallelProcesses())
+				try:
+				  pool.apply_async(abs, (-1,)).get(GDX_Setting('parallel/startTimeout', 30.))
+				except:
+				  pool.terminate()
+				  raise
+				return pool
+
+
+def GDX_ParallelPool():
+
+				global GDX_ParallelPoolInstance
+
+				# the layers of a multi-layer publish may all ask at once
+				with GDX_ParallelPoolLock:
+				  if GDX_ParallelPoolInstance is None:
+				    try:
+				      GDX_ParallelPoolInstance = GDX_ParallelStart()
+				    except Exception, e:
+				      QgsMessageLog.logMessage("parallel export not available, encoding in process: %s" % (e), 'GEarthView', QgsMessageLog.WARNING)
+				      GDX_ParallelPoolInstance = False
+
+				return GDX_ParallelPoolInstance or None
+
+
+def GDX_ParallelClose():
+
+				global GDX_ParallelPoolInstance
+
+				if GDX_ParallelPoolInstance:
+				  GDX_ParallelPoolInstance.terminate()
+				GDX_ParallelPoolInstance = None
+
+
+# QVariant & co. do not pickle: workers get the attributes as text, or None
+def GDX_AttrText(value):
+
+				if isinstance(value, basestring):
+				  return value
+				if value is None or isinstance(value, QPyNullVariant):
+				  return None
+				return unicode(value)
+
+
+def GDX_KmlEncodeParallel(job, features, pool):
+
+				fragments = job['fragments']
+				spec = (job['srcWkt'], job['tolerance'], dict([(key, job[key]) for key in GDX_ENCODE_KEYS]))
+				chunkSize = GDX_Setting('parallel/chunk', 1000)
+				window = 2 * GDX_ParallelProcesses()
+
+				pending = collections.deque()
+				chunk = []
+				for feat in features:
+
+				  fid = feat.id()
+				  if fid in fragments:
+				    # already encoded, keep its place in the output
+				    if chunk:
+				      pending.append(pool.apply_async(GDX_EncodeChunk, ((spec, chunk),)))
+				      chunk = []
+				    if not pending or not isinstance(pending[-1], list):
+				      pending.append([])
+				    pending[-1].append((fid, fragments[fid], None, False))
+				    continue
+
+				  geom = feat.geometry()
+				  wkb = geom.asWkb() if geom is not None else None
+				  attrs = feat.attributes()
+				  chunk.append((fid, wkb, [GDX_AttrText(attrs[iii]) for iii in job['fetch']]))
+
+				  if len(chunk) >= chunkSize:
+				    pending.append(pool.apply_async(GDX_EncodeChunk, ((spec, chunk),)))
+				    chunk = []
+
+				  while len(pending) > window:
+				    for piece in GDX_ParallelCollect(job, pending.popleft()):
+				      yield piece
+
+				if chunk:
+				  pending.append(pool.apply_async(GDX_EncodeChunk, ((spec, chunk),)))
+
+				while pending:
+				  for piece in GDX_ParallelCollect(job, pending.popleft()):
+				    yield piece
+
+
+def GDX_ParallelCollect(job, item):
+
+				results = item if isinstance(item, list) else item.get()
+
+				for fid, piece, parts, hasZ in results:
+				  if parts is not None:
+				    job['fragments'][fid] = piece
+				    if parts:
+				      job['store']['placemarks'][fid] = piece
+				      job['store']['geometries'][fid] = (parts, hasZ)
+				  yield piece
+
+
+# GDX_View --------------------------------------
+#
+#  Google Earth view of a NetworkLink request (CAMERA and VIEW of the
+#  viewFormat) and the ground size of one screen pixel.
+
+def GDX_ViewParams(request):
+
+				view = {}
+				try:
+				  camera = [float(v) for v in request.args['CAMERA'][0].split(',')]
+				  view['lon'], view['lat'], view['range'] = camera[0], camera[1], camera[2]
+				except (KeyError, IndexError, ValueError):
+				  return None
+
+				try:
+				  fov = [float(v) for v in request.args['VIEW'][0].split(',')]
+				  view['hfov'], view['vfov'], view['hpixels'], view['vpixels'] = fov[0], fov[1], fov[2], fov[3]
+				except (KeyError, IndexError, ValueError):
+				  view['hfov'], view['vfov'], view['hpixels'], view['vpixels'] = 60., 38., 1024., 768.
+
+				return view
+
+
+def GDX_ViewMetersPerPixel(view):
+
+				return 2. * view['range'] * tan(radians(view['hfov']) / 2.) / max(view['hpixels'], 1.)
+
+
+def GDX_MetersToLayerUnits(layer, meters):
+
+				if layer.crs().geographicFlag():
+				  return meters / 111320.
+				return meters
+
+
+# Simplification tolerance (layer units) for the view, 0 when disabled.
+def GDX_ViewTolerance(view, layer):
+
+				if not view or view['range'] <= 0 or not GDX_Setting('simplify', True):
+				  return 0.
+
+				pixels = GDX_Setting('simplify/pixels', 1.0)
+				return GDX_MetersToLayerUnits(layer, GDX_ViewMetersPerPixel(view) * pixels)
+
+
+# Decimals of the Wgs84 coordinates for the view: the fewest that keep the
+# rounding (half a unit of the last decimal, about 111 km per degree)
+# under one screen pixel, never more than the "precision" setting.
+# None without a view or with "precision/adaptive" off.
+def GDX_ViewPrecision(view):
+
+				if not view or view['range'] <= 0 or not GDX_Setting('precision/adaptive', True):
+				  return None
+
+				maximum = GDX_Setting('precision', 7)
+				decimals = int(ceil(log10(0.5 * 111320. / GDX_ViewMetersPerPixel(view))))
+				return min(max(decimals, 1), maximum)
+
+
+# Output (width, height, dpi) of the canvas overlay for the view: as many
+# pixels as the overlay covers on the Google Earth screen, times
+# "overlay/oversample", the long side kept within "overlay/minPixels" and
+# "overlay/maxPixels" and rounded to a quarter of an octave, so that close
+# views share their render cache entry.  dpi is scaled with the size:
+# symbols and labels keep their proportions on the canvas.  Without a view
+# (or with "overlay/adaptive" off) the canvas size at dpi.
+def GDX_OverlaySize(mapCanvas, view, dpi):
+
+				size = mapCanvas.mapSettings().outputSize()
+				width, height = size.width(), size.height()
+
+				if not view or view['range'] <= 0 or not GDX_Setting('overlay/adaptive', True):
+				  return width, height, dpi
+
+				west, south, east, north = GDX_CanvasBBox(mapCanvas)
+				groundWidth = (east - west) * 111320. * cos(radians((south + north) / 2.))
+				groundHeight = (north - south) * 111320.
+				canvasLong = max(width, height, 1)
+				screenLong = max(groundWidth, groundHeight) / GDX_ViewMetersPerPixel(view) * GDX_Setting('overlay/oversample', 1.0)
+
+				minPixels = GDX_Setting('overlay/minPixels', 256)
+				maxPixels = GDX_Setting('overlay/maxPixels', 4096)
+				screenLong = min(max(screenLong, minPixels), maxPixels)
+				screenLong = 2. ** (round(log(screenLong, 2) * 4.) / 4.)
+				screenLong = min(max(screenLong, minPixels), maxPixels)
+
+				factor = screenLong / canvasLong
+				return max(int(round(width * factor)), 1), max(int(round(height * factor)), 1), dpi * factor
+
+
+# GDX_Cluster --------------------------------------
+#
+#  Point layers seen from far away: the points in view are bucketed on a
+#  Wgs84 grid of about "cluster/pixels" screen pixels and each bucket is
+#  written as one Placemark with its count.  Below "cluster/range" meters
+#  of camera range the single Placemarks are written as usual.  The point
+#  coordinates are read and reprojected once per layer (until it changes:
+#  the edit signals drop them, the source stamp and filter are checked).
+
+def GDX_ClusterWanted(layer, view):
+
+				if not view or not GDX_Setting('cluster', True):
+				  return False
+				if layer.geometryType() != QGis.Point:
+				  return False
+				return view['range'] > GDX_Setting('cluster/range', 20000.)
+
+
+def GDX_ClusterIndex(layer):
+
+				entry = GDX_LayerCacheEntry(layer)
+				profile = GDX_LayerProfile(layer)
+				# the source stamp tells of changes made outside QGIS; None: unknown
+				key = (profile['filter'], GDX_FragmentStamp(layer))
+				if key[1] is not None and entry['clusters'] is not None and entry['clusters']['key'] == key:
+				  return entry['clusters']
+
+				rq = GDX_ProfileRequest(layer, None, [])
+
+				fids = []
+				xy = []
+				for feat in layer.getFeatures(rq):
+				  geom = feat.geometry()
+				  if geom is None:
+				    continue
+				  center = geom.boundingBox().center()
+				  fids.append(feat.id())
+				  xy.append((center.x(), center.y(), 0.))
+
+				xy = numpy.array(xy, dtype=float).reshape(-1, 3)
+				lonlat = xy
+				if len(xy):
+				  lonlat = numpy.array(GDX_Wgs84Transform(layer).TransformPoints(xy.tolist()))
+
+				index = {}
+				index['fids'] = numpy.array(fids, dtype=numpy.int64)
+				index['xy'] = xy[:, :2]
+				index['lonlat'] = lonlat[:, :2]
+				index['key'] = key
+
+				entry['clusters'] = index
+				return index
+
+
+# Yields cluster Placemarks, and the single ones, of the points inside rect.
+def GDX_KmlClusters(layer, rect, view):
+
+				index = GDX_ClusterIndex(layer)
+				xy = index['xy']
+
+				inside = numpy.arange(len(xy))
+				if rect is not None:
+				  inside = numpy.nonzero((xy[:, 0] >= rect.xMinimum()) & (xy[:, 0] <= rect.xMaximum()) &
+				                         (xy[:, 1] >= rect.yMinimum()) & (xy[:, 1] <= rect.yMaximum()))[0]
+				if not len(inside):
+				  return
+
+				# grid step in degrees, rounded to a power of two so the buckets stay
+				# the same while the camera moves a little
+				step = GDX_ViewMetersPerPixel(view) * GDX_Setting('cluster/pixels', 60.) / 111320.
+				step = 2. ** floor(log(max(step, 1e-6), 2))
+
+				lonlat = index['lonlat'][inside]
+				cells = numpy.floor(lonlat / step).astype(numpy.int64)
+				rows = int(ceil(90. / step)) + 1
+				keys, cluster = numpy.unique(cells[:, 0] * (2 * rows + 1) + cells[:, 1] + rows, return_inverse=True)
+
+				counts = numpy.bincount(cluster)
+				lon = numpy.bincount(cluster, lonlat[:, 0]) / counts
+				lat = numpy.bincount(cluster, lonlat[:, 1]) / counts
+
+				precision = GDX_ViewPrecision(view)
+				for iii in numpy.nonzero(counts > 1)[0].tolist():
+				  yield (
+				    '	<Placemark>\n'
+				    '		<name>%d</name>\n'
+				    '		<Style><IconStyle><scale>%.2f</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon></IconStyle></Style>\n'
+				    '		<Point><coordinates>%s</coordinates></Point>\n'
+				    '	</Placemark>\n') % (counts[iii], 0.7 + 0.3 * log10(counts[iii]),
+				                          GDX_FormatCoords(numpy.array([[lon[iii], lat[iii]]]), precision=precision or GDX_Setting('precision', 7), terminator='', trim=GDX_Setting('precision/trim', True)))
+
+				singles = inside[counts[cluster] == 1]
+				if len(singles):
+				  for piece in GDX_KmlPlacemarks(layer, None, index['fids'][singles].tolist(), precision=precision):
+				    yield piece
+
+
+# GDX_Region --------------------------------------
+#
+#  Regionated vector KML: the features of a layer are spread over a
+#  quadtree of tiles (in Wgs84), the biggest ones in the coarse tiles.
+#  Each tile holds at most "regionate/maxFeatures" Placemarks and links its
+#  children with <Region>/<Lod> NetworkLinks, served by GDX_TilePage, so
+#  Google Earth only fetches the tiles at the current level of detail.
+
+GDX_ServerUrl = 'http://localhost:5558'
+
+
+def GDX_KmlStyles():
+
+				return (
+				  '	<Style id="hl">\n'
+				  '		<IconStyle><scale>0.7</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle_highlight.png</href></Icon></IconStyle>\n'
+				  '		<LabelStyle><scale>0.7</scale></LabelStyle>\n'
+				  '	</Style>\n'
+				  '	<Style id="default">\n'
+				  '		<IconStyle><scale>0.7</scale><Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon></IconStyle>\n'
+				  '		<LabelStyle><scale>0.7</scale></LabelStyle>\n'
+				  '	</Style>\n'
+				  '	<StyleMap id="default0">\n'
+				  '		<Pair><key>normal</key><styleUrl>#default</styleUrl></Pair>\n'
+				  '		<Pair><key>highlight</key><styleUrl>#hl</styleUrl></Pair>\n'
+				  '	</StyleMap>\n'
+				  '	<Style id="sh_style"><PolyStyle><color>7fff8080</color></PolyStyle></Style>\n'
+				  '	<Style id="sn_style"><PolyStyle><color>00ff8080</color><fill>0</fill></PolyStyle></Style>\n'
+				  '	<StyleMap id="msn_style">\n'
+				  '		<Pair><key>normal</key><styleUrl>#sn_style</styleUrl></Pair>\n'
+				  '		<Pair><key>highlight</key><styleUrl>#sh_style</styleUrl></Pair>\n'
+				  '	</StyleMap>\n')
+
+
+# Feature ids, Wgs84 centers and sizes of the layer, rebuilt after edits
+# or when the source stamp or the filter changed.
+def GDX_RegionIndex(layer):
+
+				entry = GDX_LayerCacheEntry(layer)
+				profile = GDX_LayerProfile(layer)
+				# the source stamp tells of changes made outside QGIS; None: unknown
+				key = (profile['filter'], GDX_FragmentStamp(layer))
+				if key[1] is not None and entry['regions'] is not None and entry['regions']['key'] == key:
+				  return entry['regions']
+
+				rq = GDX_ProfileRequest(layer, None, [])
+
+				fids = []
+				boxes = []
+				for feat in layer.getFeatures(rq):
+				  geom = feat.geometry()
+				  if geom is None:
+				    continue
+				  box = geom.boundingBox()
+				  fids.append(feat.id())
+				  boxes.append((box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()))
+
+				boxes = numpy.array(boxes, dtype=float).reshape(-1, 4)
+				corners = numpy.zeros((2 * len(boxes), 3))
+				corners[:len(boxes), :2] = boxes[:, 0:2]
+				corners[len(boxes):, :2] = boxes[:, 2:4]
+				if len(corners):
+				  corners = numpy.array(GDX_Wgs84Transform(layer).TransformPoints(corners.tolist()))
+
+				lo = corners[:len(boxes), :2]
+				hi = corners[len(boxes):, :2]
+
+				index = {}
+				index['fids'] = numpy.array(fids, dtype=numpy.int64)
+				index['center'] = (lo + hi) / 2.
+				index['size'] = numpy.hypot(hi[:, 0] - lo[:, 0], hi[:, 1] - lo[:, 1])
+				if len(boxes):
+				  index['bbox'] = (lo[:, 0].min(), lo[:, 1].min(), hi[:, 0].max(), hi[:, 1].max())
+				else:
+				  index['bbox'] = (-180., -90., 180., 90.)
+				index['tiles'] = {}
+				index['key'] = key
+
+				entry['regions'] = index
+				return index
+
+
+def GDX_RegionBox(index, z, x, y):
+
+				west, south, east, north = index['bbox']
+				dx = (east - west) / (1 << z)
+				dy = (north - south) / (1 << z)
+				return (west + x * dx, south + y * dy, west + (x + 1) * dx, south + (y + 1) * dy)
+
+
+# Tile coordinates, at level z, of the features idx.
+def GDX_RegionCells(index, idx, z):
+
+				west, south, east, north = index['bbox']
+				n = 1 << z
+				center = index['center'][idx]
+				tx = numpy.floor((center[:, 0] - west) / max(east - west, 1e-12) * n).astype(int)
+				ty = numpy.floor((center[:, 1] - south) / max(north - south, 1e-12) * n).astype(int)
+				return numpy.clip(tx, 0, n - 1), numpy.clip(ty, 0, n - 1)
+
+
+# Returns (picks, rest): the features drawn by the tile, biggest first, and
+# those left to its children.
+def GDX_RegionTileContent(index, z, x, y):
+
+				key = (z, x, y)
+				if key in index['tiles']:
+				  return index['tiles'][key]
+
+				if z == 0:
+				  candidates = numpy.arange(len(index['fids']))
+				else:
+				  candidates = GDX_RegionTileContent(index, z - 1, x >> 1, y >> 1)[1]
+				  tx, ty = GDX_RegionCells(index, candidates, z)
+				  candidates = candidates[(tx == x) & (ty == y)]
+
+				order = candidates[numpy.argsort(-index['size'][candidates], kind='mergesort')]
+
+				maxFeatures = GDX_Setting('regionate/maxFeatures', 500)
+				if z >= GDX_Setting('regionate/maxLevel', 12):
+				  maxFeatures = len(order)
+
+				content = (order[:maxFeatures], order[maxFeatures:])
+				index['tiles'][key] = content
+				return content
+
+
+def GDX_KmlRegion(box, minLodPixels):
+
+				west, south, east, north = box
+				return (
+				  '	<Region>\n'
+				  '		<LatLonAltBox><north>%.7lf</north><south>%.7lf</south><east>%.7lf</east><west>%.7lf</west></LatLonAltBox>\n'
+				  '		<Lod><minLodPixels>%d</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod>\n'
+				  '	</Region>\n') % (north, south, east, west, minLodPixels)
+
+
+def GDX_KmlRegionLink(layer, z, x, y, box=None):
+
+				href = ('%s/tile?layer=%s&amp;z=%d&amp;x=%d&amp;y=%d') % (GDX_ServerUrl, urllib.quote(layer.id().encode('utf-8')), z, x, y)
+
+				kml = []
+				kml.append('	<NetworkLink>\n')
+				kml.append(('		<name>%d/%d/%d</name>\n') % (z, x, y))
+				if box is not None:
+				  kml.append(GDX_KmlRegion(box, GDX_Setting('regionate/minLodPixels', 256)))
+				kml.append('		<Link>\n')
+				kml.append(('			<href>%s</href>\n') % (href))
+				kml.append('			<viewRefreshMode>onRegion</viewRefreshMode>\n')
+				kml.append('		</Link>\n')
+				kml.append('	</NetworkLink>\n')
+				return ''.join(kml)
+
+
+def GDX_RegionTile(layer, z, x, y):
+
+				index = GDX_RegionIndex(layer)
+				picks, rest = GDX_RegionTileContent(index, z, x, y)
+
+				yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+				  '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+				  '<Document>\n')
+				yield (('	<name>%s %d/%d/%d</name>\n') % (layer.name(), z, x, y))
+
+				if z > 0:
+				  yield GDX_KmlRegion(GDX_RegionBox(index, z, x, y), GDX_Setting('regionate/minLodPixels', 256))
+
+				yield GDX_KmlStyles()
+				yield GDX_KmlLayerHeader(layer)
+
+				for piece in GDX_KmlPlacemarks(layer, None, index['fids'][picks].tolist()):
+				  yield piece
+
+				if len(rest):
+				  tx, ty = GDX_RegionCells(index, rest, z + 1)
+				  for cx, cy in sorted(set(zip(tx.tolist(), ty.tolist()))):
+				    yield GDX_KmlRegionLink(layer, z + 1, cx, cy, GDX_RegionBox(index, z + 1, cx, cy))
+
+				yield '</Document>\n</kml>\n'
+
+
+# /tile?layer=<layer id>&z=&x=&y= : one tile of a regionated layer.
+class GDX_TilePage(Resource):
+
+				isLeaf = True
+
+				def render_GET(self, request):
+				  layer = QgsMapLayerRegistry.instance().mapLayer(request.args.get('layer', [''])[0])
+				  if layer is None or layer.type() != layer.VectorLayer:
+				    request.setResponseCode(404)
+				    return ''
+
+				  try:
+				    z, x, y = [int(request.args[name][0]) for name in ('z', 'x', 'y')]
+				  except (KeyError, ValueError):
+				    request.setResponseCode(400)
+				    return ''
+				  if not (0 <= z <= GDX_Setting('regionate/maxLevel', 12) and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+				    request.setResponseCode(404)
+				    return ''
+
+				  request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+				  GDX_KmlProducer(request, GDX_RegionTile(layer, z, x, y)).start()
+				  return server.NOT_DONE_YET
+
+
+# GDX_FeaturePage --------------------------------------
+#
+#  With the "attributes" option set to "lazy" the Placemarks carry no
+#  attributes: their description is an iframe on /feature, so Google
+#  Earth asks for the attributes of a feature only when its balloon is
+#  opened.  The page shows the fields of the layer export profile.
+
+def GDX_FeatureUrl(layer):
+
+				return ('%s/feature?layer=%s&fid=') % (GDX_ServerUrl, urllib.quote(layer.id().encode('utf-8')))
+
+
+# /feature?layer=<layer id>&fid=<feature id> : the balloon table of one
+# feature.
+class GDX_FeaturePage(Resource):
+
+				isLeaf = True
+
+				def render_GET(self, request):
+				  layer = QgsMapLayerRegistry.instance().mapLayer(request.args.get('layer', [''])[0])
+				  if layer is None or layer.type() != layer.VectorLayer:
+				    request.setResponseCode(404)
+				    return ''
+
+				  try:
+				    fid = int(request.args['fid'][0])
+				  except (KeyError, ValueError):
+				    request.setResponseCode(400)
+				    return ''
+
+				  profile = GDX_LayerProfile(layer)
+				  rq = QgsFeatureRequest(fid)
+				  rq.setFlags(QgsFeatureRequest.NoGeometry)
+				  rq.setSubsetOfAttributes(profile['fetch'])
+
+				  feat = QgsFeature()
+				  if not layer.getFeatures(rq).nextFeature(feat):
+				    request.setResponseCode(404)
+				    return ''
+
+				  attrs = GDX_AttrValues(feat.attributes())
+				  attrs = [attrs[iii] for iii in profile['fetch']]
+
+				  html = []
+				  html.append('<html><head><meta charset="utf-8"></head><body><table border="1">\n')
+				  html.append('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
+				  for iii in range(len(profile['names'])):
+				    value = attrs[iii]
+				    if value is None:
+				      value = 'NULL'
+				    html.append(('<tr><td>%s</td><td>%s</td></tr>\n') % (escape(profile['names'][iii]), escape(('%s') % (value,))))
+				  html.append('</table></body></html>\n')
+
+				  request.setHeader('Content-Type', 'text/html; charset=utf-8')
+				  return u''.join(html).encode('utf-8')
+
+
+# /kmz?CAMERA=&VIEW= : the document of /form?p=3, deflated into a KMZ
+# ("kmz/level") while it is streamed.  The published doc.kmz is under
+# /gaeta with the other files of _WebServer.
+class GDX_KmzPage(Resource):
+
+				isLeaf = True
+
+				def __init__(self, iface):
+				  Resource.__init__(self)
+				  self.iface = iface
+
+				def render_GET(self, request):
+				  kml = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+				     '<kml xmlns="http://www.opengis.net/kml/2.2">\n')
+				  view = GDX_ViewParams(request)
+
+				  request.setHeader('Content-Type', 'application/vnd.google-earth.kmz')
+				  counts = {}
+				  pieces = GDX_KmzPieces(GDX_Publisher2(self, kml, view), GDX_Setting('kmz/level', 6), counts=counts)
+				  GDX_KmlProducer(request, pieces, view, counts).start()
+				  return server.NOT_DONE_YET
+
+
+# GDX_LayerLinks --------------------------------------
+#
+#  /layers is a root KML with one NetworkLink per published layer (the
+#  visible vector layers with "layers/all", else the current one), each
+#  on /layer?layer=<id>.  A layer refreshes on view changes and, with its
+#  "gearthview/refresh" custom property (or the "refresh" setting) in
+#  seconds, on that interval too.  /layer answers with an ETag built from
+#  the layer data stamp, edit count, style, profile and plugin settings:
+#  a refresh of a layer that did not change gets a 304.  doc.kml links
+#  /layers as "QGIS_layers", next to QGIS_link, unchecked.
+
+GDX_VIEW_FORMAT = ('BBOX=[bboxWest],[bboxSouth],[bboxEast],[bboxNorth]&amp;'
+                   'CAMERA=[lookatLon],[lookatLat],[lookatRange],[lookatTilt],[lookatHeading]&amp;'
+                   'VIEW=[horizFov],[vertFov],[horizPixels],[vertPixels]')
+
+# changes at every start, with the fragments the validators stand for
+GDX_ServerSession = '%d-%f' % (os.getpid(), time.time())
+
+
+def GDX_LayerRefresh(layer):
+
+				try:
+				  return float(layer.customProperty('gearthview/refresh', None) or GDX_Setting('refresh', 0.))
+				except (TypeError, ValueError):
+				  return 0.
+
+
+def GDX_KmlLayerLinks(layers):
+
+				kml = []
+				kml.append('<?xml version="1.0" encoding="UTF-8"?>\n'
+				  '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+				  '<Document>\n'
+				  '	<name>GEarthView</name>\n')
+
+				for layer in layers:
+				  href = ('%s/layer?layer=%s') % (GDX_ServerUrl, urllib.quote(layer.id().encode('utf-8')))
+				  refresh = GDX_LayerRefresh(layer)
+
+				  kml.append('	<NetworkLink>\n')
+				  kml.append(('		<name>%s</name>\n') % (escape(layer.name())))
+				  kml.append('		<Link>\n')
+				  kml.append(('			<href>%s</href>\n') % (href))
+				  if refresh > 0:
+				    kml.append('			<refreshMode>onInterval</refreshMode>\n')
+				    kml.append(('			<refreshInterval>%g</refreshInterval>\n') % (refresh))
+				  kml.append('			<viewRefreshMode>onStop</viewRefreshMode>\n')
+				  kml.append('			<viewRefreshTime>1</viewRefreshTime>\n')
+				  kml.append(('			<viewFormat>%s</viewFormat>\n') % (GDX_VIEW_FORMAT))
+				  kml.append('		</Link>\n')
+				  kml.append('	</NetworkLink>\n')
+
+				kml.append('</Document>\n</kml>\n')
+				return ''.join(kml)
+
+
+# ETag of the /layer document, None when the layer can change without us
+# knowing (a database layer without cache/hashContent).  The BBOX/VIEW query
+# is left out: a client only revalidates the URL it fetched.  Without a
+# BBOX the document is cut to the canvas extent, passed as rect, which
+# then goes in.  Memory layers have no stamp and QGEarth_addPoint adds to
+# the provider without any edit signal, so their feature count and extent
+# stand in for one.
+def GDX_LayerValidator(layer, rect=None):
+
+				provider = layer.dataProvider()
+				stamp = GDX_LayerStamp(layer)
+				if provider.name() == 'memory':
+				  stamp = (provider.featureCount(), provider.extent().toString(), len(provider.fields()))
+				elif stamp is None and not layer.isModified():
+				  return None
+
+				settings = QSettings()
+				settings.beginGroup('gearthview')
+				values = [(key, unicode(settings.value(key))) for key in sorted(settings.allKeys())]
+
+				entry = GDX_LayerCacheEntry(layer)
+				state = (GDX_KML_FORMAT, GDX_ServerSession, layer.id(), layer.name(), stamp, entry['edits'],
+				         GDX_LayerStyle(layer), GDX_LayerProfile(layer), GDX_LayerRefresh(layer), values,
+				         rect and rect.toString())
+				return '"%s"' % (hashlib.sha1(repr(state)).hexdigest())
+
+
+# The BBOX of a view request, in the layer CRS; None without one.
+def GDX_RequestRect(request, layer):
+
+				try:
+				  west, south, east, north = [float(v) for v in request.args['BBOX'][0].split(',')[:4]]
+				except (KeyError, IndexError, ValueError):
+				  return None
+
+				xform = GDX_QgsTransform(4326, layer.crs())
+				return xform.transformBoundingBox(QgsRectangle(west, south, east, north))
+
+
+# The Folder content of a layer for a view: a regionated link, clusters
+# or the Placemarks simplified and rounded for the view.
+def GDX_KmlLayerPieces(layer, rect, view):
+
+				if GDX_Setting('regionate', False):
+				  yield (GDX_KmlRegionLink(layer, 0, 0, 0))
+				elif GDX_ClusterWanted(layer, view):
+				  for piece in GDX_KmlClusters(layer, rect, view):
+				    yield (piece)
+				else:
+				  for piece in GDX_KmlPlacemarks(layer, rect, tolerance=GDX_ViewTolerance(view, layer), precision=GDX_ViewPrecision(view)):
+				    yield (piece)
+
+
+# The map canvas extent in the layer CRS.
+def GDX_CanvasRect(mapCanvas, layer):
+
+				boundBox = mapCanvas.extent()
+				xform = GDX_QgsTransform(mapCanvas.mapRenderer().destinationCrs(), layer.crs())
+				pt0 = xform.transform(QgsPoint(boundBox.xMinimum(), boundBox.yMinimum()))
+				pt1 = xform.transform(QgsPoint(boundBox.xMaximum(), boundBox.yMaximum()))
+				return QgsRectangle(pt0, pt1)
+
+
+def GDX_LayerDocument(layer, rect, view):
+
+				yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+				  '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+				  '<Document>\n')
+				yield (('	<name>%s</name>\n') % (escape(layer.name())))
+				yield GDX_KmlStyles()
+				yield GDX_KmlLayerHeader(layer)
+
+				for piece in GDX_KmlLayerPieces(layer, rect, view):
+				  yield piece
+
+				yield '</Document>\n</kml>\n'
+
+
+# /layers : root KML, one NetworkLink per published layer.
+class GDX_LayersPage(Resource):
+
+				isLeaf = True
+
+				def __init__(self, iface):
+				  Resource.__init__(self)
+				  self.iface = iface
+
+				def render_GET(self, request):
+				  kml = GDX_KmlLayerLinks(GDX_PublishedLayers(self.iface.mapCanvas())).encode('utf-8')
+				  request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+				  request.setHeader('Cache-Control', 'no-cache')
+				  if request.setETag('"%s"' % (hashlib.sha1(kml).hexdigest())) == http.CACHED:
+				    return ''
+				  return kml
+
+
+# /layer?layer=<layer id>&BBOX=&CAMERA=&VIEW= : the document of one
+# layer, or 304 Not Modified when its validator still matches.
+class GDX_LayerPage(Resource):
+
+				isLeaf = True
+
+				def __init__(self, iface):
+				  Resource.__init__(self)
+				  self.iface = iface
+
+				def render_GET(self, request):
+				  layer = QgsMapLayerRegistry.instance().mapLayer(request.args.get('layer', [''])[0])
+				  if layer is None or layer.type() != layer.VectorLayer:
+				    request.setResponseCode(404)
+				    return ''
+
+				  request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+				  request.setHeader('Cache-Control', 'no-cache')
+				  rect = GDX_RequestRect(request, layer)
+				  if rect is None:
+				    rect = GDX_CanvasRect(self.iface.mapCanvas(), layer)
+				    validator = GDX_LayerValidator(layer, rect)
+				  else:
+				    validator = GDX_LayerValidator(layer)
+				  if validator is not None and request.setETag(validator) == http.CACHED:
+				    return ''
+
+				  view = GDX_ViewParams(request)
+				  GDX_KmlProducer(request, GDX_LayerDocument(layer, rect, view), view).start()
+				  return server.NOT_DONE_YET
+
+
+# GDX_PublishTask --------------------------------------
+#
+#  gearthview.run publishes doc.kml in the background.  GDX_PublishState
+#  takes, on the main thread, a snapshot of everything the export needs
+#  (extent, CRS, map settings and a GDX_LayerSnapshot of each published
+#  layer); the map is rendered by a QgsMapRendererParallelJob while a
+#  GDX_PublishTask thread writes the document.  Only the final hand-off,
+#  opening doc.kml, runs on the main thread.  QgsTask is QGIS 3 only, so
+#  GDX_PublishTask is a QThread with the same progress and cancel API.
+#  With the "kmz" setting the document and the overlay image go straight
+#  into doc.kmz, deflated at "kmz/level" (0-9), instead of loose files.
+
+GDX_PublishCurrent = None
+GDX_PublishTasks = []
+
+
+class GDX_PublishCanceled(Exception):
+				pass
+
+
+# State of a vector layer as it was when the publish started: a
+# feature source detached from the layer, its CRS, fields and cache
+# stamps.  Stands in for the layer in GDX_KmlPlacemarks.
+class GDX_LayerSnapshot(object):
+
+				def __init__(self, layer):
+				  self.layerId = layer.id()
+				  self.layerName = layer.name()
+				  self.layerCrs = QgsCoordinateReferenceSystem(layer.crs())
+				  self.fields = QgsFields(layer.pendingFields())
+				  self.count = layer.featureCount()
+				  self.stamp = GDX_LayerStamp(layer)
+				  self.fragmentStamp = GDX_FragmentStamp(layer)
+				  self.style = GDX_LayerStyle(layer)
+				  self.profile = GDX_LayerProfile(layer)
+				  # osr transforms are not thread safe: this one is for the task only
+				  self.transform = osr.CoordinateTransformation(GDX_OsrSrs(layer.crs()), GDX_OsrSrs(4326))
+
+				  if hasattr(qgis.core, 'QgsVectorLayerFeatureSource'):
+				    self.source = QgsVectorLayerFeatureSource(layer)
+				  else:
+				    self.source = layer
+
+				  # the edit signals must be connected on the main thread
+				  self.edits = GDX_LayerCacheEntry(layer)['edits']
+
+				def id(self):
+				  return self.layerId
+
+				def name(self):
+				  return self.layerName
+
+				def crs(self):
+				  return self.layerCrs
+
+				def pendingFields(self):
+				  return self.fields
+
+				def fieldNameIndex(self, fieldName):
+				  return self.fields.fieldNameIndex(fieldName)
+
+				def featureCount(self):
+				  return self.count
+
+				def getFeatures(self, request=None):
+				  if request is None:
+				    request = QgsFeatureRequest()
+				  return self.source.getFeatures(request)
+
+
+# Writes doc.kml from a GDX_PublishState, off the main thread.
+class GDX_PublishTask(QThread):
+
+				def __init__(self, iface, state):
+				  QThread.__init__(self)
+				  self.iface = iface
+				  self.state = state
+				  self.canceled = False
+				  self.error = None
+				  self.image = state['image']
+				  self.data = None
+				  self.rendered = threading.Event()
+				  self.renderJob = None
+				  self.messageItem = None
+				  self.progressBar = None
+
+				  if self.image is not None:
+				    self.rendered.set()
+
+				  QObject.connect(self, SIGNAL("progressChanged(int)"), self.showProgress)
+				  QObject.connect(self, SIGNAL("finished()"), self.handOff)
+
+				def begin(self):
+				  GDX_PublishTasks.append(self)
+
+				  self.messageItem = self.iface.messageBar().createMessage("GEarthView", "Publishing doc.kml ...")
+				  self.progressBar = QProgressBar()
+				  self.progressBar.setMaximum(100)
+				  self.messageItem.layout().addWidget(self.progressBar)
+				  cancelButton = QPushButton("Cancel")
+				  QObject.connect(cancelButton, SIGNAL("clicked()"), self.cancel)
+				  self.messageItem.layout().addWidget(cancelButton)
+				  self.iface.messageBar().pushWidget(self.messageItem, QgsMessageBar.INFO)
+
+				  if not self.rendered.isSet():
+				    self.renderJob = GDX_RenderOverlay(self.state['mapSettings'], self.renderFinished, 'publish', self.state['profile'])
+
+				  self.start()
+
+				def renderFinished(self, data):
+				  self.data = data
+				  if data is None and not self.canceled:
+				    self.error = "rendering canceled or timed out"
+				  self.rendered.set()
+
+				def cancel(self):
+				  self.canceled = True
+				  if self.renderJob is not None:
+				    self.renderJob.cancel()
+
+				def isCanceled(self):
+				  return self.canceled
+
+				# worker thread side: raises GDX_PublishCanceled once canceled
+				def checkCanceled(self):
+				  if self.canceled:
+				    raise GDX_PublishCanceled()
+
+				def setProgress(self, value):
+				  self.emit(SIGNAL("progressChanged(int)"), int(value))
+
+				def showProgress(self, value):
+				  if self.progressBar is not None:
+				    self.progressBar.setValue(value)
+
+				def waitRendered(self):
+				  while not self.rendered.wait(0.1):
+				    self.checkCanceled()
+				  self.checkCanceled()
+				  return self.image
+
+				def run(self):
+				  try:
+				    GDX_PublishDocument(self, self.state)
+				  except GDX_PublishCanceled:
+				    pass
+				  except Exception, e:
+				    self.error = e
+
+				def handOff(self):
+				  global GDX_PublishCurrent
+
+				  if self in GDX_PublishTasks:
+				    GDX_PublishTasks.remove(self)
+				  if GDX_PublishCurrent is self:
+				    GDX_PublishCurrent = None
+
+				  try:
+				    self.iface.messageBar().popWidget(self.messageItem)
+				  except RuntimeError:
+				    pass
+
+				  if self.error is not None:
+				    self.iface.messageBar().pushMessage("WARNING", "Publishing failed: %s" % (self.error), level=QgsMessageBar.WARNING, duration=5)
+				    return
+				  if self.canceled:
+				    return
+
+				  docName = '/doc.kmz' if self.state['kmz'] else '/doc.kml'
+				  GDX_OpenDocument(self.state['out_folder'] + docName)
+
+
+# Hands a written document to Google Earth (or whatever opens it).
+def GDX_OpenDocument(docName):
+
+				if platform.system() == "Windows":
+				   os.startfile(docName)
+
+				if platform.system() == "Darwin":
+				   os.system("open " + str(docName))
+
+				if platform.system() == "Linux":
+				   os.system("xdg-open " + str(docName))
+
+
+def GDX_PublishCancelAll():
+
+				for task in list(GDX_PublishTasks):
+				  task.cancel()
+				  task.wait()
+
+				if GDX_SuperOverlayCurrent is not None:
+				  GDX_SuperOverlayCurrent.cancel()
+
+
+# GDX_SuperOverlay --------------------------------------
+#
+#  The map as a quadtree pyramid of "superoverlay/tileSize" pixel tiles
+#  instead of one GroundOverlay.  Tiles are cells of a global lat/lon
+#  grid: level z cuts the world in 2^(z+1) x 2^z squares of 180/2^z
+#  degrees, y counted from the south.  Each tile document drapes its
+#  image and links the four tiles below with Region/Lod NetworkLinks, so
+#  Google Earth loads them only when they grow large enough on screen.
+#  Tiles are rendered in EPSG:4326 by up to "superoverlay/jobs"
+#  QgsMapRendererParallelJob at a time.
+#
+#  With the "superoverlay" option the publish writes superoverlay.kmz:
+#  the tiles over the canvas extent, from the level where a few tiles
+#  cover it down "superoverlay/levels" more levels.  /overlay serves the
+#  same pyramid, rendered on demand, down to "superoverlay/maxLevel".
+
+GDX_SuperOverlayCurrent = None
+
+
+def GDX_OverlayBox(z, x, y):
+
+				size = 180. / (1 << z)
+				return (-180. + x * size, -90. + y * size, -180. + (x + 1) * size, -90. + (y + 1) * size)
+
+
+def GDX_BoxIntersects(a, b):
+
+				return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+# The tiles of level z over bbox (west, south, east, north).
+def GDX_OverlayCover(bbox, z):
+
+				size = 180. / (1 << z)
+				west, south, east, north = bbox
+				x0 = max(int(floor((west + 180.) / size)), 0)
+				x1 = min(int(ceil((east + 180.) / size)) - 1, (2 << z) - 1)
+				y0 = max(int(floor((south + 90.) / size)), 0)
+				y1 = min(int(ceil((north + 90.) / size)) - 1, (1 << z) - 1)
+				return [(z, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+
+# The deepest level where a tile is as large as bbox, so at most 2 x 2
+# tiles cover it, and those tiles.
+def GDX_OverlayRoots(bbox):
+
+				west, south, east, north = bbox
+				span = max(east - west, north - south, 1e-7)
+				z = min(max(int(floor(log(180. / span, 2))), 0), GDX_Setting('superoverlay/maxLevel', 18))
+				return z, GDX_OverlayCover(bbox, z)
+
+
+def GDX_OverlayChildren(z, x, y, bbox=None):
+
+				children = [(z + 1, 2 * x + i, 2 * y + j) for j in (0, 1) for i in (0, 1)]
+				if bbox is not None:
+				  children = [child for child in children if GDX_BoxIntersects(GDX_OverlayBox(*child), bbox)]
+				return children
+
+
+# The canvas extent in WGS84, as (west, south, east, north).
+def GDX_CanvasBBox(mapCanvas):
+
+				srs = mapCanvas.mapSettings().destinationCrs()
+				rect = GDX_QgsTransform(srs, 4326).transformBoundingBox(mapCanvas.extent())
+				return (max(rect.xMinimum(), -180.), max(rect.yMinimum(), -90.), min(rect.xMaximum(), 180.), min(rect.yMaximum(), 90.))
+
+
+# Tile links inside superoverlay.kmz: every file sits at the archive root,
+# so the same relative href works from doc.kml and from the tiles.
+def GDX_OverlayFile(z, x, y, ext):
+
+				return ('%d_%d_%d.%s') % (z, x, y, ext)
+
+
+def GDX_OverlayUrl(z, x, y, ext):
+
+				href = ('%s/overlay?z=%d&amp;x=%d&amp;y=%d') % (GDX_ServerUrl, z, x, y)
+				if ext == 'png':
+				  href += '&amp;png=1'
+				return href
+
+
+def GDX_KmlOverlayLink(z, x, y, href, minLodPixels):
+
+				kml = []
+				kml.append('	<NetworkLink>\n')
+				kml.append(('		<name>%d/%d/%d</name>\n') % (z, x, y))
+				kml.append(GDX_KmlRegion(GDX_OverlayBox(z, x, y), minLodPixels))
+				kml.append('		<Link>\n')
+				kml.append(('			<href>%s</href>\n') % (href(z, x, y, 'kml')))
+				kml.append('			<viewRefreshMode>onRegion</viewRefreshMode>\n')
+				kml.append('		</Link>\n')
+				kml.append('	</NetworkLink>\n')
+				return ''.join(kml)
+
+
+# The entry document: one always active link per root tile.
+def GDX_KmlOverlayRoot(tiles, href):
+
+				kml = []
+				kml.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+				kml.append('<kml xmlns="http://www.opengis.net/kml/2.2">\n')
+				kml.append('<Document>\n')
+				kml.append('	<name>GEarthView superoverlay</name>\n')
+				for z, x, y in tiles:
+				  kml.append(GDX_KmlOverlayLink(z, x, y, href, 0))
+				kml.append('</Document>\n')
+				kml.append('</kml>\n')
+				return ''.join(kml)
+
+
+# One tile: its image, drawn over its parents, and the links to children.
+def GDX_KmlOverlayTile(z, x, y, children, href):
+
+				west, south, east, north = box = GDX_OverlayBox(z, x, y)
+				minLodPixels = GDX_Setting('superoverlay/minLodPixels', 128)
+
+				kml = []
+				kml.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+				kml.append('<kml xmlns="http://www.opengis.net/kml/2.2">\n')
+				kml.append('<Document>\n')
+				kml.append(('	<name>%d/%d/%d</name>\n') % (z, x, y))
+				kml.append(GDX_KmlRegion(box, 0))
+				kml.append('	<GroundOverlay>\n')
+				kml.append(('		<drawOrder>%d</drawOrder>\n') % (z))
+				kml.append(('		<Icon><href>%s</href></Icon>\n') % (href(z, x, y, 'png')))
+				kml.append(('		<LatLonBox><north>%.7lf</north><south>%.7lf</south><east>%.7lf</east><west>%.7lf</west></LatLonBox>\n') % (north, south, east, west))
+				kml.append('	</GroundOverlay>\n')
+				for child in children:
+				  kml.append(GDX_KmlOverlayLink(child[0], child[1], child[2], href, minLodPixels))
+				kml.append('</Document>\n')
+				kml.append('</kml>\n')
+				return ''.join(kml)
+
+
+# The canvas settings redirected to one tile: EPSG:4326, square output,
+# transparent where there is no data.
+def GDX_TileSettings(template, box, size):
+
+				settings = QgsMapSettings(template)
+				settings.setDestinationCrs(GDX_Crs(4326))
+				if hasattr(settings, 'setCrsTransformEnabled'):
+				  settings.setCrsTransformEnabled(True)
+				if hasattr(settings, 'setRotation'):
+				  settings.setRotation(0)
+				settings.setOutputSize(QSize(size, size))
+				settings.setExtent(QgsRectangle(*box))
+				settings.setBackgroundColor(QColor(255, 255, 255, 0))
+				return settings
+
+
+# Renders map settings to PNG bytes with at most "superoverlay/jobs"
+# GDX_RenderJob running; done(png) is called on the main thread, with
+# None when the job was canceled.  Tiles are transparent: "png" or
+# "palette" encoded, after "superoverlay/encoder".
+class GDX_TileRenderer(object):
+
+				def __init__(self):
+				  self.limit = max(GDX_Setting('superoverlay/jobs', QThread.idealThreadCount()), 1)
+				  self.profile = GDX_Setting('superoverlay/encoder', 'png')
+				  if self.profile != 'palette':
+				    self.profile = 'png'
+				  self.pending = collections.deque()
+				  self.running = []
+
+				def render(self, settings, done):
+				  self.pending.append((settings, done))
+				  self.next()
+
+				def next(self):
+				  while self.pending and len(self.running) < self.limit:
+				    settings, done = self.pending.popleft()
+				    self.start(settings, done)
+
+				def start(self, settings, done):
+				  def rendered(png):
+				    self.running.remove(job)
+				    done(png)
+				    self.next()
+
+				  job = GDX_RenderJob(settings, rendered, profile=self.profile)
+				  self.running.append(job)
+				  job.start()
+
+				def cancel(self):
+				  self.pending.clear()
+				  for job in list(self.running):
+				    job.cancel()
+
+
+# Writes superoverlay.kmz from the canvas, tile by tile.
+class GDX_SuperOverlayTask(object):
+
+				def __init__(self, iface):
+				  mapCanvas = iface.mapCanvas()
+				  self.iface = iface
+				  self.template = QgsMapSettings(mapCanvas.mapSettings())
+				  self.out_folder = unicode(QFileInfo(QgsApplication.qgisUserDbFilePath()).path()) + "/python/plugins/gearthview/_WebServer"
+				  self.size = GDX_Setting('superoverlay/tileSize', 256)
+				  self.canceled = False
+				  self.done = 0
+				  self.failed = 0
+				  self.messageItem = None
+				  self.progressBar = None
+				  self.out = None
+				  self.kmz = None
+				  self.renderer = GDX_TileRenderer()
+
+				  bbox = GDX_CanvasBBox(mapCanvas)
+				  rootLevel, self.roots = GDX_OverlayRoots(bbox)
+				  lastLevel = min(rootLevel + GDX_Setting('superoverlay/levels', 4), GDX_Setting('superoverlay/maxLevel', 18))
+
+				  # tile -> children, level by level
+				  self.tiles = []
+				  level = self.roots
+				  while level:
+				    deeper = []
+				    for z, x, y in level:
+				      children = GDX_OverlayChildren(z, x, y, bbox) if z < lastLevel else []
+				      self.tiles.append(((z, x, y), children))
+				      deeper.extend(children)
+				    level = deeper
+
+				def begin(self):
+				  self.messageItem = self.iface.messageBar().createMessage("GEarthView", "Rendering %d superoverlay tiles ..." % (len(self.tiles)))
+				  self.progressBar = QProgressBar()
+				  self.progressBar.setMaximum(len(self.tiles))
+				  self.messageItem.layout().addWidget(self.progressBar)
+				  cancelButton = QPushButton("Cancel")
+				  QObject.connect(cancelButton, SIGNAL("clicked()"), self.cancel)
+				  self.messageItem.layout().addWidget(cancelButton)
+				  self.iface.messageBar().pushWidget(self.messageItem, QgsMessageBar.INFO)
+
+				  self.partName = self.out_folder + '/superoverlay_%d.kmz.part' % (int(time.time() * 1000))
+				  self.out = open(self.partName, 'wb')
+				  self.kmz = GDX_KmzStream(self.out, GDX_Setting('kmz/level', 6))
+				  self.kmz.writestr('doc.kml', GDX_KmlOverlayRoot(self.roots, GDX_OverlayFile))
+
+				  for (z, x, y), children in self.tiles:
+				    self.kmz.writestr(GDX_OverlayFile(z, x, y, 'kml'), GDX_KmlOverlayTile(z, x, y, children, GDX_OverlayFile))
+				    settings = GDX_TileSettings(self.template, GDX_OverlayBox(z, x, y), self.size)
+				    self.renderer.render(settings, lambda png, tile=(z, x, y): self.tileRendered(tile, png))
+
+				# png is None for a tile that timed out or failed to encode: the
+				# export goes on without its image.
+				def tileRendered(self, tile, png):
+				  if self.canceled:
+				    return
+				  if png is None:
+				    self.failed += 1
+				  else:
+				    # PNG data does not deflate any further
+				    self.kmz.writestr(GDX_OverlayFile(tile[0], tile[1], tile[2], 'png'), png, 0)
+				    self.done += 1
+				  self.progressBar.setValue(self.done + self.failed)
+				  if self.done + self.failed == len(self.tiles):
+				    self.finish()
+
+				def cancel(self):
+				  if self.canceled:
+				    return
+				  self.canceled = True
+				  self.renderer.cancel()
+				  if self.out is not None:
+				    self.out.close()
+				    os.remove(self.partName)
+				  self.close()
+
+				def abort(self, message):
+				  self.cancel()
+				  self.iface.messageBar().pushMessage("WARNING", message, level=QgsMessageBar.WARNING, duration=5)
+
+				def close(self):
+				  global GDX_SuperOverlayCurrent
+
+				  if GDX_SuperOverlayCurrent is self:
+				    GDX_SuperOverlayCurrent = None
+				  try:
+				    self.iface.messageBar().popWidget(self.messageItem)
+				  except RuntimeError:
+				    pass
+
+				def finish(self):
+				  if self.done == 0:
+				    self.abort("Superoverlay export failed: no tile could be rendered")
+				    return
+
+				  self.kmz.close()
+				  self.out.close()
+				  docName = self.out_folder + '/superoverlay.kmz'
+				  if os.path.exists(docName):
+				    os.remove(docName)
+				  os.rename(self.partName, docName)
+				  self.close()
+				  if self.failed:
+				    self.iface.messageBar().pushMessage("WARNING", "superoverlay.kmz written without %d of its %d tile images (render timeout or error)" % (self.failed, len(self.tiles)), level=QgsMessageBar.WARNING, duration=5)
+				  GDX_OpenDocument(docName)
+
+
+def GDX_SuperOverlayStart(iface):
+
+				global GDX_SuperOverlayCurrent
+
+				# a new export supersedes the running one
+				if GDX_SuperOverlayCurrent is not None:
+				  GDX_SuperOverlayCurrent.cancel()
+
+				GDX_SuperOverlayCurrent = GDX_SuperOverlayTask(iface)
+				GDX_SuperOverlayCurrent.begin()
+
+
+# /overlay : the superoverlay entry document for the current canvas.
+# /overlay?z=&x=&y= : one tile document, &png=1 its image.
+class GDX_OverlayPage(Resource):
+
+				isLeaf = True
+
+				def __init__(self, iface):
+				  Resource.__init__(self)
+				  self.iface = iface
+				  self.renderer = None
+
+				def render_GET(self, request):
+				  mapCanvas = self.iface.mapCanvas()
+				  maxLevel = GDX_Setting('superoverlay/maxLevel', 18)
+
+				  if 'z' not in request.args:
+				    rootLevel, roots = GDX_OverlayRoots(GDX_CanvasBBox(mapCanvas))
+				    request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+				    return GDX_KmlOverlayRoot(roots, GDX_OverlayUrl)
+
+				  try:
+				    z, x, y = [int(request.args[name][0]) for name in ('z', 'x', 'y')]
+				  except (KeyError, ValueError):
+				    request.setResponseCode(400)
+				    return ''
+				  if not (0 <= z <= maxLevel and 0 <= x < (2 << z) and 0 <= y < (1 << z)):
+				    request.setResponseCode(404)
+				    return ''
+
+				  if not request.args.get('png'):
+				    children = GDX_OverlayChildren(z, x, y) if z < maxLevel else []
+				    request.setHeader('Content-Type', 'application/vnd.google-earth.kml+xml')
+				    return GDX_KmlOverlayTile(z, x, y, children, GDX_OverlayUrl)
+
+				  if self.renderer is None:
+				    self.renderer = GDX_TileRenderer()
+
+				  gone = []
+				  request.notifyFinish().addBoth(gone.append)
+
+				  def rendered(png):
+				    if gone:
+				      return
+				    if png is None:
+				      request.setResponseCode(503)
+				    else:
+				      request.setHeader('Content-Type', 'image/png')
+				      request.write(png)
+				    request.finish()
+
+				  settings = GDX_TileSettings(mapCanvas.mapSettings(), GDX_OverlayBox(z, x, y), GDX_Setting('superoverlay/tileSize', 256))
+				  self.renderer.render(settings, rendered)
+				  return server.NOT_DONE_YET
+
+
+# GDX_Publisher --------------------------------------
+
+def GDX_Publisher(self):
+
+#    print "GDX_Publisher -------------------------------\n"
+
+				global GDX_PublishCurrent
+
+				if GDX_Setting('superoverlay', False):
+				  GDX_SuperOverlayStart(self.iface)
+				  return
+
+				# a new publish supersedes the running one
+				if GDX_PublishCurrent is not None:
+				  GDX_PublishCurrent.cancel()
+
+				GDX_PublishCurrent = GDX_PublishTask(self.iface, GDX_PublishState(self))
+				GDX_PublishCurrent.begin()
+
+
+# Main thread: everything GDX_PublishDocument needs from QGIS.
+def GDX_PublishState(self):
+
+				mapCanvas = self.iface.mapCanvas()
+
+				tumpdir = unicode(QFileInfo(QgsApplication.qgisUserDbFilePath()).path()) + "/python/plugins/gearthview/_WebServer"
+
+				adesso = str(datetime.datetime.now())
+				adesso = adesso.replace(" ","_")
+				adesso = adesso.replace(":","_")
+				adesso = adesso.replace(".","_")
+
+				state = {}
+				state['out_folder'] = tumpdir
+				state['adesso'] = adesso
+				state['image'] = None
+				state['profile'] = 'png'
+				state['kmz'] = GDX_Setting('kmz', False)
+				state['kmzLevel'] = GDX_Setting('kmz/level', 6)
+
+				mapRenderer = mapCanvas.mapRenderer()
+				mapRect = mapRenderer.extent()
+				width = mapRenderer.width()
+				height = mapRenderer.height()
+				srs = mapRenderer.destinationCrs()
+				state['size'] = (width, height)
+
+				if QGis.QGIS_VERSION_INT <= 120200:
+
+#  OLD version ----------------------------------------------------------
+				   # create output image and initialize it
+				   image = QImage(QSize(width, height), QImage.Format_ARGB32)
+				   image.fill(0)
+				   #adjust map canvas (renderer) to the image size and render
+				   imagePainter = QPainter(image)
+				   zoom = 1
+				   target_dpi = int(round(zoom * mapRenderer.outputDpi()))
+				   mapRenderer.setOutputSize(QSize(width, height), target_dpi)
+				   mapRenderer.render(imagePainter)
+				   imagePainter.end()
+				   state['image'] = image
+#  OLD version ----------------------------------------------------------
+
+				else:   # ovvero  QGis.QGIS_VERSION_INT > 120200
+
+				   width, height, DPI = GDX_OverlaySize(mapCanvas, None, GDX_Setting('overlay/dpi', 300))
+				   mapSettings = GDX_OverlaySettings(mapCanvas, width, height, DPI)
+				   state['size'] = (width, height)
+				   state['mapSettings'] = mapSettings
+				   state['dpi'] = DPI
+				   state['profile'] = GDX_OverlayProfile(mapSettings)
+
+				# EndIf     # QGis.QGIS_VERSION_INT > 120200
+
+				xN = mapRect.xMinimum()
+				yN = mapRect.yMinimum()
+				state['nomePNG'] = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
+				state['mapRect'] = QgsRectangle(mapRect)
+
+				xform = GDX_QgsTransform(srs, 4326)  # Wgs84LLH
+
+				corners = []
+				for x, y in ((mapRect.xMinimum(), mapRect.yMinimum()), (mapRect.xMaximum(), mapRect.yMinimum()),
+				             (mapRect.xMaximum(), mapRect.yMaximum()), (mapRect.xMinimum(), mapRect.yMaximum())):
+				  pt = xform.transform(QgsPoint(x, y))
+				  corners.extend([pt.x(), pt.y()])
+				state['corners'] = corners
+
+				pt5 = xform.transform(mapRect.center())
+				state['center'] = (pt5.x(), pt5.y())
+
+				rotazio = 0.0
+				if QGis.QGIS_VERSION_INT >= 20801:
+				   rotazio = -(mapCanvas.rotation())
+				state['rotazio'] = rotazio
+
+#  Prendo il sistema di riferimento del Layer selezionato ------------------
+
+				layers = GDX_PublishedLayers(mapCanvas)
+
+#----------------------------------------------------------------------------
+#  Trasformo la finestra video in coordinate layer,
+#     per estrarre solo gli elementi visibili
+#----------------------------------------------------------------------------
+				boundBox = mapCanvas.extent()
+				state['layers'] = [GDX_PublishLayerEntry(layer, srs, boundBox) for layer in layers]
+
+				return state
+
+
+# GDX_PublishTask thread: writes doc.kml, the overlay image and its pngw.
+def GDX_PublishDocument(task, state):
+
+				if state['kmz']:
+				  return GDX_PublishKmz(task, state)
+
+				out_folder = state['out_folder']
+				nomePNG = state['nomePNG']
+				mapRect = state['mapRect']
+
+				# written aside and renamed at the end: doc.kml is never half done
+				partName = out_folder + '/doc_' + state['adesso'] + '.kml.part'
+				kml = codecs.open(partName, 'w', encoding='utf-8')
+
+				try:
+				  GDX_PublishKml(task, state, kml)
+				  kml.close()
+				  data = GDX_PublishImage(task, state)
+				except:
+				  kml.close()
+				  os.remove(partName)
+				  raise
+
+# HERE IT DELETES THE OLD IMAGE ------------------------------------
+# (if you comment these, images still remain ...  :)
+				for filename in glob.glob(str(out_folder + '/*.png')) :
+				   os.remove( str(filename) )
+				for filename in glob.glob(str(out_folder + '/*.pngw')) :
+				   os.remove( str(filename) )
+				for filename in glob.glob(str(out_folder + '/*.jpg')) + glob.glob(str(out_folder + '/*.jpgw')) :
+				   os.remove( str(filename) )
+# ------------------------------------------------------------------
+
+				ext = GDX_OverlayExt(state['profile'])
+
+				#Save the image
+				input_file = out_folder + "/" + nomePNG + "." + ext
+				f = open(input_file, 'wb')
+				f.write(data)
+				f.close()
+
+				#Export tfw-file
+				f = open(out_folder + "/" + nomePNG + "." + ext + "w", 'w')
+				f.write(GDX_WorldFile(mapRect, state['size']))
+				f.close()
+
+				if os.path.exists(out_folder + '/doc.kml'):
+				  os.remove(out_folder + '/doc.kml')
+				os.rename(partName, out_folder + '/doc.kml')
+
+				task.setProgress(100)
+
+
+# GDX_PublishTask thread: doc.kml, the overlay image and its pngw written
+# straight into doc.kmz.
+def GDX_PublishKmz(task, state):
+
+				out_folder = state['out_folder']
+				nomePNG = state['nomePNG']
+
+				partName = out_folder + '/doc_' + state['adesso'] + '.kmz.part'
+				out = open(partName, 'wb')
+
+				try:
+				  kmz = GDX_KmzStream(out, state['kmzLevel'])
+				  kmz.begin('doc.kml')
+				  GDX_PublishKml(task, state, kmz)
+				  kmz.end()
+
+				  data = GDX_PublishImage(task, state)
+				  ext = GDX_OverlayExt(state['profile'])
+
+				  # PNG and JPEG are compressed already: stored as they are
+				  kmz.writestr(nomePNG + '.' + ext, data, 0)
+				  kmz.writestr(nomePNG + '.' + ext + 'w', GDX_WorldFile(state['mapRect'], state['size']))
+				  kmz.close()
+				  out.close()
+				except:
+				  out.close()
+				  os.remove(partName)
+				  raise
+
+				if os.path.exists(out_folder + '/doc.kmz'):
+				  os.remove(out_folder + '/doc.kmz')
+				os.rename(partName, out_folder + '/doc.kmz')
+
+				task.setProgress(100)
+
+
+# The encoded overlay: from the render stage, or the image of the old
+# QGIS versions encoded here.
+def GDX_PublishImage(task, state):
+
+				image = task.waitRendered()
+				if task.data is not None:
+				  return task.data
+				if image is None:
+				  raise GDX_PublishCanceled()
+
+				GDX_ImageDpi(image, state)
+				return GDX_OverlayEncode(image, state['profile'])
+
+
+def GDX_ImageDpi(image, state):
+
+				if 'dpi' in state:
+				  image.setDotsPerMeterX(state['dpi'] / 25.4 * 1000)
+				  image.setDotsPerMeterY(state['dpi'] / 25.4 * 1000)
+
+
+def GDX_ImageBytes(image, format, quality=-1):
+
+				data = QByteArray()
+				buffer = QBuffer(data)
+				buffer.open(QIODevice.WriteOnly)
+				image.save(buffer, format, quality)
+				buffer.close()
+				return str(data)
+
+
+# The pngw world file of a (width, height) image covering mapRect.
+def GDX_WorldFile(mapRect, size):
+
+				xScale = (mapRect.xMaximum() - mapRect.xMinimum()) /  size[0]
+				yScale = (mapRect.yMaximum() - mapRect.yMinimum()) /  size[1]
+
+				lines = [str(xScale), str(0), str(0), '-' + str(yScale),
+				         str(mapRect.xMinimum()), str(mapRect.yMaximum()), str(mapRect.xMaximum()), str(mapRect.yMinimum())]
+				return '\n'.join(lines)
+
+
+# GDX_PublishLayers --------------------------------------
+#
+#  With "layers/all" the publish takes every visible vector layer of the
+#  layer tree instead of the current one, each in its own Folder.  Up to
+#  "layers/threads" layers are encoded at once by GDX_LayerEncoder
+#  threads, each into a bounded queue that the publish task drains in
+#  layer order, so the document is still written front to back.
+#  "layers/maxFeatures" caps the Placemarks of every layer (0: no cap).
+#  Time and bytes of each layer end up in state['report'].
+
+GDX_LAYER_QUEUE = 256
+
+def GDX_VisibleVectorLayers():
+
+				layers = []
+				for node in QgsProject.instance().layerTreeRoot().findLayers():
+				  layer = node.layer()
+				  if layer is not None and layer.type() == layer.VectorLayer and node.isVisible() != Qt.Unchecked:
+				    layers.append(layer)
+				return layers
+
+
+# The visible vector layers with "layers/all", else the current layer.
+def GDX_PublishedLayers(mapCanvas):
+
+				if GDX_Setting('layers/all', False):
+				  return GDX_VisibleVectorLayers()
+
+				layer = mapCanvas.currentLayer()
+				if layer and layer.type() == layer.VectorLayer:
+				  return [layer]
+				return []
+
+
+# Main thread: what GDX_PublishLayers needs of a layer, the map extent
+# boundBox (crs) taken to the layer CRS.
+def GDX_PublishLayerEntry(layer, crs, boundBox):
+
+				xform = GDX_QgsTransform(crs, layer.crs())
+				pt0 = xform.transform(QgsPoint(boundBox.xMinimum(), boundBox.yMinimum()))
+				pt1 = xform.transform(QgsPoint(boundBox.xMaximum(), boundBox.yMaximum()))
+
+				entry = {}
+				entry['name'] = layer.name().replace(" ","_")
+				entry['rect'] = QgsRectangle(pt0, pt1)
+				entry['layer'] = GDX_LayerSnapshot(layer)
+				return entry
+
+
+# Encodes the Placemarks of one published layer into a queue, None
+# last.  Gives up when the task is canceled or the encoder stopped.
+class GDX_LayerEncoder(threading.Thread):
+
+				def __init__(self, task, entry, budget):
+				  threading.Thread.__init__(self)
+				  self.daemon = True
+				  self.task = task
+				  self.entry = entry
+				  self.budget = budget
+				  self.queue = Queue.Queue(GDX_LAYER_QUEUE)
+				  self.stopped = False
+				  self.error = None
+				  self.placemarks = 0
+				  self.bytes = 0
+				  self.truncated = False
+				  self.seconds = 0.
+
+				def run(self):
+				  started = time.time()
+				  layer = self.entry['layer']
+				  if GDX_Setting('regionate', False):
+				    pieces = iter([GDX_KmlRegionLink(layer, 0, 0, 0)])
+				  else:
+				    pieces = GDX_KmlPlacemarks(layer, self.entry['rect'])
+
+				  try:
+				    for piece in pieces:
+				      if not piece:
+				        continue
+				      if self.budget and self.placemarks >= self.budget:
+				        self.truncated = True
+				        break
+				      if not self.put(piece):
+				        break
+				      self.placemarks = self.placemarks + 1
+				  except Exception, e:
+				    self.error = e
+				  finally:
+				    if hasattr(pieces, 'close'):
+				      pieces.close()
+				    self.seconds = time.time() - started
+				    self.put(None)
+
+				def put(self, piece):
+				  while not (self.stopped or self.task.isCanceled()):
+				    try:
+				      self.queue.put(piece, True, 0.1)
+				      return True
+				    except Queue.Full:
+				      pass
+				  return False
+
+				# publish task side
+				def get(self):
+				  while True:
+				    try:
+				      return self.queue.get(True, 0.1)
+				    except Queue.Empty:
+				      self.task.checkCanceled()
+
+
+def GDX_PublishLayers(task, state, kml):
+
+				entries = state['layers']
+				threads = max(GDX_Setting('layers/threads', 4), 1)
+				budget = max(GDX_Setting('layers/maxFeatures', 0), 0)
+
+				encoders = [GDX_LayerEncoder(task, entry, budget) for entry in entries]
+				total = max(sum([min(entry['layer'].featureCount(), budget or sys.maxint) for entry in entries]), 1)
+				written = 0
+
+				for encoder in encoders[:threads]:
+				  encoder.start()
+
+				try:
+				  for iii in range(len(encoders)):
+				    encoder = encoders[iii]
+
+				    kml.write('    <Folder>\n')
+				    kml.write(('			<name>%s</name>\n') % (encoder.entry['name']))
+
+				    while True:
+				      piece = encoder.get()
+				      if piece is None:
+				        break
+				      kml.write(piece)
+				      if isinstance(piece, unicode):
+				        piece = piece.encode('utf-8')
+				      encoder.bytes = encoder.bytes + len(piece)
+				      written = written + 1
+				      if written % 1000 == 0:
+				        task.checkCanceled()
+				        task.setProgress(5 + min(85 * written / total, 85))
+
+				    kml.write('  </Folder>\n')
+
+				    if encoder.error is not None:
+				      raise encoder.error
+				    task.checkCanceled()
+
+				    if iii + threads < len(encoders):
+				      encoders[iii + threads].start()
+				finally:
+				  for encoder in encoders:
+				    encoder.stopped = True
+
+				state['report'] = GDX_PublishReport(encoders)
+
+
+def GDX_PublishReport(encoders):
+
+				report = []
+				for encoder in encoders:
+				  line = {}
+				  line['layer'] = encoder.entry['name']
+				  line['placemarks'] = encoder.placemarks
+				  line['bytes'] = encoder.bytes
+				  line['seconds'] = encoder.seconds
+				  line['truncated'] = encoder.truncated
+				  report.append(line)
+
+				  truncated = ''
+				  if encoder.truncated:
+				    truncated = ' (layers/maxFeatures reached)'
+				  GDX_Debug(("GDX_Publish: %s: %d Placemarks%s, %d bytes, %.2f s") %(line['layer'], line['placemarks'], truncated, line['bytes'], line['seconds']))
+				return report
+
+
+def GDX_PublishKml(task, state, kml):
+
+				nomePNG = state['nomePNG']
+				x1, y1, x2, y2, x3, y3, x4, y4 = state['corners']
+				xc, yc = state['center']
+
+				#Write kml header
+				kml.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+				kml.write('<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">\n')				
+				kml.write('    <Document>\n')
+				kml.write('    	 <name>QGisView</name>\n')
+				kml.write('    	 <Snippet maxLines="0"></Snippet>\n') 
+#				loc = ("    	 <description><![CDATA[http://map.project-osrm.org/?loc=%.7lf,%.7lf&ly=1784084387]]></description>\n") %(yc, xc)
+#				loc = ("    	 <description><![CDATA[http://map.project-osrm.org/?z=16&center=%.7lf,%.7lf&loc=&loc=&hl=en&ly=&alt=&df=&srv=]]></description>\n") %(yc, xc)
+				loc = ("    	 <description><![CDATA[https://map.what3words.com/%.7lf,%.7lf]]></description>\n") %(yc, xc)
+
+				kml.write(loc)
+#
+				
+				
+#				kml.write('    	 <description>http://map.project-osrm.org/?hl=it&loc=45.989486,12.778154&loc=45.985624,12.781076&z=16&center=45.984058,12.774417&alt=0&df=0&re=0&ly=-940622518</description>\n')
+				
+				kml.write('	     <open>1</open>\n')
+
+				kml.write('	<Style id="sh_style">\n')
+				kml.write('		<PolyStyle>\n')
+				kml.write('			<color>7fff8080</color>\n')
+				kml.write('		</PolyStyle>\n')
+				kml.write('	</Style>\n')
+				kml.write('	<StyleMap id="msn_style">\n')
+				kml.write('		<Pair>\n')
+				kml.write('			<key>normal</key>\n')
+				kml.write('			<styleUrl>#sn_style</styleUrl>\n')
+				kml.write('		</Pair>\n')
+				kml.write('		<Pair>\n')
+				kml.write('			<key>highlight</key>\n')
+				kml.write('			<styleUrl>#sh_style</styleUrl>\n')
+				kml.write('		</Pair>\n')
+				kml.write('	</StyleMap>\n')
+				kml.write('	<Style id="sn_style">\n')
+				kml.write('		<PolyStyle>\n')
+				kml.write('			<color>00ff8080</color>\n')
+				kml.write('			<fill>0</fill>\n')
+				kml.write('		</PolyStyle>\n')
+				kml.write('	</Style>\n')
+				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 1\n')   
 
+				kml.write('	     <Style id="sh_ylw-pushpin">\n')
+				kml.write('	     	<IconStyle>\n')
+				kml.write('	     		<scale>1.2</scale>\n')
+				kml.write('	     	</IconStyle>\n')
+				kml.write('	     	<PolyStyle>\n')
+				kml.write('	     		<fill>0</fill>\n')
+				kml.write('	     	</PolyStyle>\n')
+				kml.write('	     </Style>\n')
+				kml.write('	     <Style id="sn_ylw-pushpin">\n')
+				kml.write('	     	<PolyStyle>\n')
+				kml.write('	     		<fill>0</fill>\n')
+				kml.write('	     	</PolyStyle>\n')
+				kml.write('	     </Style>\n')
+				kml.write('	     <StyleMap id="msn_ylw-pushpin">\n')
+				kml.write('	     	<Pair>\n')
+				kml.write('	     		<key>normal</key>\n')
+				kml.write('	     		<styleUrl>#sn_ylw-pushpin</styleUrl>\n')
+				kml.write('	     	</Pair>\n')
+				kml.write('	     	<Pair>\n')
+				kml.write('	     		<key>highlight</key>\n')
+				kml.write('	     		<styleUrl>#sh_ylw-pushpin</styleUrl>\n')
+				kml.write('	     	</Pair>\n')
+				kml.write('	     </StyleMap>\n')				
+				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 2\n')
 
+				kml.write('    <StyleMap id="msn_style">\n')
+				kml.write('        <Pair>\n')
+				kml.write('            <key>normal</key>\n')
+				kml.write('            <styleUrl>#sn_style</styleUrl>\n')
+				kml.write('        </Pair>\n')
+				kml.write('        <Pair>\n')
+				kml.write('            <key>highlight</key>\n')
+				kml.write('            <styleUrl>#sh_style</styleUrl>\n')
+				kml.write('        </Pair>\n')
+				kml.write('    </StyleMap>\n')
+				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 3\n')
+				
+				kml.write('	     	<Style id="hl">\n')
+				kml.write('	     		<IconStyle>\n')
+				kml.write('	     			<scale>0.7</scale>\n')
+				kml.write('	     			<Icon>\n')
+				kml.write('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle_highlight.png</href>\n')
+				kml.write('	     			</Icon>\n')
+				kml.write('	     		</IconStyle>\n')
+				kml.write('	     		<LabelStyle>\n')
+				kml.write('	     			<scale>0.7</scale>\n')
+				kml.write('	     		</LabelStyle>\n')							
+				kml.write('	     		<ListStyle>\n')
+				kml.write('	     		</ListStyle>\n')
+				kml.write('	     	</Style>\n')
+				kml.write('	     	<Style id="default">\n')
+				kml.write('	     		<IconStyle>\n')
+				kml.write('	     			<scale>0.7</scale>\n')
+				kml.write('	     			<Icon>\n')
+				kml.write('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href>\n')
+				kml.write('	     			</Icon>\n')
+				kml.write('	     		</IconStyle>\n')
+				kml.write('	     		<LabelStyle>\n')
+				kml.write('	     			<scale>0.7</scale>\n')
+				kml.write('	     		</LabelStyle>\n')			
+				kml.write('	     		<ListStyle>\n')
+				kml.write('	     		</ListStyle>\n')
+				kml.write('	     	</Style>\n')
+				kml.write('	     	<StyleMap id="default0">\n')
+				kml.write('	     		<Pair>\n')
+				kml.write('	     			<key>normal</key>\n')
+				kml.write('	     			<styleUrl>#default</styleUrl>\n')
+				kml.write('	     		</Pair>\n')
+				kml.write('	     		<Pair>\n')
+				kml.write('	     			<key>highlight</key>\n')
+				kml.write('	     			<styleUrl>#hl</styleUrl>\n')
+				kml.write('	     		</Pair>\n')
+				kml.write('	     	</StyleMap>\n')
+				kml.write('NEL MEZZO DEL CAMMIN DI NOSTRA VITA 4\n')				
+				for entry in state['layers']:
+				  kml.write (GDX_KmlLayerHeader(entry['layer']))
+				
+				rotazio = state['rotazio']
+				
+				
+				kml.write('      <Folder>\n')
+				
+				xc = (x1 + x3) / 2.
+				yc = (y1 + y3) / 2.
+				dx = (x3 - x1) * 75000. #100000.
 
-				#Export tfw-file
-				xScale = (mapRect.xMaximum() - mapRect.xMinimum()) /  image.width()
-				yScale = (mapRect.yMaximum() - mapRect.yMinimum()) /  image.height()
 
-							
-				f = open(out_folder + "/" + nomePNG	+ ".pngw", 'w')				
-				f.write(str(xScale) + '\n')
-				f.write(str(0) + '\n')
-				f.write(str(0) + '\n')
-				f.write('-' + str(yScale) + '\n')
-				f.write(str(mapRect.xMinimum()) + '\n')
-				f.write(str(mapRect.yMaximum()) + '\n')
-				f.write(str(mapRect.xMaximum()) + '\n')
-				f.write(str(mapRect.yMinimum()))				
-				f.close()
-			
+				kml.write('    		<open>1</open>\n')    
+				kml.write('    		<NetworkLink>\n')
+				kml.write('    		   <name>QGIS_link</name>\n')
+				kml.write('    		   <visibility>1</visibility>\n')
+				kml.write('    		   <open>1</open>\n')
+				kml.write('    		   <Link>\n')
+#				kml.write('    		      <href>../_WebServer/QGIS_link.kmz</href>\n')
+				kml.write('    		      <href>QGIS_link.kmz</href>\n')        
+				kml.write('    		   </Link>\n')
+				kml.write('    		</NetworkLink>\n')        
 
-				nomeLay = "gearthview" 	 # foo default name		
+				# the live layers of /layers, off until checked in the Places panel
+				kml.write('    		<NetworkLink>\n')
+				kml.write('    		   <name>QGIS_layers</name>\n')
+				kml.write('    		   <visibility>0</visibility>\n')
+				kml.write('    		   <Link>\n')
+				kml.write(('    		      <href>%s/layers</href>\n') %(GDX_ServerUrl))
+				kml.write('    		   </Link>\n')
+				kml.write('    		</NetworkLink>\n')
 
+        				
+				kml.write('    		<LookAt>\n')
+				stringazza = ("    		   <longitude>%lf</longitude>\n") %(xc)
+				kml.write(stringazza)				
+				stringazza = ("    		   <latitude>%lf</latitude>\n") %(yc)
+				kml.write(stringazza)				
+				kml.write('    		   <altitude>0</altitude>\n')
 
-#  Adesso scrivo il vettoriale
-#  Prendo il sistema di riferimento del Layer selezionato ------------------
-        
+				stringazza = ("    		   <heading>%lf</heading>\n") %(rotazio)
+				kml.write(stringazza)
         
-				layer = mapCanvas.currentLayer()
-				if layer:
-				  if layer.type() == layer.VectorLayer:				
-
-#				    nele = -1
-				    name = layer.source();
-				    nomeLayer = layer.name()
-				    nomeLay   = nomeLayer.replace(" ","_")
-
-				    kml.write('    <Folder>\n')
-				    stringazza =   ('			<name>%s</name>\n') % (nomeLay)
-				    kml.write (stringazza)     				          
-      				    
-				    crsSrc = layer.crs();
-
-				    crsDest = QgsCoordinateReferenceSystem(4326)  # Wgs84LLH
-				    xform = QgsCoordinateTransform(crsSrc, crsDest)
+				kml.write('    		   <tilt>0</tilt>\n')
+				stringazza = ("    		   <range>%lf</range>\n") %(dx)
+				kml.write(stringazza)				
+				kml.write('    		   <gx:altitudeMode>relativeToGround</gx:altitudeMode>\n')
+				kml.write('    		</LookAt>\n')
 
-#----------------------------------------------------------------------------
-#  Trasformo la finestra video in coordinate layer, 
-#     per estrarre solo gli elementi visibili
-#----------------------------------------------------------------------------
-#				    mapCanvas = iface.mapCanvas()
-				    boundBox = mapCanvas.extent() 
-                
-				    xMin = float(boundBox.xMinimum())
-				    yMin = float(boundBox.yMinimum())
+				kml.write('      <GroundOverlay>\n')
+				kml.write('    	 <name>QGisView</name>\n')
+        				
+				kml.write('    	<Icon>\n')
 
-				    xMax = float(boundBox.xMaximum())                
-				    yMax = float(boundBox.yMaximum())
-				    
-				    
-				    crs2 = mapCanvas.mapRenderer().destinationCrs()
-				    crsSrc2  = QgsCoordinateReferenceSystem(crs2.authid())   
-				    crsDest2 = QgsCoordinateReferenceSystem(layer.crs())   
-				    xform2   = QgsCoordinateTransform(crsSrc2, crsDest2)
-                              
-				    pt0 = xform2.transform(QgsPoint(xMin, yMin))
-				    pt1 = xform2.transform(QgsPoint(xMax, yMax))
-				    
-				    rect = QgsRectangle(pt0, pt1)
-				    
-#----------------------------------------------------------------------------
+#				nomePNG = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
+				stringazza = ("    	<href>%s.%s</href>\n") % (nomePNG, GDX_OverlayExt(state['profile']))
+				kml.write(stringazza)
+				kml.write('    		<viewBoundScale>1.0</viewBoundScale>\n')
+				kml.write('    	</Icon>\n')
+				kml.write('    	<gx:LatLonQuad>\n')
+				kml.write('    		<coordinates>\n')
 
+				quad = numpy.array([[x1, y1], [x2, y2], [x3, y3], [x4, y4]])
+				kml.write(GDX_FormatCoords(quad, altitude=0, zPrecision=0, terminator=' ') + '\n')
 
-				    rq = QgsFeatureRequest(rect)
+				kml.write('    		</coordinates>\n')
+				kml.write('    	</gx:LatLonQuad>\n')
+				kml.write('    </GroundOverlay>\n')
 
-				    iter = layer.getFeatures(rq)				    
-				    for feat in iter:
-				    
-#				      nele = nele + 1
-				      nele = feat.id()
-
-# Prendo il contenuto dei campi -------------
-#				      fff = feat.fields()
-#				      num = fff.count()
-#				      for iii in range(num):
-#				         print "%s " %(feat[iii])
-# -------------------------------------------
-
-# NathanW example code-----------------------------
-#				      for feature in layer.getFeatures():
-#				         for attr in feature:
-#				            print attr
-#
-#				      for f in layer.pendingFields():
-#				         print f.name()
-#-------------------------------------------------
-              				      
-				      # fetch geometry
-				      geom = feat.geometry()
-				       # show some information about the feature
+#				#Write kml footer
+#				kml.write('</kml>\n')
+#				#Close kml file
+#				kml.close()
 
-#				      print ("GeomType: %d") %(geom.type())
 
-#  For MultiPoint    http://gis.stackexchange.com/questions/55067/how-to-convert-multipoint-layer-to-point
-				      
-				      if geom.type() == QGis.Point:
-				        elem = geom.asPoint()
-				        x1 = elem.x()
-				        y1 = elem.y()
 
-				        pt1 = xform.transform(QgsPoint(x1, y1))
 
-				        kml.write ('	<Placemark>\n')
-				        
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml.write (stringazza)	
-                			        
-				        kml.write ('	<styleUrl>#default0</styleUrl>\n')
-
-# DESCRIPTION DATA-----------
-				        kml.write ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml.write ('	<description><![CDATA[\n')				        
-				        kml.write ('<html><body><table border="1">\n')
-				        kml.write ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           kml.write (stringazza)					           
-               	
-				        kml.write ('</table></body></html>\n')
-				        kml.write (']]></description>\n')
-				        
-#  VECCHIO METODO------------------------------------------------------------				        
-				        kml.write ('		<Point>\n')
-				        kml.write ('			<gx:drawOrder>1</gx:drawOrder>\n')
-				        stringazza =   ('			<coordinates>%.7lf,%.7lf</coordinates>\n') % (pt1.x(), pt1.y())
-				        kml.write (stringazza)                                  
-				        kml.write ('		</Point>\n')
-#  VECCHIO METODO------------------------------------------------------------
-
-#  NUOVO METODO------------------------------------------------------------
-#				        testo = geom.exportToWkt() 
-#				        geometra = ogr.CreateGeometryFromWkt(testo)
-#				        testoKML = geometra.ExportToKML()
-#				        kml.write (testoKML)
-#  NUOVO METODO------------------------------------------------------------
-
-				        kml.write ('	</Placemark>\n')
-
-
-				      elif geom.type() == QGis.Line:
-
-				        kml.write ('	<Placemark>\n')
-                	
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml.write (stringazza)
-
-# DESCRIPTION DATA-----------
-				        kml.write ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml.write ('	<description><![CDATA[\n')				        
-				        kml.write ('<html><body><table border="1">\n')
-				        kml.write ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           kml.write (stringazza)					           
-               	
-				        kml.write ('</table></body></html>\n')
-				        kml.write (']]></description>\n')
-				        
-#  VECCHIO METODO------------------------------------------------------------               			        
-#				        kml.write ('		<LineString>\n')
-#				        kml.write ('			<tessellate>1</tessellate>\n')
-#				        kml.write ('			<coordinates>\n')
-				        
-#				        elem = geom.asPolyline()
-				         
-#				        for p1 in elem:
-#				          x1,y1 = p1.x(),p1.y()
-
-#				          pt1 = xform.transform(QgsPoint(x1, y1))
-                                               
-#				          stringazza =   ('%.7lf,%.7lf \n') % (pt1.x(), pt1.y())
-#				          kml.write (stringazza)
-				          
-#				        kml.write ('			</coordinates>\n')                   
-#				        kml.write ('		</LineString>\n')
-#  VECCHIO METODO------------------------------------------------------------
-
-#  NUOVO METODO------------------------------------------------------------
-				        wkt = layer.crs().toWkt()
-				        source = osr.SpatialReference()
-				        source.ImportFromWkt(wkt)
-
-				        target = osr.SpatialReference()
-				        target.ImportFromEPSG(4326)
-
-				        transform = osr.CoordinateTransformation(source, target)
-
-				        testo = geom.exportToWkt() 
-#				        print testo
-				        testo = testo.replace("LineStringZ (", "LineString (")
-				        testo = testo.replace(" 0,", ",")
-				        testo = testo.replace(" 0)", ")")                
-				        geometra = ogr.CreateGeometryFromWkt(testo)
-				        geometra.Transform(transform)                
-				        testoKML = geometra.ExportToKML()
-				        kml.write (testoKML)
-#  NUOVO METODO------------------------------------------------------------                
-                
-				        kml.write ('	</Placemark>\n')
 
+				task.setProgress(5)
 
-				      elif geom.type() == QGis.Polygon:
+#  Adesso scrivo il vettoriale
 
-				        kml.write ('	<Placemark>\n')
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml.write (stringazza)				        
-				        kml.write ('		<styleUrl>#msn_style</styleUrl>\n')
-				        
-# DESCRIPTION DATA-----------
-				        kml.write ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml.write ('	<description><![CDATA[\n')				        
-				        kml.write ('<html><body><table border="1">\n')
-				        kml.write ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-                
-				        height = ',0 '
-				        extrusion = '<Polygon>'                                
-
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           # Se esiste un campo "height" prendi il valore e impostalo
-                   
-				           if (f.name() == "height"):
-				              height = ',' + str(feat[iii]) + ' '
-				              extrusion = '<Polygon><extrude>1</extrude><altitudeMode>relativeToGround</altitudeMode>'
-
-				           kml.write (stringazza)					           
-               	
-				        kml.write ('</table></body></html>\n')
-				        kml.write (']]></description>\n')
-				        
-				        
-				        
+				GDX_PublishLayers(task, state, kml)
 
-#  VECCHIO METODO------------------------------------------------------------                				        
-#				        kml.write ('		<Polygon>\n')
-#				        kml.write ('			<tessellate>1</tessellate>\n')
-#				        kml.write ('     <outerBoundaryIs>\n')
-#				        kml.write ('        <LinearRing>\n')
-#				        kml.write ('         <coordinates>\n')
-              
-#				        elem = geom.asPolygon()
-
-# http://qgis.spatialthoughts.com/2012/11/tip-count-number-of-vertices-in-layer.html				        
-#				        if geom.isMultipart():
-#				          print "MULTIPART !!!"
-#				          elem = geom.asMultiPolygon()
-
-##				          for polygon in elem:
-##				             for ring in polygon:
-## 				                print ("Pezzo con %d vertici") %(len(ring))
-
-                            			        			        
-#				        for iii in range (len(elem)):
-
-#				          if (iii == 1):				          
-#				            kml.write ('         </coordinates>\n')
-#				            kml.write ('         </LinearRing>\n')
-#				            kml.write ('         </outerBoundaryIs>\n')
-#				            kml.write ('         <innerBoundaryIs>\n')
-#				            kml.write ('         <LinearRing>\n')
-#				            kml.write ('         <coordinates>\n')
-
-#				          if (iii > 1):				          
-#				            kml.write ('         </coordinates>\n')
-#				            kml.write ('         </LinearRing>\n')
-#				            kml.write ('         </innerBoundaryIs>\n')
-#				            kml.write ('         <innerBoundaryIs>\n')
-#				            kml.write ('         <LinearRing>\n')
-#				            kml.write ('         <coordinates>\n')	
-				        
-#				          for jjj in range (len(elem[iii])):
-				                         
-#				            x1,y1 = elem[iii][jjj][0], elem[iii][jjj][1]
-
-#				            if geom.isMultipart():
-#				               pt1 = xform.transform(x1)
-#				            else:				            
-#				               pt1 = xform.transform(QgsPoint(x1, y1))
-                          
-#				            stringazza =   ('%.7lf,%.7lf,0 \n') % (pt1.x(), pt1.y())
-#				            kml.write (stringazza)
-
-#				        if (iii == 0):
-#				           kml.write ('         </coordinates>\n')
-#				           kml.write ('        </LinearRing>\n')
-#				           kml.write ('     </outerBoundaryIs>\n')
-#				           kml.write ('   </Polygon>\n')
-
-#				        if (iii > 0):
-#				           kml.write ('         </coordinates>\n')
-#				           kml.write ('        </LinearRing>\n')
-#				           kml.write ('     </innerBoundaryIs>\n')
-#				           kml.write ('   </Polygon>\n')	
-#  VECCHIO METODO------(chi lascia la vecchia strada...)-------------------
-
-
-#  NUOVO METODO------------------------------------------------------------
-				        wkt = layer.crs().toWkt()
-				        source = osr.SpatialReference()
-				        source.ImportFromWkt(wkt)
-
-				        target = osr.SpatialReference()
-				        target.ImportFromEPSG(4326)
-
-				        transform = osr.CoordinateTransformation(source, target)
-
-				        testo = geom.exportToWkt() 
-#				        print testo
-				        istr = testo.split(' ')
-#				        print istr[0] 
-#				        print istr[3]
-                        
-				        testo = testo.replace("PolygonZ (", "Polygon (")
-				        testo = testo.replace(" 0,", ",")
-				        testo = testo.replace(" 0)", ")")                                                
-				        geometra = ogr.CreateGeometryFromWkt(testo)
-				        geometra.Transform(transform)                
-				        testoKML = geometra.ExportToKML()
-#				        print testoKML
-     
-				        testoKML = testoKML.replace('<Polygon>',extrusion)
-                                   
-				        # Se non  un "PolygonZ", aggiungi la coordinata di estrusione                               
-				        #  altrimenti, utilizza la sua Z
-               
-				        if(istr[0] != "PolygonZ" or istr[3] == '0,'):
-
-				           testoKML = testoKML.replace(' ', height)
-				           stringazza = height + '</coordinates>'
-				           testoKML = testoKML.replace('</coordinates>', stringazza)
-                                
-#				        print testoKML
-				        kml.write (testoKML)
-#  NUOVO METODO------------------------------------------------------------ 
-
-                  				        
-				        kml.write ('	</Placemark>\n')
-				        
-				    kml.write ('  </Folder>\n')
-					    
-				    
 				kml.write ('</Folder>\n')
 
-				stringazza = ('<Schema name="%s" id="%s">\n') % (nomeLay, nomeLay)
-				kml.write (stringazza)				
-				kml.write ('	<SimpleField name="id" type="string"></SimpleField>\n')
-				kml.write ('</Schema>\n')		
-				
-				kml.write ('</Document>\n')        
+				kml.write ('</Document>\n')
 				kml.write ('</kml>\n')
-				kml.close()
 
+				task.setProgress(90)
 
 
-#http://cesiumjs.org/Cesium/Build/Apps/CesiumViewer/index.html?src=
-				
-				if platform.system() == "Windows":            
-						os.startfile(out_folder + '/doc.kml')
-						
-				if platform.system() == "Darwin":			
-						os.system("open " + str(out_folder + '/doc.kml'))
-						
-				if platform.system() == "Linux":            
-						os.system("xdg-open " + str(out_folder + '/doc.kml'))		
-
+# GDX_Publisher2 --------------------------------------
 
+#  GDX_Publisher2 is a generator: it yields the NetworkLink document a piece
+#  at a time, while features come out of layer.getFeatures(rq).
+#  FormPage writes the pieces through GDX_KmlProducer, so the whole
+#  document is never held in memory.
 
+def GDX_Publisher2(self, kml, view=None):
 
-# GDX_Publisher2 --------------------------------------
+#				print "GDX_Publisher2 --------------\n"
 
-def GDX_Publisher2(self, kml):
+				yield kml
 
-#				print "GDX_Publisher2 --------------\n"
+				if view:
+				  view['precision'] = GDX_ViewPrecision(view)
 
 				mapCanvas = self.iface.mapCanvas()
 				
@@ -1476,11 +4145,9 @@ def GDX_Publisher2(self, kml):
 			
 
 # HERE IT DELETES THE OLD IMAGE ------------------------------------
-# (if you comment these, images still remain ...  :)
-				for filename in glob.glob(str(tumpdir + '/*.png')) :
-				   os.remove( str(filename) )
-				for filename in glob.glob(str(tumpdir + '/*.pngw')) :
-				   os.remove( str(filename) )            
+# only the refresh overlays: the QGisView_ images belong to doc.kml
+				for filename in glob.glob(tumpdir + '/QGisRefresh_*'):
+				   os.remove(filename)
 # ------------------------------------------------------------------				
 
     
@@ -1497,35 +4164,45 @@ def GDX_Publisher2(self, kml):
 				height = mapRenderer.height()
 				srs = mapRenderer.destinationCrs()
 
-				# create output image and initialize it
-				image = QImage(QSize(width, height), QImage.Format_ARGB32)
-				image.fill(0)
-				
-				#adjust map canvas (renderer) to the image size and render
-				imagePainter = QPainter(image)
-				
-				zoom = 1
-				target_dpi = int(round(zoom * mapRenderer.outputDpi()))				
-				
-				mapRenderer.setOutputSize(QSize(width, height), target_dpi)
-			
-				mapRenderer.render(imagePainter)
-				imagePainter.end()
+				# sized for the Google Earth screen when the request tells its VIEW
+				width, height, target_dpi = GDX_OverlaySize(mapCanvas, view, mapRenderer.outputDpi())
+
+				mapSettings = GDX_OverlaySettings(mapCanvas, width, height, target_dpi)
+				# transparent where there is no data, as the QPainter render was
+				mapSettings.setBackgroundColor(QColor(255, 255, 255, 0))
+				profile = GDX_OverlayProfile(mapSettings)
+
+				result = {}
+				ready = defer.Deferred()
+
+				def rendered(data):
+				  result['data'] = data
+				  ready.callback(None)
+
+				# a newer refresh supersedes this one; the producer streams on once
+				# the render is done
+				job = GDX_RenderOverlay(mapSettings, rendered, 'refresh', profile)
+				try:
+				  yield ready
+				finally:
+				  job.cancel()
+				data = result['data']
 
 				xN = mapRect.xMinimum()
 				yN = mapRect.yMinimum()
 
-				nomePNG = ("QGisView_%lf_%lf_%s") % (xN, yN, adesso)
-				
-				input_file = out_folder + "/" + nomePNG + ".png"
-				
+				nomePNG = ("QGisRefresh_%lf_%lf_%s") % (xN, yN, adesso)
+
+				input_file = out_folder + "/" + nomePNG + "." + GDX_OverlayExt(profile)
+
 				#Save the image
-				image.save(input_file, "png")
+				if data is not None:
+				  f = open(input_file, 'wb')
+				  f.write(data)
+				  f.close()
 
 				layer = mapCanvas.currentLayer()
-				crsSrc = srs  # QgsCoordinateReferenceSystem(layer.crs())   # prendere quello attuale
-				crsDest = QgsCoordinateReferenceSystem(4326)  # Wgs84LLH
-				xform = QgsCoordinateTransform(crsSrc, crsDest)
+				xform = GDX_QgsTransform(srs, 4326)  # Wgs84LLH
 
 
 				x1 = mapRect.xMinimum()
@@ -1571,7 +4248,7 @@ def GDX_Publisher2(self, kml):
 				
 #				kml = kml + ('<?xml version="1.0" encoding="UTF-8"?>\n')
 #				kml = kml + ('<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">\n')				
-				kml = kml + ('    <Document>\n')
+				yield ('    <Document>\n')
 
 #				kml = kml + ('    	 <name>QGisView</name>\n')
 #				kml = kml + ('    	 <Snippet maxLines="0"></Snippet>\n') 
@@ -1579,66 +4256,68 @@ def GDX_Publisher2(self, kml):
 #				kml = kml + (loc)
 #				kml = kml + ('	     <open>0</open>\n')
 
-				kml = kml + ('	     <Style id="sh_ylw-pushpin">\n')
-				kml = kml + ('	     	<IconStyle>\n')
-				kml = kml + ('	     		<scale>1.2</scale>\n')
-				kml = kml + ('	     	</IconStyle>\n')
-				kml = kml + ('	     	<PolyStyle>\n')
-				kml = kml + ('	     		<fill>0</fill>\n')
-				kml = kml + ('	     	</PolyStyle>\n')
-				kml = kml + ('	     </Style>\n')
-				kml = kml + ('	     <Style id="sn_ylw-pushpin">\n')
-				kml = kml + ('	     	<PolyStyle>\n')
-				kml = kml + ('	     		<fill>0</fill>\n')
-				kml = kml + ('	     	</PolyStyle>\n')
-				kml = kml + ('	     </Style>\n')
-				kml = kml + ('	     <StyleMap id="msn_ylw-pushpin">\n')
-				kml = kml + ('	     	<Pair>\n')
-				kml = kml + ('	     		<key>normal</key>\n')
-				kml = kml + ('	     		<styleUrl>#sn_ylw-pushpin</styleUrl>\n')
-				kml = kml + ('	     	</Pair>\n')
-				kml = kml + ('	     	<Pair>\n')
-				kml = kml + ('	     		<key>highlight</key>\n')
-				kml = kml + ('	     		<styleUrl>#sh_ylw-pushpin</styleUrl>\n')
-				kml = kml + ('	     	</Pair>\n')
-				kml = kml + ('	     </StyleMap>\n')				
+				yield ('	     <Style id="sh_ylw-pushpin">\n')
+				yield ('	     	<IconStyle>\n')
+				yield ('	     		<scale>1.2</scale>\n')
+				yield ('	     	</IconStyle>\n')
+				yield ('	     	<PolyStyle>\n')
+				yield ('	     		<fill>0</fill>\n')
+				yield ('	     	</PolyStyle>\n')
+				yield ('	     </Style>\n')
+				yield ('	     <Style id="sn_ylw-pushpin">\n')
+				yield ('	     	<PolyStyle>\n')
+				yield ('	     		<fill>0</fill>\n')
+				yield ('	     	</PolyStyle>\n')
+				yield ('	     </Style>\n')
+				yield ('	     <StyleMap id="msn_ylw-pushpin">\n')
+				yield ('	     	<Pair>\n')
+				yield ('	     		<key>normal</key>\n')
+				yield ('	     		<styleUrl>#sn_ylw-pushpin</styleUrl>\n')
+				yield ('	     	</Pair>\n')
+				yield ('	     	<Pair>\n')
+				yield ('	     		<key>highlight</key>\n')
+				yield ('	     		<styleUrl>#sh_ylw-pushpin</styleUrl>\n')
+				yield ('	     	</Pair>\n')
+				yield ('	     </StyleMap>\n')				
 				
-				kml = kml + ('	     	<Style id="hl">\n')
-				kml = kml + ('	     		<IconStyle>\n')
-				kml = kml + ('	     			<scale>0.7</scale>\n')
-				kml = kml + ('	     			<Icon>\n')
-				kml = kml + ('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle_highlight.png</href>\n')
-				kml = kml + ('	     			</Icon>\n')
-				kml = kml + ('	     		</IconStyle>\n')
-				kml = kml + ('	     		<LabelStyle>\n')
-				kml = kml + ('	     			<scale>0.7</scale>\n')
-				kml = kml + ('	     		</LabelStyle>\n')							
-				kml = kml + ('	     		<ListStyle>\n')
-				kml = kml + ('	     		</ListStyle>\n')
-				kml = kml + ('	     	</Style>\n')
-				kml = kml + ('	     	<Style id="default">\n')
-				kml = kml + ('	     		<IconStyle>\n')
-				kml = kml + ('	     			<scale>0.7</scale>\n')
-				kml = kml + ('	     			<Icon>\n')
-				kml = kml + ('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href>\n')
-				kml = kml + ('	     			</Icon>\n')
-				kml = kml + ('	     		</IconStyle>\n')
-				kml = kml + ('	     		<LabelStyle>\n')
-				kml = kml + ('	     			<scale>0.7</scale>\n')
-				kml = kml + ('	     		</LabelStyle>\n')			
-				kml = kml + ('	     		<ListStyle>\n')
-				kml = kml + ('	     		</ListStyle>\n')
-				kml = kml + ('	     	</Style>\n')
-				kml = kml + ('	     	<StyleMap id="default0">\n')
-				kml = kml + ('	     		<Pair>\n')
-				kml = kml + ('	     			<key>normal</key>\n')
-				kml = kml + ('	     			<styleUrl>#default</styleUrl>\n')
-				kml = kml + ('	     		</Pair>\n')
-				kml = kml + ('	     		<Pair>\n')
-				kml = kml + ('	     			<key>highlight</key>\n')
-				kml = kml + ('	     			<styleUrl>#hl</styleUrl>\n')
-				kml = kml + ('	     		</Pair>\n')
-				kml = kml + ('	     	</StyleMap>\n')
+				yield ('	     	<Style id="hl">\n')
+				yield ('	     		<IconStyle>\n')
+				yield ('	     			<scale>0.7</scale>\n')
+				yield ('	     			<Icon>\n')
+				yield ('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle_highlight.png</href>\n')
+				yield ('	     			</Icon>\n')
+				yield ('	     		</IconStyle>\n')
+				yield ('	     		<LabelStyle>\n')
+				yield ('	     			<scale>0.7</scale>\n')
+				yield ('	     		</LabelStyle>\n')							
+				yield ('	     		<ListStyle>\n')
+				yield ('	     		</ListStyle>\n')
+				yield ('	     	</Style>\n')
+				yield ('	     	<Style id="default">\n')
+				yield ('	     		<IconStyle>\n')
+				yield ('	     			<scale>0.7</scale>\n')
+				yield ('	     			<Icon>\n')
+				yield ('	     				<href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href>\n')
+				yield ('	     			</Icon>\n')
+				yield ('	     		</IconStyle>\n')
+				yield ('	     		<LabelStyle>\n')
+				yield ('	     			<scale>0.7</scale>\n')
+				yield ('	     		</LabelStyle>\n')			
+				yield ('	     		<ListStyle>\n')
+				yield ('	     		</ListStyle>\n')
+				yield ('	     	</Style>\n')
+				yield ('	     	<StyleMap id="default0">\n')
+				yield ('	     		<Pair>\n')
+				yield ('	     			<key>normal</key>\n')
+				yield ('	     			<styleUrl>#default</styleUrl>\n')
+				yield ('	     		</Pair>\n')
+				yield ('	     		<Pair>\n')
+				yield ('	     			<key>highlight</key>\n')
+				yield ('	     			<styleUrl>#hl</styleUrl>\n')
+				yield ('	     		</Pair>\n')
+				yield ('	     	</StyleMap>\n')
+				if layer and layer.type() == layer.VectorLayer:
+				  yield GDX_KmlLayerHeader(layer)
 				
 				
 #				kml = kml + ('      <Folder>\n')
@@ -1646,6 +4325,18 @@ def GDX_Publisher2(self, kml):
 				xc = (x1 + x3) / 2.
 				yc = (y1 + y3) / 2.
 				dx = (x3 - x1) * 75000. #100000.
+
+				# the overlay rendered for this view, served from /gaeta
+				if data is not None:
+				  yield ('      <GroundOverlay>\n')
+				  yield ('    	 <name>QGisView</name>\n')
+				  yield ('    	<Icon>\n')
+				  yield (("    	<href>%s/gaeta/%s.%s</href>\n") % (GDX_ServerUrl, nomePNG, GDX_OverlayExt(profile)))
+				  yield ('    	</Icon>\n')
+				  yield ('    	<LatLonBox>\n')
+				  yield (("    		<north>%.7lf</north><south>%.7lf</south><east>%.7lf</east><west>%.7lf</west>\n") % (max(y1, y2, y3, y4), min(y1, y2, y3, y4), max(x1, x2, x3, x4), min(x1, x2, x3, x4)))
+				  yield ('    	</LatLonBox>\n')
+				  yield ('    </GroundOverlay>\n')
         				
 #				kml = kml + ('    		<LookAt>\n')
 #				stringazza = ("    		   <longitude>%lf</longitude>\n") %(xc)
@@ -1718,14 +4409,10 @@ def GDX_Publisher2(self, kml):
 				    nomeLayer = layer.name()
 				    nomeLay   = nomeLayer.replace(" ","_")
 
-				    kml = kml + ('    <Folder>\n')
+				    yield ('    <Folder>\n')
 				    stringazza =   ('			<name>%s</name>\n') % (nomeLay)
-				    kml = kml +  (stringazza)     				          
+				    yield (stringazza)     				          
       				    
-				    crsSrc = layer.crs();
-
-				    crsDest = QgsCoordinateReferenceSystem(4326)  # Wgs84LLH
-				    xform = QgsCoordinateTransform(crsSrc, crsDest)
 
 
 				    boundBox = mapCanvas.extent() 
@@ -1738,9 +4425,7 @@ def GDX_Publisher2(self, kml):
 				    
 				    
 				    crs2 = mapCanvas.mapRenderer().destinationCrs()
-				    crsSrc2  = QgsCoordinateReferenceSystem(crs2.authid())   
-				    crsDest2 = QgsCoordinateReferenceSystem(layer.crs())   
-				    xform2   = QgsCoordinateTransform(crsSrc2, crsDest2)
+				    xform2   = GDX_QgsTransform(crs2, layer.crs())
                               
 				    pt0 = xform2.transform(QgsPoint(xMin, yMin))
 				    pt1 = xform2.transform(QgsPoint(xMax, yMax))
@@ -1749,206 +4434,10 @@ def GDX_Publisher2(self, kml):
 				    
 
 
-				    rq = QgsFeatureRequest(rect)
-
-				    iter = layer.getFeatures(rq)				    
-				    for feat in iter:
-				    
-				      nele = feat.id()
-
-              				      
-				      # fetch geometry
-				      geom = feat.geometry()
-				       # show some information about the feature
-
-#				      print ("GeomType: %d") %(geom.type())
-				      
-				      if geom.type() == QGis.Point:
-				        elem = geom.asPoint()
-				        x1 = elem.x()
-				        y1 = elem.y()
-
-				        pt1 = xform.transform(QgsPoint(x1, y1))
-
-				        kml = kml +  ('	<Placemark>\n')
-				        
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml = kml +  (stringazza)	
-                			        
-				        kml = kml +  ('	<styleUrl>#default0</styleUrl>\n')
-
-# DESCRIPTION DATA-----------
-				        kml = kml +  ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml = kml +  ('	<description><![CDATA[\n')				        
-				        kml = kml +  ('<html><body><table border="1">\n')
-				        kml = kml +  ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           kml = kml +  (stringazza)					           
-               	
-				        kml = kml +  ('</table></body></html>\n')
-				        kml = kml +  (']]></description>\n')
-				        
-# DESCRIPTION DATA-----------
-
-				        
-				        kml = kml +  ('		<Point>\n')
-				        kml = kml +  ('			<gx:drawOrder>1</gx:drawOrder>\n')
-				        stringazza =   ('			<coordinates>%.7lf,%.7lf</coordinates>\n') % (pt1.x(), pt1.y())
-				        kml = kml +  (stringazza)                                  
-				        kml = kml +  ('		</Point>\n')
-				        kml = kml +  ('	</Placemark>\n')
-
-
-				      elif geom.type() == QGis.Line:
-
-				        kml = kml +  ('	<Placemark>\n')
-                	
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml = kml +  (stringazza)
-
-# DESCRIPTION DATA-----------
-				        kml = kml +  ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml = kml +  ('	<description><![CDATA[\n')				        
-				        kml = kml +  ('<html><body><table border="1">\n')
-				        kml = kml +  ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           kml = kml +  (stringazza)					           
-               	
-				        kml = kml +  ('</table></body></html>\n')
-				        kml = kml +  (']]></description>\n')
-				        
-				                        			        
-				        kml = kml +  ('		<LineString>\n')
-				        kml = kml +  ('			<tessellate>1</tessellate>\n')
-				        kml = kml +  ('			<coordinates>\n')
-				        
-				        elem = geom.asPolyline()
-				         
-				        for p1 in elem:
-				          x1,y1 = p1.x(),p1.y()
-
-				          pt1 = xform.transform(QgsPoint(x1, y1))
-                                               
-				          stringazza =   ('%.7lf,%.7lf \n') % (pt1.x(), pt1.y())
-				          kml = kml +  (stringazza)
-				          
-				        kml = kml +  ('			</coordinates>\n')                   
-				        kml = kml +  ('		</LineString>\n')
-				        kml = kml +  ('	</Placemark>\n')
-
-
-				      elif geom.type() == QGis.Polygon:
-
-				        kml = kml +  ('	<Placemark>\n')
-				        stringazza =   ('		<name>%s</name>\n') % (nele)
-				        kml = kml +  (stringazza)				        
-				        kml = kml +  ('		<styleUrl>#msn_style</styleUrl>\n')
-				        
-# DESCRIPTION DATA-----------
-				        kml = kml +  ('	<Snippet maxLines="0"></Snippet>\n')
-				        kml = kml +  ('	<description><![CDATA[\n')				        
-				        kml = kml +  ('<html><body><table border="1">\n')
-				        kml = kml +  ('<tr><th>Field Name</th><th>Field Value</th></tr>\n')
- 
- # Prendo il contenuto dei campi -------------
-				        fff = feat.fields()
-				        num = fff.count()                
-				        iii = -1
-				        for f in layer.pendingFields(): 				        
-				           iii = iii + 1
-				           
-				           stringazza = ('<tr><td>%s</td><td>%s</td></tr>\n') %(f.name(),feat[iii])
-
-				           kml = kml +  (stringazza)					           
-               	
-				        kml = kml +  ('</table></body></html>\n')
-				        kml = kml +  (']]></description>\n')
-				        
-# DESCRIPTION DATA-----------				        
+				    for piece in GDX_KmlLayerPieces(layer, rect, view):
+				      yield (piece)
 				        
-                				        
-				        kml = kml +  ('		<Polygon>\n')
-				        kml = kml +  ('			<tessellate>1</tessellate>\n')
-				        kml = kml +  ('     <outerBoundaryIs>\n')
-				        kml = kml +  ('        <LinearRing>\n')
-				        kml = kml +  ('         <coordinates>\n')
-              
-				        elem = geom.asPolygon()
-
-# h ttp://qgis.spatialthoughts.com/2012/11/tip-count-number-of-vertices-in-layer.html				        
-				        if geom.isMultipart():
-				          print "MULTIPART !!!"
-				          elem = geom.asMultiPolygon()
-
-				          for polygon in elem:
-				             for ring in polygon:
-				                print ("Pezzo con %d vertici") %(len(ring))
-
-                     
-                            			        			        
-				        for iii in range (len(elem)):
-
-				          if (iii == 1):				          
-				            kml = kml +  ('         </coordinates>\n')
-				            kml = kml +  ('         </LinearRing>\n')
-				            kml = kml +  ('         </outerBoundaryIs>\n')
-				            kml = kml +  ('         <innerBoundaryIs>\n')
-				            kml = kml +  ('         <LinearRing>\n')
-				            kml = kml +  ('         <coordinates>\n')
-
-				          if (iii > 1):				          
-				            kml = kml +  ('         </coordinates>\n')
-				            kml = kml +  ('         </LinearRing>\n')
-				            kml = kml +  ('         </innerBoundaryIs>\n')
-				            kml = kml +  ('         <innerBoundaryIs>\n')
-				            kml = kml +  ('         <LinearRing>\n')
-				            kml = kml +  ('         <coordinates>\n')	
-				        
-				          for jjj in range (len(elem[iii])):
-				                         
-				            x1,y1 = elem[iii][jjj][0], elem[iii][jjj][1]
-
-				            if geom.isMultipart():
-				               pt1 = xform.transform(x1)
-				            else:				            
-				               pt1 = xform.transform(QgsPoint(x1, y1))
-                          
-				            stringazza =   ('%.7lf,%.7lf,0 \n') % (pt1.x(), pt1.y())
-				            kml = kml +  (stringazza)
-
-				        if (iii == 0):
-				           kml = kml +  ('         </coordinates>\n')
-				           kml = kml +  ('        </LinearRing>\n')
-				           kml = kml +  ('     </outerBoundaryIs>\n')
-				           kml = kml +  ('   </Polygon>\n')
-
-				        if (iii > 0):
-				           kml = kml +  ('         </coordinates>\n')
-				           kml = kml +  ('        </LinearRing>\n')
-				           kml = kml +  ('     </innerBoundaryIs>\n')
-				           kml = kml +  ('   </Polygon>\n')	
-                  				        
-				        kml = kml +  ('	</Placemark>\n')
-				        
-				    kml = kml +  ('  </Folder>\n')
+				    yield ('  </Folder>\n')
 					    
 				    
 #				kml = kml +  ('</Folder>\n')
@@ -1958,10 +4447,9 @@ def GDX_Publisher2(self, kml):
 #				kml = kml +  ('	<SimpleField name="id" type="string"></SimpleField>\n')
 #				kml = kml +  ('</Schema>\n')		
 				
-				kml = kml +  ('</Document>\n')        
-				kml = kml +  ('</kml>\n')
+				yield ('</Document>\n')        
+				yield ('</kml>\n')
                 
-				return 	kml			
 	
 
 # ----------------------------------------------------
@@ -2058,6 +4546,24 @@ class gearthview:
         
         self.iface.addPluginToWebMenu(u"&GEarthView", self.aboutAction) 
 
+        # CRS / transform pool invalidation
+        QObject.connect(self.iface.mapCanvas(), SIGNAL("destinationCrsChanged()"), GDX_CrsPoolClear)
+        QObject.connect(QgsMapLayerRegistry.instance(), SIGNAL("layersAdded(QList<QgsMapLayer*>)"), self.layersAdded)
+        self.repaintSlots = {}
+        self.layersAdded(QgsMapLayerRegistry.instance().mapLayers().values())
+
+        # KML fragment cache of the removed layers
+        QObject.connect(QgsMapLayerRegistry.instance(), SIGNAL("layerWillBeRemoved(QString)"), GDX_FragmentRemoveLayer)
+
+# ---------------------------------------------------------
+    def layersAdded(self, layers):
+        for layer in layers:
+          QObject.connect(layer, SIGNAL("layerCrsChanged()"), GDX_CrsPoolClear)
+          # render cache: every repaint QGIS asks for changes the picture
+          slot = lambda layerId=layer.id(): GDX_RenderDirty(layerId)
+          layer.repaintRequested.connect(slot)
+          self.repaintSlots[layer.id()] = slot
+
 # ---------------------------------------------------------
     def unload(self):
         # Remove the plugin menu item and icon
@@ -2074,6 +4580,21 @@ class gearthview:
         #self.toolBar.removeAction(self.PasteFromGEaction)
         #self.toolBar.removeAction(self.aboutAction)
         #del self.GECombo
+        QObject.disconnect(self.iface.mapCanvas(), SIGNAL("destinationCrsChanged()"), GDX_CrsPoolClear)
+        QObject.disconnect(QgsMapLayerRegistry.instance(), SIGNAL("layersAdded(QList<QgsMapLayer*>)"), self.layersAdded)
+        for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+          QObject.disconnect(layer, SIGNAL("layerCrsChanged()"), GDX_CrsPoolClear)
+          slot = self.repaintSlots.pop(layer.id(), None)
+          if slot is not None:
+            layer.repaintRequested.disconnect(slot)
+          GDX_FragmentDisconnect(layer)
+        self.repaintSlots.clear()
+        GDX_FragmentCache.clear()
+        GDX_CrsPoolClear()
+        GDX_PublishCancelAll()
+        GDX_ParallelClose()
+        QObject.disconnect(QgsMapLayerRegistry.instance(), SIGNAL("layerWillBeRemoved(QString)"), GDX_FragmentRemoveLayer)
+
         self.toolBar.removeAction(self.action)
         if not self.toolBar.actions() :
           del self.toolBar       
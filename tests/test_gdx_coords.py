@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# GDX_FormatCoords: coordinate blocks of gdx_kml, fixed and trimmed
+# decimals, without QGIS or GDAL.
+#
+#   python -m unittest discover tests
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from gdx_kml import GDX_FormatCoords, GDX_KmlCoords
+
+
+class GDX_FormatCoordsTest(unittest.TestCase):
+
+				  def test_fixed_decimals(self):
+				    xyz = numpy.array([[12.5, 3., 0.], [-0.125, 45.1234567, 0.]])
+				    self.assertEqual(GDX_FormatCoords(xyz), '12.5000000,3.0000000 \n-0.1250000,45.1234567 \n')
+
+				  def test_trim(self):
+				    xyz = numpy.array([[12.5, 3., 0.], [100., 120.05, 0.], [-0.125, 45.1234567, 0.]])
+				    self.assertEqual(GDX_FormatCoords(xyz, trim=True), '12.5,3 \n100,120.05 \n-0.125,45.1234567 \n')
+
+				  def test_trim_keeps_the_value(self):
+				    xyz = numpy.random.RandomState(1).uniform(-180., 180., (200, 3)).round(4)
+				    text = GDX_FormatCoords(xyz, precision=4, trim=True)
+				    values = [[float(v) for v in row.split(',')] for row in text.split(' \n')[:-1]]
+				    self.assertEqual(values, xyz[:, :2].tolist())
+				    self.assertFalse([v for row in text.split(' \n') for v in row.split(',') if v.endswith('0') and '.' in v])
+
+				  def test_constant_z(self):
+				    xyz = numpy.array([[1., 2., 5.], [3., 4., 5.]])
+				    self.assertEqual(GDX_FormatCoords(xyz, withZ=True, precision=1), '1.0,2.0,5.00 \n3.0,4.0,5.00 \n')
+				    self.assertEqual(GDX_FormatCoords(xyz, withZ=True, precision=1, trim=True), '1,2,5 \n3,4,5 \n')
+
+				  def test_varying_z(self):
+				    xyz = numpy.array([[1., 2., 5.], [3., 4., 6.5]])
+				    self.assertEqual(GDX_FormatCoords(xyz, withZ=True, precision=1, trim=True), '1,2,5 \n3,4,6.5 \n')
+
+				  def test_altitude(self):
+				    xyz = numpy.array([[1., 2., 5.]])
+				    self.assertEqual(GDX_KmlCoords(xyz, altitude=30., precision=2), '1.00,2.00,30.00 \n')
+				    self.assertEqual(GDX_KmlCoords(xyz, altitude=30., precision=2, trim=True), '1,2,30 \n')
+
+				  def test_csv_rows(self):
+				    xyz = numpy.array([[1.5, 2., 0.]])
+				    self.assertEqual(GDX_FormatCoords(xyz, precision=2, suffix=',7,100%,0', terminator='\n'), '1.50,2.00,7,100%,0\n')
+
+				  def test_shortest_repr(self):
+				    xyz = numpy.array([[0.1, 2.]])
+				    self.assertEqual(GDX_FormatCoords(xyz, precision=None), '0.1,2.0 \n')
+
+				  def test_empty(self):
+				    self.assertEqual(GDX_FormatCoords(numpy.zeros((0, 3))), '')
+
+
+if __name__ == '__main__':
+				  unittest.main()
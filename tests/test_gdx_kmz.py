@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# GDX_KmzStream: the streamed KMZ archives of gdx_kml, read back with
+# zipfile, without QGIS or GDAL.
+#
+#   python -m unittest discover tests
+
+import os, sys, tempfile, unittest, zipfile
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gdx_kml import GDX_KmzStream, GDX_KmzPieces
+
+
+KML = u'<?xml version="1.0" encoding="UTF-8"?>\n<kml><Document><name>Citt\xe0</name></Document></kml>\n'
+
+
+class GDX_KmzStreamTest(unittest.TestCase):
+
+				  def archive(self, data):
+				    kmz = zipfile.ZipFile(StringIO(data))
+				    self.assertEqual(kmz.testzip(), None)
+				    return kmz
+
+				  def test_entries(self):
+				    out = StringIO()
+				    kmz = GDX_KmzStream(out)
+				    kmz.begin('doc.kml')
+				    for piece in KML.split('<'):
+				      kmz.write(piece and '<' + piece)
+				    kmz.end()
+				    kmz.writestr('files/overlay.png', b'\x89PNG' + b'\x00' * 5000, level=0)
+				    kmz.close()
+
+				    archive = self.archive(out.getvalue())
+				    self.assertEqual(archive.namelist(), ['doc.kml', 'files/overlay.png'])
+				    self.assertEqual(archive.read('doc.kml').decode('utf-8'), KML)
+				    self.assertEqual(archive.read('files/overlay.png'), b'\x89PNG' + b'\x00' * 5000)
+				    self.assertEqual(archive.getinfo('doc.kml').compress_type, zipfile.ZIP_DEFLATED)
+				    self.assertEqual(archive.getinfo('files/overlay.png').file_size, 5004)
+
+				  def test_levels(self):
+				    data = KML.encode('utf-8') * 2000
+				    sizes = []
+				    for level in (0, 9):
+				      out = StringIO()
+				      kmz = GDX_KmzStream(out, level)
+				      kmz.writestr('doc.kml', data)
+				      kmz.close()
+				      self.assertEqual(self.archive(out.getvalue()).read('doc.kml'), data)
+				      sizes.append(len(out.getvalue()))
+				    self.assertTrue(sizes[1] < sizes[0] / 10)
+
+				  def test_unicode_name(self):
+				    out = StringIO()
+				    kmz = GDX_KmzStream(out)
+				    kmz.writestr(u'Citt\xe0.kml', KML)
+				    kmz.close()
+				    self.assertEqual(self.archive(out.getvalue()).namelist(), [u'Citt\xe0.kml'])
+
+				  def test_writefile(self):
+				    handle, path = tempfile.mkstemp()
+				    os.write(handle, os.urandom(3 * 1048576 + 17))
+				    os.close(handle)
+				    try:
+				      out = StringIO()
+				      kmz = GDX_KmzStream(out)
+				      kmz.writefile('files/big.bin', path)
+				      kmz.close()
+				      self.assertEqual(self.archive(out.getvalue()).read('files/big.bin'), open(path, 'rb').read())
+				    finally:
+				      os.remove(path)
+
+				  def test_empty_archive(self):
+				    out = StringIO()
+				    GDX_KmzStream(out).close()
+				    self.assertEqual(self.archive(out.getvalue()).namelist(), [])
+
+
+class GDX_KmzPiecesTest(unittest.TestCase):
+
+				  def test_pieces(self):
+				    marker = object()
+				    closed = []
+
+				    def document():
+				      try:
+				        yield KML[:20]
+				        yield marker
+				        for iii in range(500):
+				          yield u'<Placemark><name>%d</name></Placemark>\n' % (iii)
+				        yield KML[20:]
+				      finally:
+				        closed.append(True)
+
+				    counts = {}
+				    chunks = list(GDX_KmzPieces(document(), level=1, counts=counts))
+				    self.assertTrue(marker in chunks)
+				    self.assertEqual(closed, [True])
+
+				    data = b''.join([chunk for chunk in chunks if chunk is not marker])
+				    archive = zipfile.ZipFile(StringIO(data))
+				    self.assertEqual(archive.testzip(), None)
+				    kml = archive.read('doc.kml').decode('utf-8')
+				    self.assertTrue(kml.startswith(KML[:20]))
+				    self.assertEqual(kml.count(u'<Placemark>'), 500)
+				    self.assertEqual(counts, {'placemarks': 500})
+
+				  def test_abandoned(self):
+				    closed = []
+
+				    def document():
+				      try:
+				        while True:
+				          yield u'<Placemark/>\n' * 1000
+				      finally:
+				        closed.append(True)
+
+				    pieces = document()
+				    stream = GDX_KmzPieces(pieces)
+				    next(stream)
+				    stream.close()
+				    self.assertEqual(closed, [True])
+
+
+if __name__ == '__main__':
+				  unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# GDX_WkbRead: the numpy WKB reader of gdx_kml, without QGIS or GDAL.
+#
+#   python -m unittest discover tests
+
+import os, sys, struct, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from gdx_kml import GDX_WkbRead, GDX_WkbParts, GDX_WkbTypeName
+
+
+def ring(order, coords):
+
+				  return struct.pack(order + 'I', len(coords)) + b''.join([struct.pack(order + 'd' * len(xyz), *xyz) for xyz in coords])
+
+
+class GDX_WkbReadTest(unittest.TestCase):
+
+				  def read(self, wkb):
+				    parts = []
+				    offset, hasZ = GDX_WkbRead(wkb, 0, parts)
+				    self.assertEqual(offset, len(wkb))
+				    return parts, hasZ
+
+				  def test_point(self):
+				    parts, hasZ = self.read(struct.pack('<BIdd', 1, 1, 6., 7.))
+				    self.assertFalse(hasZ)
+				    self.assertEqual([kind for kind, rings in parts], ['Point'])
+				    self.assertEqual(parts[0][1][0].tolist(), [[6., 7., 0.]])
+
+				  def test_empty_point(self):
+				    parts, hasZ = self.read(struct.pack('<BIdd', 1, 1, float('nan'), float('nan')))
+				    self.assertEqual(parts, [])
+
+				  def test_big_endian_iso_z(self):
+				    wkb = struct.pack('>BI', 0, 1002) + ring('>', [(1., 2., 3.), (4., 5., 6.)])
+				    parts, hasZ = self.read(wkb)
+				    self.assertTrue(hasZ)
+				    self.assertEqual(parts[0][0], 'LineString')
+				    self.assertEqual(parts[0][1][0].tolist(), [[1., 2., 3.], [4., 5., 6.]])
+
+				  def test_qgis_25d_polygon(self):
+				    outer = [(0., 0., 9.), (4., 0., 9.), (4., 4., 9.), (0., 0., 9.)]
+				    inner = [(1., 1., 9.), (2., 1., 9.), (2., 2., 9.), (1., 1., 9.)]
+				    wkb = struct.pack('<BII', 1, 0x80000003, 2) + ring('<', outer) + ring('<', inner)
+				    parts, hasZ = self.read(wkb)
+				    self.assertTrue(hasZ)
+				    kind, rings = parts[0]
+				    self.assertEqual(kind, 'Polygon')
+				    self.assertEqual([r.tolist() for r in rings], [[list(xyz) for xyz in outer], [list(xyz) for xyz in inner]])
+
+				  def test_m_dropped(self):
+				    wkb = struct.pack('<BI', 1, 2002) + ring('<', [(1., 2., 50.), (3., 4., 60.)])
+				    parts, hasZ = self.read(wkb)
+				    self.assertFalse(hasZ)
+				    self.assertEqual(parts[0][1][0].tolist(), [[1., 2., 0.], [3., 4., 0.]])
+
+				  def test_zm_point(self):
+				    parts, hasZ = self.read(struct.pack('<BIdddd', 1, 3001, 1., 2., 3., 4.))
+				    self.assertTrue(hasZ)
+				    self.assertEqual(parts[0][1][0].tolist(), [[1., 2., 3.]])
+
+				  def test_multi_and_collection(self):
+				    square = ring('<', [(0., 0.), (1., 0.), (1., 1.), (0., 0.)])
+				    polygon = struct.pack('<BII', 1, 3, 1) + square
+				    line = struct.pack('<BI', 1, 2) + ring('<', [(5., 5.), (6., 6.)])
+				    multi = struct.pack('<BII', 1, 6, 2) + polygon + polygon
+				    wkb = struct.pack('<BII', 1, 7, 2) + multi + line
+				    parts, hasZ = self.read(wkb)
+				    self.assertEqual([kind for kind, rings in parts], ['Polygon', 'Polygon', 'LineString'])
+
+				  def test_curve_refused(self):
+				    wkb = struct.pack('<BI', 1, 8) + ring('<', [(0., 0.), (1., 1.), (2., 0.)])
+				    self.assertRaises(ValueError, GDX_WkbRead, wkb, 0, [])
+
+				  def test_type_name(self):
+				    self.assertEqual(GDX_WkbTypeName(struct.pack('<BI', 1, 0x80000003)), 'PolygonZ')
+				    self.assertEqual(GDX_WkbTypeName(struct.pack('>BI', 0, 2002)), 'LineStringM')
+				    self.assertEqual(GDX_WkbTypeName(struct.pack('<BI', 1, 3006)), 'MultiPolygonZM')
+
+				  def test_parts(self):
+				    self.assertEqual(GDX_WkbParts(None), ([], False))
+				    parts, hasZ = GDX_WkbParts(struct.pack('<BIdd', 1, 1, 6., 7.))
+				    self.assertIsInstance(parts[0][1][0], numpy.ndarray)
+
+				  def test_parts_minimal(self):
+				    # nothing to simplify: read with numpy, OGR is not needed
+				    point = struct.pack('<BIdd', 1, 1, 6., 7.)
+				    multi = struct.pack('<BII', 1, 4, 2) + point + point
+				    line = struct.pack('<BI', 1, 2) + ring('<', [(5., 5.), (6., 6.)])
+				    triangle = struct.pack('<BII', 1, 3, 1) + ring('<', [(0., 0.), (1., 0.), (1., 1.), (0., 0.)])
+				    for wkb in (point, multi, line, triangle):
+				      parts, hasZ = GDX_WkbParts(wkb, tolerance=10.)
+				      self.assertTrue(parts)
+				    parts, hasZ = GDX_WkbParts(multi, tolerance=10., clip=(0., 0., 10., 10.))
+				    self.assertEqual([kind for kind, rings in parts], ['Point', 'Point'])
+
+
+if __name__ == '__main__':
+				  unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# GDX_FetchBenchmark --------------------------------------
+#
+#  Compares, on a layer of the running QGIS, the profile fetch of
+#  GDX_ProfileRequest (balloon fields and "height" only, with the profile
+#  filter) with a full fetch.  From the QGIS Python console, with the
+#  layer to measure active:
+#    execfile('<plugin folder>/tools/gdx_fetch_benchmark.py')
+#  The bytes are those of the geometries (WKB) and attribute values that
+#  reach Python.
+
+import sys, time
+
+import qgis.utils
+from PyQt4.QtCore import QPyNullVariant
+from qgis.core import QgsFeatureRequest
+
+
+# rect is in the layer CRS
+def GDX_FetchBenchmark(layer, rect=None, repeat=3):
+
+				# the loaded plugin module, whatever its folder is called
+				GDX_ProfileRequest = sys.modules[type(qgis.utils.plugins['gearthview']).__module__].GDX_ProfileRequest
+
+				full = QgsFeatureRequest()
+				if rect is not None:
+				  full.setFilterRect(rect)
+
+				results = {}
+				for label, rq in (('full', full), ('profile', GDX_ProfileRequest(layer, rect))):
+				  best = None
+				  for run in range(repeat):
+				    started = time.time()
+				    count = 0
+				    size = 0
+				    for feat in layer.getFeatures(rq):
+				      geom = feat.geometry()
+				      if geom is not None:
+				        size = size + len(geom.asWkb())
+				      for value in feat.attributes():
+				        if not isinstance(value, QPyNullVariant) and value is not None:
+				          size = size + len(unicode(value))
+				      count = count + 1
+				    seconds = time.time() - started
+				    if best is None or seconds < best:
+				      best = seconds
+				  results[label] = {'features': count, 'bytes': size, 'seconds': best}
+				  print ("GDX_FetchBenchmark: %-8s %d features, %d bytes, %.3f s") %(label, count, size, best)
+
+				return results
+
+
+if __name__ == '__main__':
+
+				iface = qgis.utils.iface
+				GDX_FetchBenchmark(iface.activeLayer(), iface.mapCanvas().extent())
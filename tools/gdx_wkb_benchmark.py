@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# GDX_WkbBenchmark --------------------------------------
+#
+#  python tools/gdx_wkb_benchmark.py [features] [vertices] compares, on
+#  polygon-heavy fixtures, the numpy WKB reader of gdx_kml with the OGR
+#  reader and with the old WKT round trip (ExportToWkt,
+#  CreateGeometryFromWkt, ExportToKML).  Needs numpy and GDAL, not QGIS.
+
+import os, sys, time, struct
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+from osgeo import ogr
+
+from gdx_kml import GDX_WkbParts, GDX_OgrWkbParts, GDX_KmlGeometry
+
+
+def GDX_WkbFixtures(features=2000, vertices=200):
+
+				def ring(cx, cy, radius, count, z):
+				  angles = numpy.linspace(0., 2. * numpy.pi, count)
+				  xyz = numpy.column_stack((cx + radius * numpy.cos(angles), cy + radius * numpy.sin(angles), numpy.ones(count) * z))
+				  xyz[-1] = xyz[0]
+				  return struct.pack('<I', count) + xyz.astype('<f8').tobytes()
+
+				def polygon(cx, cy, z):
+				  rings = [ring(cx, cy, 0.01, vertices, z), ring(cx, cy, 0.004, vertices // 4, z), ring(cx + 0.005, cy, 0.002, vertices // 4, z)]
+				  return struct.pack('<BII', 1, 0x80000003, len(rings)) + b''.join(rings)
+
+				fixtures = []
+				for iii in range(features):
+				  cx, cy = 12. + (iii % 100) * 0.03, 41. + (iii // 100) * 0.03
+				  if iii % 4 == 3:
+				    fixtures.append(struct.pack('<BII', 1, 0x80000006, 3) + b''.join([polygon(cx + k * 0.02, cy, 10.) for k in range(3)]))
+				  else:
+				    fixtures.append(polygon(cx, cy, 10.))
+				return fixtures
+
+
+def GDX_WkbBenchmark(fixtures, repeat=3):
+
+				def numpyPath(wkb):
+				  parts, hasZ = GDX_WkbParts(wkb)
+				  return GDX_KmlGeometry(parts, hasZ)
+
+				def ogrPath(wkb):
+				  parts, hasZ = GDX_OgrWkbParts(wkb)
+				  return GDX_KmlGeometry(parts, hasZ)
+
+				def wktPath(wkb):
+				  return ogr.CreateGeometryFromWkt(ogr.CreateGeometryFromWkb(wkb).ExportToWkt()).ExportToKML()
+
+				timings = {}
+				for name, path in (('numpy', numpyPath), ('ogr', ogrPath), ('wkt', wktPath)):
+				  best = None
+				  for iii in range(repeat):
+				    start = time.time()
+				    for wkb in fixtures:
+				      path(wkb)
+				    elapsed = time.time() - start
+				    if best is None or elapsed < best:
+				      best = elapsed
+				  timings[name] = best
+				return timings
+
+
+if __name__ == '__main__':
+
+				features = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+				vertices = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+				fixtures = GDX_WkbFixtures(features, vertices)
+				timings = GDX_WkbBenchmark(fixtures)
+				for name in ('numpy', 'ogr', 'wkt'):
+				  print('%-6s %8.3f s  %8.1f features/s  x%.1f' % (name, timings[name], len(fixtures) / timings[name], timings[name] / timings['numpy']))